@@ -0,0 +1,156 @@
+"""
+Cost-based admission control for analyze requests
+
+- Every request carries an estimated cost in units (1 unit ~ 1000 prompt tokens, see
+  agent_server.estimate_request_cost); a 2-page text invoice costs a few units, a 10-page
+  high-resolution scan a hundred
+- Per API key: a token bucket (capacity units, refilled at `refill` units/s) limits how much
+  work one client can push over time. Only keys listed in the budgets get their own bucket;
+  every other key (the header is client-supplied) shares one default bucket, so the bucket
+  table cannot grow without bound and rotating keys does not reset a budget
+- Globally: the sum of in-flight costs stays under `capacity`, so a burst of big scans cannot
+  overload the LLM boxes; a request that does not fit waits up to `max_wait_s` for running work
+  to finish, otherwise it is rejected. A lone request is always admitted when nothing else is
+  running, so an over-sized request is never starved
+- Rejections raise AdmissionRejected with a Retry-After estimate for the 429 response
+
+Usage from agent_server:
+  ADMISSION = AdmissionController(capacity=200, budgets=parse_budgets("team-a=300/3"), default_budget=(100, 1))
+  ticket = await ADMISSION.acquire(api_key, cost)     # raises AdmissionRejected
+  try: ... finally: await ADMISSION.release(ticket)
+"""
+
+from __future__ import annotations
+import asyncio
+import math
+import time
+from typing import Any, Dict, Optional, Tuple
+
+
+DEFAULT_KEY = "*"                  # zajednički bucket za ključeve bez vlastitog budžeta
+
+
+class AdmissionRejected(RuntimeError):
+    def __init__(self, reason: str, retry_after_s: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after_s = retry_after_s
+
+
+def parse_budgets(value: Optional[str]) -> Dict[str, Tuple[float, float]]:
+    """'team-a=300/3, batch=50/0.5' -> {'team-a': (300.0, 3.0), 'batch': (50.0, 0.5)}"""
+    out: Dict[str, Tuple[float, float]] = {}
+    for part in (value or "").split(","):
+        if "=" not in part:
+            continue
+        key, spec = part.split("=", 1)
+        cap, _, rate = spec.partition("/")
+        out[key.strip()] = (float(cap), float(rate or 0))
+    return out
+
+
+class Bucket:
+    def __init__(self, capacity: float, refill: float):
+        self.capacity = capacity
+        self.refill = refill            # units per second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.admitted = 0
+        self.rejected = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill)
+        self.updated = now
+
+    def wait_for(self, cost: float) -> float:
+        """Seconds until `cost` units are available (0 = now, inf = never)."""
+        self._refill()
+        need = min(cost, self.capacity) - self.tokens   # veći od kapaciteta: čeka pun bucket
+        if need <= 0:
+            return 0.0
+        return need / self.refill if self.refill > 0 else math.inf
+
+    def take(self, cost: float) -> None:
+        self.tokens -= min(cost, self.capacity)
+
+
+class Ticket:
+    __slots__ = ("key", "cost", "requested_at", "admitted_at")
+
+    def __init__(self, key: str, cost: float, requested_at: float):
+        self.key = key
+        self.cost = cost
+        self.requested_at = requested_at
+        self.admitted_at = time.monotonic()
+
+
+class AdmissionController:
+    def __init__(self, capacity: float, budgets: Optional[Dict[str, Tuple[float, float]]] = None,
+                 default_budget: Tuple[float, float] = (100.0, 1.0), max_wait_s: float = 0.0,
+                 retry_after_s: float = 5.0):
+        self.capacity = float(capacity)
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self.max_wait_s = float(max_wait_s)
+        self.retry_after_s = float(retry_after_s)
+        self.in_flight = 0.0
+        self.running = 0
+        self._buckets: Dict[str, Bucket] = {}
+        self._cond = asyncio.Condition()
+
+    def _bucket(self, key: str) -> Bucket:
+        if key not in self.budgets:
+            key = DEFAULT_KEY
+        b = self._buckets.get(key)
+        if b is None:
+            b = self._buckets[key] = Bucket(*self.budgets.get(key, self.default_budget))
+        return b
+
+    def _fits(self, cost: float) -> bool:
+        return self.running == 0 or self.capacity <= 0 or self.in_flight + cost <= self.capacity
+
+    async def acquire(self, key: str, cost: float) -> Ticket:
+        requested_at = time.monotonic()
+        async with self._cond:
+            bucket = self._bucket(key)
+            wait_s = bucket.wait_for(cost)
+            if wait_s > 0:
+                bucket.rejected += 1
+                raise AdmissionRejected("api key budget exhausted", wait_s if math.isfinite(wait_s) else 3600.0)
+            if not self._fits(cost):
+                deadline = time.monotonic() + self.max_wait_s
+                while not self._fits(cost):
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        bucket.rejected += 1
+                        raise AdmissionRejected("server at capacity", self.retry_after_s)
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout=left)
+                    except asyncio.TimeoutError:
+                        pass
+            bucket.take(cost)
+            bucket.admitted += 1
+            self.in_flight += cost
+            self.running += 1
+            return Ticket(key, cost, requested_at)
+
+    async def release(self, ticket: Ticket) -> None:
+        async with self._cond:
+            self.in_flight = max(0.0, self.in_flight - ticket.cost)
+            self.running = max(0, self.running - 1)
+            self._cond.notify_all()
+
+    def snapshot(self) -> Dict[str, Any]:
+        for b in self._buckets.values():
+            b._refill()
+        return {
+            "capacity": self.capacity,
+            "inFlight": round(self.in_flight, 2),
+            "running": self.running,
+            # ključevi su tajni -> samo prefiks
+            "keys": {(k[:4] + "…" if len(k) > 4 else k): {
+                         "tokens": round(b.tokens, 2), "capacity": b.capacity, "refillPerS": b.refill,
+                         "admitted": b.admitted, "rejected": b.rejected}
+                     for k, b in self._buckets.items()},
+        }
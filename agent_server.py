@@ -1,28 +1,170 @@
 # agent_server.py
 # FastAPI agent koji orkestrira PDF/slike preko tool-calling petlje na lokalni llama-cpp server
-from fastapi import FastAPI, UploadFile, Form
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, UploadFile, Form
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
-import base64, io, json, os
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, ConfigDict
+from typing import Callable, List, Optional, Dict, Any
+import asyncio, base64, hashlib, http.client, io, json, math, multiprocessing, os, socket, threading, time, uuid, zipfile, zlib
+import urllib.parse
 import requests
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 import pypdfium2 as pdfium                          # Windows-friendly PDF rendering
-from pdfminer.high_level import extract_text        # pdfminer.six
 from jsonschema import validate as js_validate, Draft202012Validator
 from jsonschema.exceptions import ValidationError
 from datetime import datetime
-from contextlib import suppress
+from contextlib import asynccontextmanager, nullcontext, suppress
+from llm_pool import EndpointPool, NoHealthyEndpoint
+from supplier_templates import TemplateStore
+from dedup_index import DedupIndex
+from pdf_bundle import extract_pages, split_bundle
+from admission import AdmissionController, AdmissionRejected, parse_budgets
+from job_queue import JobQueue
+from vision_windows import WindowCache, merge_windows, plan_windows
+import ocr_stage
+import pdf_probe
+import mem_profile
 
 # ---------- KONFIG ----------
+# Oba URL-a primaju listu odvojenu zarezom (više llama.cpp servera po ulozi)
 TEXT_LLM_URL   = os.getenv("TEXT_LLM_URL",   "http://127.0.0.1:8000")  # llama_cpp.server --model text.gguf
 VISION_LLM_URL = os.getenv("VISION_LLM_URL", "http://127.0.0.1:8001")  # llama_cpp.server --model vlm.gguf --mmproj ...
 MODEL_LABEL    = os.getenv("MODEL_LABEL", "local-gguf")
 MAX_PAGES_DEF  = int(os.getenv("MAX_PAGES_DEF", "3"))
 
+# Endpoint pool: circuit breaker + conversation affinity
+LLM_CB_FAILURES   = int(os.getenv("LLM_CB_FAILURES", "3"))        # uzastopne greške prije izbacivanja endpointa
+LLM_CB_COOLDOWN_S = float(os.getenv("LLM_CB_COOLDOWN_S", "15"))   # nakon toga aktivni probe prije vraćanja
+LLM_AFFINITY      = os.getenv("LLM_AFFINITY", "1").strip() == "1" # agent razgovor ostaje na istom endpointu (KV cache)
+LLM_TIMEOUT_S     = float(os.getenv("LLM_TIMEOUT_S", "120"))
+REQUEST_DEADLINE_S = float(os.getenv("REQUEST_DEADLINE_S", "300"))   # ukupni budžet zahtjeva; 0 = bez roka
+DISCONNECT_POLL_S  = float(os.getenv("DISCONNECT_POLL_S", "0.5"))    # koliko često se provjerava je li klijent još tu
+LLM_STREAM_CANCEL  = os.getenv("LLM_STREAM_CANCEL", "0").strip() == "1"  # LLM pozivi kao SSE stream (prekid između tokena)
+
+# Memorija: RSS i bajtovi stanja po zahtjevu, opcionalno tracemalloc vrh po fazi, plafon koji smanjuje render
+MEM_TRACE             = os.getenv("MEM_TRACE", "0").strip() == "1"         # tracemalloc (usporava alokacije ~2x)
+MEM_TRACE_FRAMES      = int(os.getenv("MEM_TRACE_FRAMES", "1"))
+MEM_REQUEST_CEILING_MB = float(os.getenv("MEM_REQUEST_CEILING_MB", "0"))    # procjena po zahtjevu; 0 = bez plafona
+
+# Pozadinski health check (0 = isključeno, endpointi se onda probaju pri pozivu)
+HEALTH_INTERVAL_S      = float(os.getenv("HEALTH_INTERVAL_S", "5"))
+HEALTH_STORE_INTERVAL_S = float(os.getenv("HEALTH_STORE_INTERVAL_S", "15"))  # SQLite brojači za /agent/health (snapshot); 0 = čitaj po zahtjevu u threadpoolu
+HEALTH_PROBE_TIMEOUT_S = float(os.getenv("HEALTH_PROBE_TIMEOUT_S", "3"))
+
+# Prompt prefix cache (llama.cpp): cache_prompt + opcionalno vezanje razgovora na slot
+LLM_CACHE_PROMPT = os.getenv("LLM_CACHE_PROMPT", "1").strip() == "1"
+LLM_SLOTS        = int(os.getenv("LLM_SLOTS", "0"))  # broj slotova po serveru (-np); 0 = nepoznato
+LLM_PIN_SLOT     = os.getenv("LLM_PIN_SLOT", "0").strip() == "1"  # razgovor -> fiksni slot (id_slot); inače server bira slobodan
+
+# Procjena prompt tokena i budžet konteksta (0 = bez automatskog izbora stranica/širine)
+CTX_BUDGET_TOKENS    = int(os.getenv("CTX_BUDGET_TOKENS", "0"))
+CTX_RESERVE_TOKENS   = int(os.getenv("CTX_RESERVE_TOKENS", "1024"))   # rezerva za odgovor
+CHARS_PER_TOKEN      = float(os.getenv("CHARS_PER_TOKEN", "3.2"))     # HR tekst s brojevima
+VLM_TOKENS_PER_IMAGE = int(os.getenv("VLM_TOKENS_PER_IMAGE", "576"))  # fiksno po slici (LLaVA-1.5)
+VLM_PATCH_PX         = int(os.getenv("VLM_PATCH_PX", "0"))            # >0: tokeni po patchu (Qwen2-VL = 28)
+MIN_RENDER_WIDTH     = int(os.getenv("MIN_RENDER_WIDTH", "768"))      # ispod toga tablice postaju nečitljive
+
+# Renderiranje stranica za VLM: 'fixed' (JPEG q80, zadana širina) | 'adaptive'
+RENDER_MODE            = os.getenv("RENDER_MODE", "fixed").lower()
+RENDER_MAX_WIDTH       = int(os.getenv("RENDER_MAX_WIDTH", "2048"))
+RENDER_TARGET_GLYPH_PX = float(os.getenv("RENDER_TARGET_GLYPH_PX", "10"))  # ciljana visina znaka u pikselima
+RENDER_TARGET_BYTES    = int(os.getenv("RENDER_TARGET_BYTES", "250000"))   # po stranici; 0 = bez limita
+RENDER_PAGE_TOKENS     = int(os.getenv("RENDER_PAGE_TOKENS", "0"))         # po stranici (uz VLM_PATCH_PX); 0 = bez limita
+
+# Upload slika (foto/sken): EXIF orijentacija, smanjenje, opcionalno ravnanje i izrezivanje papira
+IMAGE_MAX_PX  = int(os.getenv("IMAGE_MAX_PX", "2048"))           # dulja stranica nakon smanjenja
+IMAGE_DESKEW  = os.getenv("IMAGE_DESKEW", "0").strip() == "1"     # ispravi nagib do ±5°
+IMAGE_CROP    = os.getenv("IMAGE_CROP", "0").strip() == "1"       # izreži dokument s tamnije podloge
+
+# Region mode: VLM dobiva samo izreze označenih regija (anotacije) umjesto cijelih stranica
+REGION_MODE        = os.getenv("REGION_MODE", "0").strip() == "1"    # zadano za zahtjeve bez `region_mode` polja
+REGION_MIN_WIDTH   = int(os.getenv("REGION_MIN_WIDTH", "1024"))        # manji izrezi se povećavaju (najviše 3x)
+REGION_PAD         = float(os.getenv("REGION_PAD", "0.04"))            # rub oko regije, udio veće dimenzije
+REGION_OVERVIEW_PX = int(os.getenv("REGION_OVERVIEW_PX", "0"))         # >0: uz izreze i pregled cijele stranice
+
+# Lokalni OCR (Tesseract) za skenove: dovoljno pouzdan tekst ide text putem umjesto kroz VLM
+OCR_ENABLED   = os.getenv("OCR_ENABLED", "0").strip() == "1"       # treba pytesseract + tesseract (hrv, eng)
+OCR_LANG      = os.getenv("OCR_LANG", "hrv+eng")
+OCR_WORKERS   = int(os.getenv("OCR_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))  # procesa u poolu
+OCR_DPI       = int(os.getenv("OCR_DPI", "300"))
+OCR_MIN_CONF  = float(os.getenv("OCR_MIN_CONF", "80"))     # prosječna pouzdanost riječi (0-100), svaka stranica
+OCR_MIN_CHARS = int(os.getenv("OCR_MIN_CHARS", "50"))      # znakova po stranici, manje = stranica bez sadržaja za text put
+OCR_CACHE     = os.getenv("OCR_CACHE", "ocr_cache.sqlite")
+OCR_PAGE_TIMEOUT_S = float(os.getenv("OCR_PAGE_TIMEOUT_S", "60"))
+
+# Cijeli dokument kroz VLM: sve stranice skena u prozorima, paralelno na vision poolu
+VISION_FULL_DOC       = os.getenv("VISION_FULL_DOC", "0").strip() == "1"   # zadano za zahtjeve bez `full_document` polja
+VISION_FULL_MAX_PAGES = int(os.getenv("VISION_FULL_MAX_PAGES", "50"))
+VISION_WINDOW_PAGES   = int(os.getenv("VISION_WINDOW_PAGES", "3"))         # stranica po VLM pozivu
+VISION_WINDOW_TOKENS  = int(os.getenv("VISION_WINDOW_TOKENS", "0"))        # image tokena po prozoru; 0 = iz CTX_BUDGET_TOKENS
+VISION_WINDOW_WORKERS = int(os.getenv("VISION_WINDOW_WORKERS", "4"))       # prozora istovremeno (uskladiti s vision endpointima)
+VISION_WINDOW_CACHE   = int(os.getenv("VISION_WINDOW_CACHE", "512"))       # rezultata prozora u memoriji (LRU)
+
+# Paket računa u jednom PDF-u: podjela na dokumente i paralelna obrada
+BUNDLE_SPLIT     = os.getenv("BUNDLE_SPLIT", "0").strip() == "1"   # zadano za zahtjeve bez `split` polja
+BUNDLE_MAX_PAGES = int(os.getenv("BUNDLE_MAX_PAGES", "200"))
+BUNDLE_WORKERS   = int(os.getenv("BUNDLE_WORKERS", "4"))           # dokumenata istovremeno (uskladiti s brojem endpointa)
+
+# Admission control: procijenjeni trošak zahtjeva (1 jedinica ~ 1000 prompt tokena) protiv budžeta
+ADMISSION_ENABLED        = os.getenv("ADMISSION_ENABLED", "0").strip() == "1"
+ADMISSION_CAPACITY       = float(os.getenv("ADMISSION_CAPACITY", "200"))       # jedinica u obradi istovremeno; 0 = bez limita
+ADMISSION_DEFAULT_BUDGET = os.getenv("ADMISSION_DEFAULT_BUDGET", "100/1")      # kapacitet/punjenje po sekundi, zajedničko za ključeve izvan ADMISSION_BUDGETS
+ADMISSION_BUDGETS        = os.getenv("ADMISSION_BUDGETS", "")                  # "kljuc-a=300/3,kljuc-b=50/0.5"
+ADMISSION_MAX_WAIT_S     = float(os.getenv("ADMISSION_MAX_WAIT_S", "0"))       # čekanje na slobodan kapacitet prije 429
+ADMISSION_RETRY_AFTER_S  = float(os.getenv("ADMISSION_RETRY_AFTER_S", "5"))
+ADMISSION_KEY_HEADER     = os.getenv("ADMISSION_KEY_HEADER", "X-API-Key")
+ADMISSION_BASE_UNITS     = float(os.getenv("ADMISSION_BASE_UNITS", "1.0"))     # fiksno po zahtjevu (prompt + odgovor)
+
+# Hedged izvršavanje: text i vision put paralelno za PDF-ove sa slabim tekstualnim slojem
+HEDGE_MODE            = os.getenv("HEDGE_MODE", "0").strip() == "1"      # zadano za zahtjeve bez `hedge` polja
+HEDGE_DELAY_S         = float(os.getenv("HEDGE_DELAY_S", "-1"))          # <0 = percentil latencije prvog puta
+HEDGE_PERCENTILE      = float(os.getenv("HEDGE_PERCENTILE", "0.9"))
+HEDGE_MIN_SAMPLES     = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))        # manje uzoraka -> oba puta odmah
+HEDGE_WEAK_TEXT_CHARS = int(os.getenv("HEDGE_WEAK_TEXT_CHARS", "200"))   # znakova po stranici ispod kojih je tekst "slab"
+HEDGE_LOSER_WAIT_S = float(os.getenv("HEDGE_LOSER_WAIT_S", "2"))   # čekanje da prekinuti gubitnik završi (njegovi pozivi u _meta)
+
+# Predlošci dobavljača: naučena pravila umjesto LLM-a za poznate layoute
+TEMPLATES_ENABLED         = os.getenv("TEMPLATES_ENABLED", "0").strip() == "1"
+TEMPLATE_STORE            = os.getenv("TEMPLATE_STORE", "supplier_templates.sqlite")
+TEMPLATE_LEARN_MIN        = int(os.getenv("TEMPLATE_LEARN_MIN", "3"))          # suglasnih LLM rezultata prije učenja
+TEMPLATE_SPOT_CHECK_EVERY = int(os.getenv("TEMPLATE_SPOT_CHECK_EVERY", "20"))  # svaki N-ti pogodak ide i kroz LLM
+
+# Indeks (skoro) duplikata: isti račun ponovno skeniran/izvezen -> prethodni rezultat bez LLM-a
+DEDUP_ENABLED          = os.getenv("DEDUP_ENABLED", "0").strip() == "1"
+DEDUP_INDEX            = os.getenv("DEDUP_INDEX", "dedup_index.sqlite")
+DEDUP_TEXT_THRESHOLD   = float(os.getenv("DEDUP_TEXT_THRESHOLD", "0.9"))  # procijenjena Jaccard sličnost teksta
+DEDUP_IMAGE_ONLY_DIST  = int(os.getenv("DEDUP_IMAGE_ONLY_DIST", "-1"))    # dHash udaljenost za dokumente bez teksta, -1 = isključeno
+
+# Batch: više datoteka ili ZIP u jednom zahtjevu, rezultati kao NDJSON redom završetka
+BATCH_MAX_FILES     = int(os.getenv("BATCH_MAX_FILES", "500"))
+BATCH_MAX_BYTES     = int(os.getenv("BATCH_MAX_BYTES", str(512 * 1024 * 1024)))  # ukupno (raspakirano)
+BATCH_WORKERS       = int(os.getenv("BATCH_WORKERS", "0"))         # dokumenata istovremeno; 0 = endpointi x slotovi
+BATCH_CPU_PROCESSES = int(os.getenv("BATCH_CPU_PROCESSES", "0"))   # procesi za pdfminer (tekst, broj stranica); 0 = u niti
+
+# Asinkroni poslovi: upload se sprema u trajni red (SQLite), obrađuju ga radnici u pozadini
+JOBS_ENABLED      = os.getenv("JOBS_ENABLED", "0").strip() == "1"   # agent_worker.py ga uvijek uključuje
+JOB_DB            = os.getenv("JOB_DB", "jobs.sqlite")
+JOB_WORKERS       = int(os.getenv("JOB_WORKERS", "2"))            # radnih niti u ovom procesu; 0 = samo prihvat
+JOB_VISIBILITY_S  = float(os.getenv("JOB_VISIBILITY_S", "600"))   # lease bez heartbeata istječe -> posao se ponovno isporučuje
+JOB_MAX_ATTEMPTS  = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BACKOFF_S = float(os.getenv("JOB_RETRY_BACKOFF_S", "5"))  # 5 s, 10 s, 20 s ...
+JOB_POLL_S        = float(os.getenv("JOB_POLL_S", "1.0"))          # prazan red -> pauza prije sljedećeg pokušaja
+JOB_DEADLINE_S    = float(os.getenv("JOB_DEADLINE_S", "3600"))     # rok pozadinskog posla (umjesto REQUEST_DEADLINE_S); 0 = bez roka
+JOB_RETENTION_S   = float(os.getenv("JOB_RETENTION_S", "604800"))  # završeni poslovi se brišu nakon 7 dana; 0 = čuvaj zauvijek
+JOB_CALLBACK_TIMEOUT_S = float(os.getenv("JOB_CALLBACK_TIMEOUT_S", "10"))
+# Dozvoljeni hostovi za callback_url: "erp.example,hooks.example:8443,*.intra.example"; prazno = callbackovi isključeni
+JOB_CALLBACK_ALLOW = [h.strip().lower() for h in os.getenv("JOB_CALLBACK_ALLOW", "").split(",") if h.strip()]
+JOB_NODE_HEARTBEAT_S   = float(os.getenv("JOB_NODE_HEARTBEAT_S", "5"))   # javljanje čvora (API ili agent_worker.py) u tablicu nodes
+
+TEXT_POOL   = EndpointPool("text",   TEXT_LLM_URL,   failure_threshold=LLM_CB_FAILURES, cooldown_s=LLM_CB_COOLDOWN_S)
+VISION_POOL = EndpointPool("vision", VISION_LLM_URL, failure_threshold=LLM_CB_FAILURES, cooldown_s=LLM_CB_COOLDOWN_S)
+
 # Backend/policy selection for LLM execution
 LLM_BACKEND  = os.getenv("LLM_BACKEND", "openai_compat").lower()  # 'openai_compat' | 'hf'
 AGENT_POLICY = os.getenv("AGENT_POLICY", "llm_tools").lower()     # 'llm_tools' | 'rule_based'
+HF_EAGER_LOAD = os.getenv("HF_EAGER_LOAD", "0").strip() == "1"     # HF: učitaj model pri startu (u pozadini)
 
 # If user selects HF backend and didn't override policy, default to rule_based
 if LLM_BACKEND == "hf" and os.getenv("AGENT_POLICY") is None:
@@ -36,31 +178,520 @@ try:
 except Exception as _hf_err:
     HF_ENABLED = False
 
+# ---------- METRIKE ----------
+_METRICS_LOCK = threading.Lock()
+METRICS: Dict[str, float] = {}
+
+def metric_inc(name: str, value: float = 1.0) -> None:
+    with _METRICS_LOCK:
+        METRICS[name] = METRICS.get(name, 0.0) + value
+
+def metric_max(name: str, value: float) -> None:
+    """High-water gauge (npr. najveći RSS)."""
+    with _METRICS_LOCK:
+        METRICS[name] = max(METRICS.get(name, 0.0), value)
+
+# ---------- MEMORIJA ----------
+if MEM_TRACE:
+    mem_profile.start_tracing(MEM_TRACE_FRAMES)
+
+def mem_stage(state: "AgentState", name: str):
+    """Per-stage RSS/tracemalloc record in state.mem_info (sub-states of windows/bundle/hedge: no-op)."""
+    if state.mem_info is None:
+        return nullcontext()
+    return mem_profile.stage(state.mem_info.setdefault("stages", {}), name)
+
+def estimate_render_bytes(sizes: list, width: int) -> int:
+    """Peak bytes to render pages at `width`: one bitmap in flight (pdfium BGRA + PIL copy, ~7 B/px)
+    plus the data URLs held until the VLM call (~0.5 B/px with base64 and the JSON payload copy)."""
+    if not sizes:
+        return 0
+    px = [w * h for w, h in (_rendered_dims(sz, width) for sz in sizes)]
+    return int(max(px) * 7 + sum(px) * 0.5)
+
+def fit_render_memory(state: "AgentState", sizes: list, pages: int, width: int, stage: str) -> tuple[int, int]:
+    """(pages, width) under MEM_REQUEST_CEILING_MB: lower the width first (down to MIN_RENDER_WIDTH),
+    then drop pages; the request degrades instead of pushing the worker into the OOM killer."""
+    if MEM_REQUEST_CEILING_MB <= 0 or not sizes:
+        return pages, width
+    ceiling = int(MEM_REQUEST_CEILING_MB * 1024 * 1024)
+    # upload + kopija u pdfiumu + tekst
+    base = len(state.file_bytes) * 2 + len((state.text or "").encode("utf-8"))
+    need = lambda n, w: base + estimate_render_bytes(sizes[:n], w)
+    if need(pages, width) <= ceiling:
+        return pages, width
+    floor = min(width, MIN_RENDER_WIDTH)
+    widths = list(range(width, floor, -128)) + [floor]
+    choice = (1, floor)
+    for n in range(pages, 0, -1):
+        w = next((w for w in widths if need(n, w) <= ceiling), None)
+        if w is not None:
+            choice = (n, w)
+            break
+    metric_inc("mem_degraded_total")
+    metric_inc(f"mem_degraded_{stage}_total")
+    if state.mem_info is not None:
+        state.mem_info.setdefault("degraded", []).append(
+            {"stage": stage, "pages": [pages, choice[0]], "width": [width, choice[1]],
+             "estimatedBytes": need(*choice), "ceilingBytes": ceiling})
+    return choice
+
+# ---------- PREKID (CANCEL) ----------
+class RequestCancelled(RuntimeError):
+    """Work was cancelled (lost hedge, deadline, client gone)."""
+
+class CancelToken:
+    """Zajednički signal za prekid; callbackovi npr. zatvaraju socket prema llama.cpp.
+
+    deadline_s: rok od sada; djeca nasljeđuju raniji rok roditelja. check() nakon roka
+    prekida s razlogom "deadline"; timeout() daje HTTP timeout ograničen preostalim vremenom.
+    """
+    def __init__(self, parent: Optional["CancelToken"] = None, deadline_s: Optional[float] = None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+        self.reason: Optional[str] = None
+        self.deadline: Optional[float] = time.monotonic() + deadline_s if deadline_s else None
+        if parent is not None:
+            if parent.deadline is not None and (self.deadline is None or parent.deadline < self.deadline):
+                self.deadline = parent.deadline
+            parent.on_cancel(lambda: self.cancel(parent.reason))
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: Optional[str] = "cancelled") -> None:
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for cb in callbacks:
+            with suppress(Exception):
+                cb()
+
+    def on_cancel(self, cb: Callable[[], None]) -> Callable[[], None]:
+        """Register cb (runs at once if already cancelled); returns an unregister function."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(cb)
+                def unregister():
+                    with self._lock, suppress(ValueError):
+                        self._callbacks.remove(cb)
+                return unregister
+        with suppress(Exception):
+            cb()
+        return lambda: None
+
+    def remaining(self) -> Optional[float]:
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def check(self) -> None:
+        if not self._event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("deadline")
+        if self._event.is_set():
+            raise RequestCancelled(self.reason or "cancelled")
+
+    def timeout(self, default: float) -> float:
+        """default, ali ne dulje od preostalog roka (raises once the deadline has passed)."""
+        self.check()
+        left = self.remaining()
+        return default if left is None else max(0.05, min(default, left))
+
 # ---------- POMOĆNE ----------
 def data_url(img_bytes: bytes, mime="image/jpeg") -> str:
     return f"data:{mime};base64," + base64.b64encode(img_bytes).decode()
 
+def extract_pdf_text(file_bytes: bytes, cancel: Optional[CancelToken] = None) -> str:
+    """pdfminer text (same output as high_level.extract_text), page by page so a
+    cancelled/expired request stops between pages."""
+    return pdf_probe.extract_text(file_bytes, cancel.check if cancel is not None else None)
+
 def get_page_count(file_bytes: bytes) -> int:
     """Get total page count from PDF using pypdfium2"""
+    return pdf_probe.page_count(file_bytes)
+
+def get_page_sizes(file_bytes: bytes, max_pages: Optional[int] = None) -> list[tuple[float, float]]:
+    """Page sizes in PDF points (w, h) for the first max_pages pages."""
     try:
         pdf = pdfium.PdfDocument(file_bytes)
-        count = len(pdf)
+        n = len(pdf) if max_pages is None else min(len(pdf), max_pages)
+        sizes = [tuple(pdf[i].get_size()) for i in range(n)]
         pdf.close()
-        return count
+        return sizes
     except Exception:
-        return 1  # Fallback for corrupted/invalid PDFs
+        return []
+
+# ---------- ADAPTIVNO RENDERIRANJE ----------
+def _median_glyph_height_pt(page) -> Optional[float]:
+    """Median character box height (PDF points) from the text layer, None for scans."""
+    try:
+        textpage = page.get_textpage()
+        n = textpage.count_chars()
+        step = max(1, n // 2000)
+        heights = []
+        for i in range(0, n, step):
+            l, b, r, t = textpage.get_charbox(i)
+            if t - b > 0.5 and r - l > 0.1:
+                heights.append(t - b)
+        textpage.close()
+        if len(heights) < 20:
+            return None
+        heights.sort()
+        return heights[len(heights) // 2]
+    except Exception:
+        return None
+
+def _ink_density(img) -> float:
+    """Share of dark pixels on a small grayscale thumbnail."""
+    thumb = img.convert("L")
+    thumb.thumbnail((256, 256))
+    hist = thumb.histogram()
+    return sum(hist[:160]) / max(1, thumb.width * thumb.height)
+
+def _is_grayscale(img, tolerance: int = 24, max_share: float = 0.002) -> bool:
+    """True when (almost) no pixel has a visible channel spread."""
+    from PIL import ImageChops
+    if img.mode in ("L", "1"):
+        return True
+    thumb = img.convert("RGB")
+    thumb.thumbnail((256, 256))
+    r, g, b = thumb.split()
+    spread = ImageChops.lighter(ImageChops.lighter(ImageChops.difference(r, g), ImageChops.difference(g, b)),
+                                ImageChops.difference(r, b))
+    hist = spread.histogram()
+    return sum(hist[tolerance:]) / max(1, thumb.width * thumb.height) <= max_share
+
+def _trim_margins(img, threshold: int = 245, pad: int = 8):
+    """Crop white page margins, keeping a small padding."""
+    mask = img.convert("L").point(lambda v: 255 if v < threshold else 0)
+    bbox = mask.getbbox()
+    if not bbox:
+        return img
+    l, t, r, b = bbox
+    l, t = max(0, l - pad), max(0, t - pad)
+    r, b = min(img.width, r + pad), min(img.height, b + pad)
+    if (r - l) * (b - t) >= 0.97 * img.width * img.height:
+        return img
+    return img.crop((l, t, r, b))
+
+def encode_page_image(img, target_bytes: int = 0, min_width: int = 512) -> tuple[bytes, str]:
+    """Encode compactly: smallest of JPEG (quality stepped down to fit target_bytes) and,
+    for grayscale pages, PNG. Downscales as a last resort. Returns (bytes, mime)."""
+    from PIL import Image
+    gray = img.mode == "L"
+    while True:
+        candidates = []
+        if gray:
+            buf = io.BytesIO()
+            img.save(buf, format="PNG")
+            candidates.append((buf.getvalue(), "image/png"))
+        for q in (85, 75, 65, 55, 45):
+            buf = io.BytesIO()
+            img.save(buf, format="JPEG", quality=q, optimize=True)
+            candidates.append((buf.getvalue(), "image/jpeg"))
+            if not target_bytes or len(candidates[-1][0]) <= target_bytes:
+                break
+        best = min(candidates, key=lambda c: len(c[0]))
+        if not target_bytes or len(best[0]) <= target_bytes or img.width <= min_width:
+            return best
+        scale = max(0.5, (target_bytes / len(best[0])) ** 0.5)
+        img = img.resize((max(min_width, int(img.width * scale)), max(1, int(img.height * scale))), Image.LANCZOS)
+
+def _fit_page_tokens(img):
+    """Downscale so the page stays within RENDER_PAGE_TOKENS image tokens."""
+    from PIL import Image
+    if RENDER_PAGE_TOKENS <= 0 or VLM_PATCH_PX <= 0:
+        return img
+    tokens = estimate_image_tokens(*img.size)
+    if tokens <= RENDER_PAGE_TOKENS:
+        return img
+    s = (RENDER_PAGE_TOKENS / tokens) ** 0.5
+    return img.resize((max(1, int(img.width * s)), max(1, int(img.height * s))), Image.LANCZOS)
+
+def _adaptive_page_width(page, max_width: int) -> int:
+    """Render width from text size (text layer) or ink density (scans)."""
+    pw, _ = page.get_size()
+    lo, hi = min(MIN_RENDER_WIDTH, max_width), max_width
+    glyph = _median_glyph_height_pt(page)
+    if glyph:
+        want = pw * RENDER_TARGET_GLYPH_PX / glyph
+    else:
+        # skenirano: gušći sadržaj (tablice) -> veća rezolucija
+        probe = page.render(scale=512 / pw if pw > 0 else 1.0).to_pil()
+        density = _ink_density(probe)
+        frac = min(1.0, max(0.0, (density - 0.02) / 0.10))
+        want = lo + frac * (hi - lo)
+    return int(min(hi, max(lo, want)))
+
+def render_page_adaptive(page, max_width: int) -> str:
+    pw, _ = page.get_size()
+    width = _adaptive_page_width(page, max_width)
+    pil_image = page.render(scale=width / pw if pw > 0 else 1.0).to_pil()
+    if _is_grayscale(pil_image):
+        pil_image = pil_image.convert("L")
+    pil_image = _fit_page_tokens(_trim_margins(pil_image))
+    raw, mime = encode_page_image(pil_image, RENDER_TARGET_BYTES, min_width=min(MIN_RENDER_WIDTH, max_width))
+    metric_inc("render_pages_total")
+    metric_inc("render_bytes_total", len(raw))
+    return data_url(raw, mime)
+
+# ---------- UPLOAD SLIKA ----------
+def _sniff_mime(b: bytes) -> str:
+    if b.startswith(b"\x89PNG"):
+        return "image/png"
+    if b[:4] == b"RIFF" and b[8:12] == b"WEBP":
+        return "image/webp"
+    if b[:3] == b"GIF":
+        return "image/gif"
+    return "image/jpeg"
+
+def _deskew_angle(img, max_deg: float = 5.0, step: float = 0.5) -> float:
+    """Angle whose rotation gives the sharpest row profile (text lines horizontal)."""
+    from PIL import Image, ImageOps
+    thumb = ImageOps.invert(img.convert("L"))
+    thumb.thumbnail((600, 600))
+    best, best_score = 0.0, -1.0
+    steps = int(max_deg / step)
+    for k in range(-steps, steps + 1):
+        a = k * step
+        rot = thumb.rotate(a, resample=Image.BILINEAR, expand=False, fillcolor=0)
+        rows = list(rot.resize((1, rot.height), Image.BOX).getdata())
+        mean = sum(rows) / len(rows)
+        score = sum((v - mean) ** 2 for v in rows)
+        if score > best_score:
+            best, best_score = a, score
+    return best
+
+def _crop_to_document(img, min_share: float = 0.3):
+    """Crop a photographed page from a darker background (bright paper region bbox)."""
+    from PIL import ImageFilter
+    thumb = img.convert("L")
+    thumb.thumbnail((400, 400))
+    hist = thumb.histogram()
+    # prag između pozadine i papira: 60. percentil svjetline, ali barem 140
+    total, acc, thr = thumb.width * thumb.height, 0, 140
+    for v, c in enumerate(hist):
+        acc += c
+        if acc >= 0.6 * total:
+            thr = max(140, v - 30)
+            break
+    mask = thumb.point(lambda v: 255 if v >= thr else 0).filter(ImageFilter.MinFilter(5))
+    bbox = mask.getbbox()
+    if not bbox:
+        return img
+    sx, sy = img.width / thumb.width, img.height / thumb.height
+    l, t, r, b = int(bbox[0] * sx), int(bbox[1] * sy), int(bbox[2] * sx), int(bbox[3] * sy)
+    share = (r - l) * (b - t) / float(img.width * img.height)
+    if share < min_share or share > 0.95:
+        return img
+    return img.crop((l, t, r, b))
+
+def prepare_upload_image(file_bytes: bytes) -> str:
+    """Uploaded photo/scan -> compact data URL with the correct mime.
+
+    EXIF orientation, downscale to IMAGE_MAX_PX, optional deskew/crop (IMAGE_DESKEW,
+    IMAGE_CROP), grayscale when colourless, trimmed margins, same encoder as PDF pages.
+    Undecodable input is passed through unchanged.
+    """
+    from PIL import Image, ImageOps
+    try:
+        img = Image.open(io.BytesIO(file_bytes))
+        if MEM_REQUEST_CEILING_MB > 0 and img.format == "JPEG" and \
+                img.size[0] * img.size[1] * 9 > MEM_REQUEST_CEILING_MB * 1024 * 1024:
+            # dekodiranje već smanjeno (JPEG DCT scaling): bez punog bitmapa velike fotografije
+            img.draft("RGB", (IMAGE_MAX_PX, IMAGE_MAX_PX))
+            metric_inc("mem_degraded_upload_image_total")
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "P"):
+            rgba = img.convert("RGBA")
+            bg = Image.new("RGB", rgba.size, (255, 255, 255))
+            bg.paste(rgba, mask=rgba.split()[-1])
+            img = bg
+        elif img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        if max(img.size) > IMAGE_MAX_PX:
+            img.thumbnail((IMAGE_MAX_PX, IMAGE_MAX_PX), Image.LANCZOS)
+        if IMAGE_CROP:
+            img = _crop_to_document(img)
+        if IMAGE_DESKEW:
+            angle = _deskew_angle(img)
+            if angle:
+                img = img.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor="white")
+        if _is_grayscale(img):
+            img = img.convert("L")
+        img = _fit_page_tokens(_trim_margins(img))
+        raw, mime = encode_page_image(img, RENDER_TARGET_BYTES, min_width=min(MIN_RENDER_WIDTH, IMAGE_MAX_PX))
+    except Exception as e:
+        print(f"Image normalization failed: {e}")
+        raw, mime = file_bytes, _sniff_mime(file_bytes)
+    metric_inc("upload_images_total")
+    metric_inc("upload_image_bytes_in_total", len(file_bytes))
+    metric_inc("upload_image_bytes_out_total", len(raw))
+    return data_url(raw, mime)
+
+# ---------- REGIJE (ANOTACIJE) ----------
+def _num(v: Any) -> Optional[float]:
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+def annotation_regions(annotations: Any) -> List[Dict[str, Any]]:
+    """Regions from UI annotations -> [{page, box: (l, t, r, b), relative, label}].
+
+    Accepts {"circles": [{x, y, radius}]} (frontend image editor, source pixels) and
+    {"boxes"|"regions": [{x, y, width, height} | {bbox: [l, t, r, b]}]}. Coordinates that are
+    all <= 1 are page-relative; otherwise image pixels (uploads) or PDF points (PDFs).
+    `page` is 1-based, default 1.
+    """
+    if isinstance(annotations, list):
+        annotations = {"regions": annotations}
+    if not isinstance(annotations, dict):
+        return []
+    out = []
+    for c in annotations.get("circles") or []:
+        if not isinstance(c, dict):
+            continue
+        x, y, r = _num(c.get("x")), _num(c.get("y")), _num(c.get("radius"))
+        if None in (x, y, r) or r <= 0:
+            continue
+        out.append({"box": (x - r, y - r, x + r, y + r), "page": c.get("page"), "label": c.get("description")})
+    for b in (annotations.get("boxes") or []) + (annotations.get("regions") or []):
+        if not isinstance(b, dict):
+            continue
+        if isinstance(b.get("bbox"), (list, tuple)) and len(b["bbox"]) == 4:
+            box = tuple(_num(v) for v in b["bbox"])
+        else:
+            x, y, w, h = _num(b.get("x")), _num(b.get("y")), _num(b.get("width")), _num(b.get("height"))
+            box = (x, y, x + w, y + h) if None not in (x, y, w, h) else (None,)
+        if None in box or box[2] <= box[0] or box[3] <= box[1]:
+            continue
+        out.append({"box": box, "page": b.get("page"), "label": b.get("label") or b.get("description")})
+    for reg in out:
+        reg["page"] = max(1, int(_num(reg["page"]) or 1))
+        reg["relative"] = all(0.0 <= v <= 1.0 for v in reg["box"])
+    return out
+
+def _crop_region(img, box: tuple, units_per_px: float, relative: bool):
+    """Crop one region with padding and upscale small crops (<= 3x) for small print."""
+    from PIL import Image
+    if relative:
+        l, t, r, b = box[0] * img.width, box[1] * img.height, box[2] * img.width, box[3] * img.height
+    else:
+        l, t, r, b = (v / units_per_px for v in box)
+    pad = max(8.0, REGION_PAD * max(r - l, b - t))
+    l, t = max(0, int(l - pad)), max(0, int(t - pad))
+    r, b = min(img.width, int(r + pad)), min(img.height, int(b + pad))
+    if r - l < 4 or b - t < 4:
+        return None
+    crop = img.crop((l, t, r, b))
+    if crop.width < REGION_MIN_WIDTH:
+        f = min(3.0, REGION_MIN_WIDTH / crop.width, IMAGE_MAX_PX / max(crop.size))
+        if f > 1.0:
+            crop = crop.resize((int(crop.width * f), int(crop.height * f)), Image.LANCZOS)
+    return crop
+
+def _encode_region(img) -> str:
+    if _is_grayscale(img):
+        img = img.convert("L")
+    raw, mime = encode_page_image(_fit_page_tokens(img), RENDER_TARGET_BYTES, min_width=min(MIN_RENDER_WIDTH, img.width))
+    metric_inc("region_crops_total")
+    metric_inc("render_bytes_total", len(raw))
+    return data_url(raw, mime)
+
+def _overview(img) -> str:
+    thumb = img.copy()
+    thumb.thumbnail((REGION_OVERVIEW_PX, REGION_OVERVIEW_PX))
+    return _encode_region(thumb)
+
+def crop_regions(file_bytes: bytes, is_pdf: bool, regions: List[Dict[str, Any]]) -> List[str]:
+    """Data URLs of the annotated regions (plus an overview per page when REGION_OVERVIEW_PX > 0)."""
+    from PIL import Image, ImageOps
+    by_page: Dict[int, List[Dict[str, Any]]] = {}
+    for reg in regions:
+        by_page.setdefault(reg["page"], []).append(reg)
+    urls = []
+    if is_pdf:
+        pdf = pdfium.PdfDocument(file_bytes)
+        try:
+            for pno in sorted(by_page):
+                if pno > len(pdf):
+                    continue
+                page = pdf[pno - 1]
+                pw, _ = page.get_size()
+                scale = RENDER_MAX_WIDTH / pw if pw > 0 else 1.0
+                img = page.render(scale=scale).to_pil()
+                if REGION_OVERVIEW_PX > 0:
+                    urls.append(_overview(img))
+                for reg in by_page[pno]:
+                    crop = _crop_region(img, reg["box"], 1.0 / scale, reg["relative"])
+                    if crop is not None:
+                        urls.append(_encode_region(crop))
+        finally:
+            pdf.close()
+    else:
+        # koordinate iz UI-a su u pikselima originala nakon EXIF orijentacije
+        img = ImageOps.exif_transpose(Image.open(io.BytesIO(file_bytes))).convert("RGB")
+        if REGION_OVERVIEW_PX > 0:
+            urls.append(_overview(img))
+        for reg in regions:
+            crop = _crop_region(img, reg["box"], 1.0, reg["relative"])
+            if crop is not None:
+                urls.append(_encode_region(crop))
+    return urls
+
+def uses_regions(state: "AgentState") -> bool:
+    """Region mode sees only parts of the document: such results are not cached or learned from."""
+    return state.region_mode and bool(annotation_regions(state.annotations))
+
+def region_images(state: "AgentState") -> Optional[List[str]]:
+    """Region crops when region mode is on and annotations define regions, else None."""
+    if not state.region_mode:
+        return None
+    regions = annotation_regions(state.annotations)
+    if not regions:
+        return None
+    try:
+        urls = crop_regions(state.file_bytes, state.is_pdf, regions)
+    except Exception as e:
+        print(f"Region crop failed: {e}")
+        return None
+    if not urls:
+        return None
+    state.region_info = {"regions": len(regions), "images": len(urls), "overview": REGION_OVERVIEW_PX > 0}
+    return urls
 
-def rasterize_pdf_pages_pypdfium2(file_bytes: bytes, max_pages=3, width=1024) -> list[str]:
-    """Convert PDF pages to JPEG data URLs using pypdfium2"""
+def rasterize_pdf_pages_pypdfium2(file_bytes: bytes, max_pages=3, width=1024, adaptive: Optional[bool] = None,
+                                  cancel: Optional[CancelToken] = None, pages: Optional[List[int]] = None,
+                                  max_width: Optional[int] = None) -> list[str]:
+    """Convert PDF pages to JPEG data URLs using pypdfium2
+
+    adaptive (default RENDER_MODE == 'adaptive'): per-page width from text size or
+    content density, grayscale when colourless, trimmed margins, compact encoding.
+    With a context budget `width` is the upper bound, otherwise RENDER_MAX_WIDTH.
+    pages: explicit 0-based page indices instead of the first `max_pages`.
+    max_width: hard cap for both modes (memory ceiling).
+    """
+    if adaptive is None:
+        adaptive = RENDER_MODE == "adaptive"
     try:
         pdf = pdfium.PdfDocument(file_bytes)
-        n = min(len(pdf), max_pages)
+        indices = [i for i in pages if i < len(pdf)] if pages is not None else range(min(len(pdf), max_pages))
         images = []
         
-        for i in range(n):
+        for i in indices:
+            if cancel is not None:
+                cancel.check()
             page = pdf[i]
+            if adaptive:
+                cap = width if CTX_BUDGET_TOKENS > 0 else RENDER_MAX_WIDTH
+                images.append(render_page_adaptive(page, min(cap, max_width) if max_width else cap))
+                continue
             pw, ph = page.get_size()
-            scale = width / pw if pw > 0 else 1.0
+            scale = min(width, max_width or width) / pw if pw > 0 else 1.0
             
             # Render page to bitmap
             bitmap = page.render(scale=scale)  # RGB format
@@ -73,27 +704,315 @@ def rasterize_pdf_pages_pypdfium2(file_bytes: bytes, max_pages=3, width=1024) ->
             
         pdf.close()
         return images
+    except RequestCancelled:
+        raise
     except Exception as e:
         print(f"PDF rasterization failed: {e}")
         return []
 
-def openai_compat_chat(base_url: str, messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None,
-                       response_format: Optional[Dict[str, Any]] = None, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+def llm_call_stats(role: str, j: Dict[str, Any], elapsed_ms: float) -> Dict[str, Any]:
+    """Prompt-eval statistika iz llama.cpp odgovora (timings/usage)."""
+    timings = j.get("timings") or {}
+    usage = j.get("usage") or {}
+    prompt_tokens = usage.get("prompt_tokens")
+    cached = timings.get("cache_n")
+    if cached is None:
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    if cached is None and prompt_tokens is not None and timings.get("prompt_n") is not None:
+        cached = max(0, int(prompt_tokens) - int(timings["prompt_n"]))
+    per_tok = timings.get("prompt_per_token_ms")
+    saved = round(cached * per_tok, 1) if cached and per_tok else 0.0
+    return {
+        "role": role,
+        "elapsedMs": round(elapsed_ms, 1),
+        "promptTokens": prompt_tokens,
+        "cachedPromptTokens": cached,
+        "promptEvalMs": timings.get("prompt_ms"),
+        "promptEvalSavedMs": saved,
+        "completionTokens": usage.get("completion_tokens"),
+    }
+
+def _record_llm_call(stats: Optional[List[Dict[str, Any]]], call: Dict[str, Any]) -> None:
+    metric_inc("llm_calls_total")
+    metric_inc("llm_prompt_tokens_total", call.get("promptTokens") or 0)
+    metric_inc("llm_cached_prompt_tokens_total", call.get("cachedPromptTokens") or 0)
+    metric_inc("llm_prompt_eval_ms_total", call.get("promptEvalMs") or 0)
+    metric_inc("llm_prompt_eval_saved_ms_total", call.get("promptEvalSavedMs") or 0)
+    if stats is not None:
+        stats.append(call)
+
+# ---------- PROCJENA TROŠKA ----------
+def estimate_text_tokens(text: Optional[str]) -> int:
+    return int(math.ceil(len(text or "") / CHARS_PER_TOKEN))
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Image tokens for the configured VLM: fixed per image or per VLM_PATCH_PX patch."""
+    if VLM_PATCH_PX > 0:
+        return int(math.ceil(width / VLM_PATCH_PX) * math.ceil(height / VLM_PATCH_PX))
+    return VLM_TOKENS_PER_IMAGE
+
+def _rendered_dims(page_size: tuple[float, float], width: int) -> tuple[int, int]:
+    pw, ph = page_size
+    return width, int(round(width * ph / pw)) if pw > 0 else width
+
+def _dataurl_dims(url: str) -> tuple[int, int]:
+    """Image size from a data URL (PIL reads only the header)."""
+    from PIL import Image
+    try:
+        raw = base64.b64decode(url[url.find(",") + 1:])
+        with Image.open(io.BytesIO(raw)) as im:
+            return im.size
+    except Exception:
+        return (0, 0)
+
+def plan_vision_budget(page_sizes: list[tuple[float, float]], max_pages: int, width: int,
+                       base_tokens: int) -> tuple[int, int, int]:
+    """Choose (pages, width, image_tokens) that fit CTX_BUDGET_TOKENS.
+
+    Keeps as many pages as possible and lowers the render width first (down to
+    MIN_RENDER_WIDTH), then drops pages. Without a budget returns the request unchanged.
+    """
+    pages = max(1, min(max_pages, len(page_sizes) or max_pages))
+    sizes = page_sizes or [(595.0, 842.0)] * pages  # A4 ako veličine nisu poznate
+    cost = lambda n, w: sum(estimate_image_tokens(*_rendered_dims(sz, w)) for sz in sizes[:n])
+    if CTX_BUDGET_TOKENS <= 0:
+        return pages, width, cost(pages, width)
+    avail = CTX_BUDGET_TOKENS - CTX_RESERVE_TOKENS - base_tokens
+    floor = min(width, MIN_RENDER_WIDTH)
+    widths = list(range(width, floor, -64)) + [floor] if VLM_PATCH_PX > 0 else [width]
+    for n in range(pages, 0, -1):
+        for w in widths:
+            if cost(n, w) <= avail:
+                return n, w, cost(n, w)
+    return 1, widths[-1], cost(1, widths[-1])
+
+def estimate_request_cost(state: "AgentState") -> Dict[str, Any]:
+    """Cheap pre-flight cost estimate for admission control (no pdfminer, no rendering).
+
+    Units = ADMISSION_BASE_UNITS + estimated prompt tokens / 1000 for the path the request will
+    take: text layer -> text tokens, scan -> image tokens at the render width, hedge -> both,
+    bundle split -> every page, full document scan -> up to VISION_FULL_MAX_PAGES pages.
+    """
+    from PIL import Image
+    text_tokens = image_tokens = 0
+    if state.is_pdf:
+        pdf = pdfium.PdfDocument(state.file_bytes)
+        try:
+            n = min(len(pdf), BUNDLE_MAX_PAGES if state.split else state.max_pages)
+            tp = pdf[0].get_textpage() if n else None
+            chars = tp.count_chars() if tp is not None else 0
+            if tp is not None:
+                tp.close()
+            if state.full_document and chars < 30:
+                # sken ide kroz sve stranice (prozori)
+                n = min(len(pdf), max(n, VISION_FULL_MAX_PAGES))
+            sizes = [tuple(pdf[i].get_size()) for i in range(n)]
+        finally:
+            pdf.close()
+        width = RENDER_MAX_WIDTH if RENDER_MODE == "adaptive" else 1024
+        vision_tokens = sum(estimate_image_tokens(*_rendered_dims(sz, width)) for sz in sizes)
+        if chars >= 30:
+            text_tokens = int(chars * n / CHARS_PER_TOKEN)
+            path = "text"
+            if state.hedge and chars < HEDGE_WEAK_TEXT_CHARS:
+                image_tokens, path = vision_tokens, "hedge"
+        else:
+            image_tokens, path = vision_tokens, "vision"
+        pages = n
+    else:
+        try:
+            with Image.open(io.BytesIO(state.file_bytes)) as im:
+                w, h = im.size
+        except Exception:
+            w, h = IMAGE_MAX_PX, IMAGE_MAX_PX
+        s = min(1.0, IMAGE_MAX_PX / max(w, h, 1))
+        image_tokens, path, pages = estimate_image_tokens(int(w * s), int(h * s)), "image", 1
+    units = ADMISSION_BASE_UNITS + (text_tokens + image_tokens) / 1000.0
+    return {"units": round(units, 2), "path": path, "pages": pages,
+            "textTokens": text_tokens, "imageTokens": image_tokens}
+
+def admission_cost(state: "AgentState") -> Dict[str, Any]:
+    """estimate_request_cost, or the base units if the estimate fails (a broken page must not
+    fail a document that the analysis itself may still handle)."""
+    try:
+        return estimate_request_cost(state)
+    except Exception as e:
+        print(f"Admission cost estimate failed: {e}")
+        metric_inc("admission_estimate_failed_total")
+        return {"units": ADMISSION_BASE_UNITS, "path": "unknown", "error": str(e)[:100]}
+
+def text_char_budget(base_tokens: int) -> int:
+    """Max characters of document text that fit the budget (100000 safety cut otherwise);
+    0 when the prompt alone is over the budget."""
+    if CTX_BUDGET_TOKENS <= 0:
+        return 100000
+    avail = CTX_BUDGET_TOKENS - CTX_RESERVE_TOKENS - base_tokens
+    return max(0, min(100000, int(avail * CHARS_PER_TOKEN)))
+
+def _record_estimate(state: "AgentState", path: str, text_tokens: int, image_tokens: int,
+                     pages: Optional[int] = None, width: Optional[int] = None) -> Dict[str, Any]:
+    est = {
+        "path": path,
+        "promptTokens": text_tokens + image_tokens,
+        "textTokens": text_tokens,
+        "imageTokens": image_tokens,
+        "pages": pages,
+        "width": width,
+        "budgetTokens": CTX_BUDGET_TOKENS or None,
+        "withinBudget": (text_tokens + image_tokens + CTX_RESERVE_TOKENS <= CTX_BUDGET_TOKENS) if CTX_BUDGET_TOKENS > 0 else None,
+    }
+    state.estimate = est
+    metric_inc("estimated_prompt_tokens_total", est["promptTokens"])
+    metric_inc(f"estimated_{path}_requests_total")
+    return est
+
+def _read_sse_completion(r: requests.Response, cancel: CancelToken) -> Dict[str, Any]:
+    """Assemble a streamed (SSE) chat completion into the non-stream response shape."""
+    content: List[str] = []
+    tool_calls: Dict[int, Dict[str, Any]] = {}
+    out: Dict[str, Any] = {}
+    finish = None
+    for line in r.iter_lines():
+        cancel.check()
+        if not line or not line.startswith(b"data:"):
+            continue
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            break
+        chunk = json.loads(data)
+        for k in ("usage", "timings"):
+            if chunk.get(k):
+                out[k] = chunk[k]
+        for ch in chunk.get("choices") or []:
+            delta = ch.get("delta") or {}
+            if delta.get("content"):
+                content.append(delta["content"])
+            for tc in delta.get("tool_calls") or []:
+                slot = tool_calls.setdefault(tc.get("index", 0), {"id": None, "type": "function",
+                                                                  "function": {"name": "", "arguments": ""}})
+                if tc.get("id"):
+                    slot["id"] = tc["id"]
+                fn = tc.get("function") or {}
+                slot["function"]["name"] += fn.get("name") or ""
+                slot["function"]["arguments"] += fn.get("arguments") or ""
+            finish = ch.get("finish_reason") or finish
+    msg: Dict[str, Any] = {"role": "assistant", "content": "".join(content) if content or not tool_calls else None}
+    if tool_calls:
+        msg["tool_calls"] = [tool_calls[i] for i in sorted(tool_calls)]
+    out["choices"] = [{"index": 0, "message": msg, "finish_reason": finish}]
+    return out
+
+def _post_abortable(url: str, payload: Dict[str, Any], cancel: CancelToken) -> Dict[str, Any]:
+    """Plain (non-streaming) POST; cancel shuts the socket down, llama.cpp sees the closed
+    connection and frees the slot. Network errors are raised as the requests exceptions the
+    caller already handles."""
+    u = urllib.parse.urlsplit(url)
+    conn_cls = http.client.HTTPSConnection if u.scheme == "https" else http.client.HTTPConnection
+    conn = conn_cls(u.hostname, u.port, timeout=cancel.timeout(LLM_TIMEOUT_S))
+    try:
+        conn.connect()
+    except OSError as e:
+        conn.close()
+        raise requests.ConnectionError(str(e)) from e
+    sock = conn.sock
+    unregister = cancel.on_cancel(lambda: sock.shutdown(socket.SHUT_RDWR))
+    try:
+        conn.request("POST", (u.path or "/") + (f"?{u.query}" if u.query else ""),
+                     body=json.dumps(payload).encode("utf-8"), headers={"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        body = resp.read()
+    except socket.timeout as e:
+        cancel.check()
+        raise requests.Timeout(str(e)) from e
+    except (OSError, http.client.HTTPException) as e:
+        cancel.check()  # prekinuti socket -> RequestCancelled umjesto mrežne greške
+        raise requests.ConnectionError(str(e)) from e
+    finally:
+        unregister()
+        conn.close()
+    if resp.status >= 400:
+        raise RuntimeError(f"LLM HTTP {resp.status}: {body[:200].decode('utf-8', 'replace')}")
+    return json.loads(body)
+
+def _post_streaming(url: str, payload: Dict[str, Any], cancel: CancelToken) -> Dict[str, Any]:
+    """Streaming (SSE) POST (LLM_STREAM_CANCEL=1); cancel is checked between chunks and closing
+    the response closes the connection."""
+    payload = dict(payload, stream=True, stream_options={"include_usage": True})
+    r = requests.post(url, json=payload, timeout=cancel.timeout(LLM_TIMEOUT_S), stream=True)
+    try:
+        if not r.ok:
+            raise RuntimeError(f"LLM HTTP {r.status_code}: {r.text[:200]}")
+        return _read_sse_completion(r, cancel)
+    except (requests.RequestException, OSError):
+        cancel.check()
+        raise
+    finally:
+        r.close()
+
+def _post_cancellable(url: str, payload: Dict[str, Any], cancel: CancelToken) -> Dict[str, Any]:
+    cancel.check()
+    if LLM_STREAM_CANCEL:
+        return _post_streaming(url, payload, cancel)
+    return _post_abortable(url, payload, cancel)
+
+def openai_compat_chat(pool: EndpointPool, messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None,
+                       response_format: Optional[Dict[str, Any]] = None, params: Optional[Dict[str, Any]] = None,
+                       affinity: Optional[str] = None, stats: Optional[List[Dict[str, Any]]] = None,
+                       cancel: Optional[CancelToken] = None) -> Dict[str, Any]:
+    """Chat completion on the least-loaded endpoint of `pool`.
+
+    With a `cancel` token the call can be aborted mid-flight (socket shutdown, or between
+    streamed chunks with LLM_STREAM_CANCEL=1).
+    """
+    # Redoslijed ključeva je fiksan -> system prompt i tools su uvijek bajt-identičan prefiks
     payload = {"model": MODEL_LABEL, "messages": messages, "stream": False}
     if tools: payload["tools"] = tools
     if response_format: payload["response_format"] = response_format
+    if LLM_CACHE_PROMPT:
+        payload["cache_prompt"] = True
+        if LLM_PIN_SLOT and LLM_SLOTS > 0 and affinity:
+            # isti razgovor -> isti slot (hash); dva razgovora na istom slotu čekaju jedan drugog
+            payload["id_slot"] = zlib.crc32(affinity.encode()) % LLM_SLOTS
     if params: payload.update(params)
-    r = requests.post(base_url.rstrip("/") + "/v1/chat/completions", json=payload, timeout=120)
-    if not r.ok:
-        raise RuntimeError(f"LLM HTTP {r.status_code}: {r.text[:200]}")
-    return r.json()
+    tried = []
+    while True:
+        ep = pool.acquire(affinity if LLM_AFFINITY else None, exclude=tried)
+        ok = False
+        try:
+            t0 = time.perf_counter()
+            if cancel is not None:
+                j = _post_cancellable(ep.url + "/v1/chat/completions", payload, cancel)
+                ok = True
+            else:
+                r = requests.post(ep.url + "/v1/chat/completions", json=payload, timeout=LLM_TIMEOUT_S)
+                ok = r.status_code < 500  # 4xx je greška zahtjeva, ne endpointa
+                if not r.ok:
+                    raise RuntimeError(f"LLM HTTP {r.status_code}: {r.text[:200]}")
+                j = r.json()
+            _record_llm_call(stats, llm_call_stats(pool.role, j, (time.perf_counter() - t0) * 1000.0))
+            return j
+        except RequestCancelled:
+            ok = True  # prekid nije kvar endpointa
+            raise
+        except RuntimeError as e:
+            ok = not str(e).startswith("LLM HTTP 5")
+            raise
+        except requests.ConnectionError:
+            # zahtjev nije ni stigao do servera -> probaj sljedeći endpoint
+            tried.append(ep)
+            if len(tried) >= len(pool):
+                raise
+        finally:
+            pool.release(ep, ok)
 
-def _check_openai_server(base_url: str) -> bool:
-    try:
-        r = requests.get(base_url.rstrip("/") + "/v1/models", timeout=3)
-        return bool(r.ok)
-    except Exception:
-        return False
+async def _health_loop():
+    """Periodično proba sve endpointe; /agent/health i routing čitaju cache."""
+    while True:
+        checks = [asyncio.to_thread(pool.check, ep, HEALTH_PROBE_TIMEOUT_S)
+                  for pool in (TEXT_POOL, VISION_POOL) for ep in pool.endpoints]
+        with suppress(Exception):
+            await asyncio.gather(*checks)
+        await asyncio.sleep(HEALTH_INTERVAL_S)
 
 def hr_number_to_float(s: str) -> Optional[float]:
     if s is None: return None
@@ -268,6 +1187,8 @@ TOOLS = [
 
 # ---------- AGENT STATE ----------
 class AgentState(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     file_bytes: bytes
     is_pdf: bool
     page_count: Optional[int] = None
@@ -278,12 +1199,89 @@ class AgentState(BaseModel):
     # Optional multimodal user context
     text_context: Optional[str] = None
     annotations: Optional[Any] = None
+    # Affinity key: drži agent razgovor na istom LLM endpointu
+    session_id: Optional[str] = None
+    # Statistika LLM poziva (prompt tokens, cache, ušteđeno vrijeme)
+    llm_calls: List[Dict[str, Any]] = []
+    max_pages: int = MAX_PAGES_DEF
+    # Procjena prompt tokena zadnjeg LLM poziva (vidi estimate_*)
+    estimate: Optional[Dict[str, Any]] = None
+    # Prekid u tijeku (hedge gubitnik); LLM pozivi ga poštuju
+    cancel: Optional[CancelToken] = None
+    hedge: bool = False
+    hedge_info: Optional[Dict[str, Any]] = None
+    template_info: Optional[Dict[str, Any]] = None
+    dedup_info: Optional[Dict[str, Any]] = None
+    region_mode: bool = False
+    region_info: Optional[Dict[str, Any]] = None
+    split: bool = False
+    bundle_info: Optional[Dict[str, Any]] = None
+    full_document: bool = False
+    page_window: Optional[Dict[str, Any]] = None     # prozor stranica (cijeli dokument) -> napomena u promptu
+    windows_info: Optional[Dict[str, Any]] = None
+    ocr_info: Optional[Dict[str, Any]] = None
+    # RSS, bajtovi stanja i faze (mem_profile); None u pod-stanjima (prozori, bundle, hedge)
+    mem_info: Optional[Dict[str, Any]] = None
+    admission_info: Optional[Dict[str, Any]] = None
+    # /agent/analyze-stream: prima događaje {"event": "token" | "field", ...} dok HF model generira
+    token_sink: Optional[Callable[[Dict[str, Any]], None]] = None
+
+# ---------- OCR ----------
+OCR = None
+if OCR_ENABLED:
+    _ocr_ok, _ocr_reason = ocr_stage.available()
+    if _ocr_ok:
+        OCR = ocr_stage.OcrStage(OCR_CACHE, workers=OCR_WORKERS, lang=OCR_LANG, dpi=OCR_DPI,
+                                 page_timeout_s=OCR_PAGE_TIMEOUT_S)
+    else:
+        print(f"OCR disabled: {_ocr_reason}")
+
+def try_ocr(state: AgentState) -> bool:
+    """OCR the scanned pages; True (state.text set) only if every page is confident enough.
+
+    A single weak page (handwriting, stamp over the table, bad photo) keeps the whole document
+    on the vision path, since the text LLM would not see what OCR missed.
+    """
+    if OCR is None or state.ocr_info is not None or uses_regions(state):
+        return False
+    t0 = time.perf_counter()
+    n = state.page_count or get_page_count(state.file_bytes)
+    n = min(n, VISION_FULL_MAX_PAGES if state.full_document else state.max_pages)
+    try:
+        with mem_stage(state, "ocr"):
+            pages = OCR.ocr_pdf(state.file_bytes, list(range(n)),
+                                cancel_check=state.cancel.check if state.cancel is not None else None)
+    except RequestCancelled:
+        raise
+    except Exception as e:
+        print(f"OCR failed: {e}")
+        state.ocr_info = {"used": False, "error": str(e)[:200]}
+        metric_inc("ocr_failed_total")
+        return False
+    weak = [p.page + 1 for p in pages if p.confidence < OCR_MIN_CONF or len(p.text.strip()) < OCR_MIN_CHARS]
+    used = bool(pages) and not weak
+    state.ocr_info = {"used": used, "pages": [p.info() for p in pages], "weakPages": weak,
+                      "elapsedMs": round((time.perf_counter() - t0) * 1000.0, 1)}
+    metric_inc("ocr_pages_total", len(pages))
+    metric_inc("ocr_text_path_total" if used else "ocr_vision_fallback_total")
+    if used:
+        state.text = "\n\n".join(p.text for p in pages)
+        state.has_text = True
+    return used
 
 # ---------- TOOL IMPLEMENTACIJE ----------
 def tool_probe_pdf(state: AgentState) -> Dict[str, Any]:
+    if state.has_text is not None and state.page_count is not None:
+        # već ispitano (ponovljeni probe u agent petlji, batch CPU pool, OCR tekst); sken iz
+        # batch poola još nije prošao OCR (try_ocr je no-op ako je već pokušan)
+        if not state.has_text:
+            try_ocr(state)
+        return {"page_count": state.page_count, "has_text": state.has_text, "bytes_len": len(state.file_bytes),
+                **({"ocr": True} if state.ocr_info and state.ocr_info.get("used") else {})}
     try:
         # Extract text using pdfminer
-        txt = extract_text(io.BytesIO(state.file_bytes)) or ""
+        with mem_stage(state, "pdf_text"):
+            txt = extract_pdf_text(state.file_bytes, state.cancel) or ""
         has_text = bool(txt.strip())
         
         # Get accurate page count using pypdfium2
@@ -291,33 +1289,62 @@ def tool_probe_pdf(state: AgentState) -> Dict[str, Any]:
         
         # Store text in state for later use
         state.text = txt if has_text else None
+        state.page_count, state.has_text = page_count, has_text
+        # sken bez tekstnog sloja: lokalni OCR, ako je pouzdan agent vidi tekst
+        if not has_text and try_ocr(state):
+            has_text = True
         
         return {
             "page_count": page_count, 
             "has_text": has_text, 
-            "bytes_len": len(state.file_bytes)
+            "bytes_len": len(state.file_bytes),
+            **({"ocr": True} if state.ocr_info and state.ocr_info.get("used") else {}),
         }
+    except RequestCancelled:
+        raise
     except Exception as e:
         print(f"PDF probe failed: {e}")
         return {"page_count": None, "has_text": False, "bytes_len": len(state.file_bytes)}
 
 def tool_extract_pdf_text(state: AgentState) -> Dict[str, Any]:
-    txt = extract_text(io.BytesIO(state.file_bytes)) or ""
+    if state.ocr_info and state.ocr_info.get("used"):
+        return {"chars": len(state.text or ""), "ocr": True}
+    if state.text is not None and state.has_text:
+        # batch: tekst je već izvučen u CPU procesu
+        return {"chars": len(state.text)}
+    with mem_stage(state, "pdf_text"):
+        txt = extract_pdf_text(state.file_bytes, state.cancel) or ""
     state.text = txt
     return {"chars": len(txt)}
 
 def tool_rasterize_pdf_pages(state: AgentState, max_pages=MAX_PAGES_DEF, dpi=144, width=1024) -> Dict[str, Any]:
+    crops = region_images(state)
+    if crops:
+        state.images_dataurls = crops
+        return {"images": crops, "count": len(crops), "regions": True}
+    # Broj stranica i širina se smanjuju ako procjena tokena prelazi CTX_BUDGET_TOKENS
+    base = estimate_text_tokens(SYSTEM_PROMPT + _vision_prompt(state))
+    sizes = get_page_sizes(state.file_bytes, max_pages)
+    pages, width, _ = plan_vision_budget(sizes, max_pages, width, base)
+    # plafon memorije: adaptive renderira do RENDER_MAX_WIDTH pa se procjenjuje s tom širinom
+    est_width = RENDER_MAX_WIDTH if RENDER_MODE == "adaptive" and CTX_BUDGET_TOKENS <= 0 else width
+    mem_pages, mem_width = fit_render_memory(state, sizes, pages, est_width, "rasterize")
+    pages = min(pages, mem_pages)
     # Use pypdfium2 for cross-platform PDF rendering (no Poppler needed)
-    urls = rasterize_pdf_pages_pypdfium2(state.file_bytes, max_pages=max_pages, width=width)
+    with mem_stage(state, "rasterize"):
+        urls = rasterize_pdf_pages_pypdfium2(state.file_bytes, max_pages=pages, width=width, cancel=state.cancel,
+                                             max_width=mem_width if mem_width < est_width else None)
     state.images_dataurls = urls
-    return {"images": urls, "count": len(urls)}
+    return {"images": urls, "count": len(urls), "width": width}
 
-SYSTEM_PROMPT = """You are an extraction agent. Your goal is to return ONLY a strict JSON object for Croatian invoices/quotes with fields:
+EXTRACT_SPEC = """You are an extraction agent. Your goal is to return ONLY a strict JSON object for Croatian invoices/quotes with fields:
 documentType, documentNumber, date, dueDate, currency,
 supplier{name,address,oib,iban}, buyer{name,address,oib,iban},
 items[{position,code,description,quantity,unit,unitPrice,discountPercent,totalPrice}],
 totals{subtotal,vatAmount,totalAmount}.
-Use tools when needed. If you have images, analyze them. If you have text, analyze it.
+"""
+
+SYSTEM_PROMPT = EXTRACT_SPEC + """Use tools when needed. If you have images, analyze them. If you have text, analyze it.
 Always end by calling normalize_and_validate with the full JSON string.
 """
 
@@ -327,21 +1354,109 @@ ANALYZE_TEXT_PROMPT = """Extract the JSON described in the spec from the followi
 ANALYZE_VISION_PROMPT = """Extract the JSON described in the spec from these images; return ONLY JSON:
 """
 
+# Statički prefiks za HF text put; hf_backend drži njegov KV cache. Bez uputa za toolove: HF model ih nema
+HF_TEXT_PREFIX = EXTRACT_SPEC + "\n" + ANALYZE_TEXT_PROMPT
+
+def _analyze_messages(user_content: Any) -> List[Dict[str, Any]]:
+    # system prompt ide prvi i uvijek isti, varijabilni sadržaj tek na kraju
+    return [{"role":"system","content":SYSTEM_PROMPT}, {"role":"user","content": user_content}]
+
+_JSON_DECODER = json.JSONDecoder()
+
+def partial_json_fields(text: str) -> List[tuple]:
+    """Top-level (key, value) pairs of a JSON object that are already complete in streamed text.
+
+    A value counts only when the character after it has arrived, so a number still being
+    generated ("12" of "125") is not reported early.
+    """
+    out: List[tuple] = []
+    i = text.find("{")
+    if i < 0:
+        return out
+    i, n = i + 1, len(text)
+    while True:
+        while i < n and text[i] in " \t\r\n,":
+            i += 1
+        if i >= n or text[i] != '"':
+            return out
+        try:
+            key, i = _JSON_DECODER.raw_decode(text, i)
+            while i < n and text[i] in " \t\r\n":
+                i += 1
+            if i >= n or text[i] != ":":
+                return out
+            i += 1
+            while i < n and text[i] in " \t\r\n":
+                i += 1
+            value, i = _JSON_DECODER.raw_decode(text, i)
+        except ValueError:
+            return out
+        if i >= n:
+            return out
+        out.append((key, value))
+
+def _hf_stream(state: AgentState, role: str, prompt: str, images: Optional[List[str]] = None,
+               prefix: Optional[str] = None, stats: Optional[Dict[str, Any]] = None) -> str:
+    """HF generation piece by piece into state.token_sink (tokens + completed top-level fields)."""
+    parts: List[str] = []
+    sent = 0
+    for piece in hf_backend.stream_generate(prompt, images=images, max_new_tokens=512, temperature=0.2,
+                                            prefix=prefix, stats=stats,
+                                            cancel_check=state.cancel.check if state.cancel is not None else None):
+        parts.append(piece)
+        state.token_sink({"event": "token", "role": role, "text": piece})
+        fields = partial_json_fields("".join(parts))
+        for key, value in fields[sent:]:
+            state.token_sink({"event": "field", "role": role, "key": key, "value": value})
+        sent = len(fields)
+    return "".join(parts)
+
 def tool_text_analyze(state: AgentState, text: str) -> Dict[str, Any]:
+    with mem_stage(state, "text_llm"):
+        return _text_analyze(state, text)
+
+def _text_analyze(state: AgentState, text: str) -> Dict[str, Any]:
+    base = estimate_text_tokens(HF_TEXT_PREFIX if HF_ENABLED else SYSTEM_PROMPT + ANALYZE_TEXT_PROMPT)
+    budget = text_char_budget(base)
+    if budget == 0 and (text or "").strip():
+        # sam prompt ne stane u budžet -> bez poziva s praznim dokumentom
+        metric_inc("context_budget_exceeded_total")
+        return {"error": f"context_budget_exceeded: prompt ~{base} tokens + reserve {CTX_RESERVE_TOKENS} "
+                         f"> CTX_BUDGET_TOKENS {CTX_BUDGET_TOKENS}"}
+    text = (text or "")[:budget]
+    _record_estimate(state, "text", base + estimate_text_tokens(text), 0)
     if HF_ENABLED:
-        prompt = ANALYZE_TEXT_PROMPT + (text or "")[:100000]
-        content = hf_backend.generate_text_only(prompt, max_new_tokens=512, temperature=0.2)
+        prompt = HF_TEXT_PREFIX + text
+        hf_stats: Dict[str, Any] = {}
+        t0 = time.perf_counter()
+        if state.token_sink is not None:
+            content = _hf_stream(state, "text", prompt, prefix=HF_TEXT_PREFIX, stats=hf_stats)
+        else:
+            content = hf_backend.generate_text_only(prompt, max_new_tokens=512, temperature=0.2,
+                                                    prefix=HF_TEXT_PREFIX, stats=hf_stats,
+                                                    cancel_check=state.cancel.check if state.cancel is not None else None)
+        _record_llm_call(state.llm_calls, {
+            "role": "text",
+            "elapsedMs": round((time.perf_counter() - t0) * 1000.0, 1),
+            "promptTokens": hf_stats.get("prompt_tokens"),
+            "cachedPromptTokens": hf_stats.get("cached_prompt_tokens"),
+            "promptEvalMs": None,
+            "promptEvalSavedMs": hf_stats.get("prompt_eval_saved_ms", 0.0),
+            "completionTokens": hf_stats.get("completion_tokens"),
+            "batchSize": hf_stats.get("batch_size"),
+            "queueMs": hf_stats.get("queue_ms"),
+            "stoppedAtJson": hf_stats.get("stopped_at_json"),
+        })
         return {"raw_json": content}
     else:
-        messages = [
-            {"role":"system","content":SYSTEM_PROMPT},
-            {"role":"user","content": ANALYZE_TEXT_PROMPT + text[:100000]} # safety cut
-        ]
-        j = openai_compat_chat(TEXT_LLM_URL, messages, response_format={"type":"json_object"}, params={"temperature":0.2})
+        messages = _analyze_messages(ANALYZE_TEXT_PROMPT + text)
+        j = openai_compat_chat(TEXT_POOL, messages, response_format={"type":"json_object"}, params={"temperature":0.2},
+                               affinity=state.session_id, stats=state.llm_calls,
+                               cancel=state.cancel)
         content = j.get("choices",[{}])[0].get("message",{}).get("content","")
         return {"raw_json": content}
 
-def tool_vision_analyze_images(state: AgentState, images: List[str]) -> Dict[str, Any]:
+def _vision_prompt(state: AgentState) -> str:
     # Build augmented prompt with optional context/annotations
     prompt = ANALYZE_VISION_PROMPT
     if state.text_context:
@@ -352,15 +1467,54 @@ def tool_vision_analyze_images(state: AgentState, images: List[str]) -> Dict[str
         except Exception:
             ann = str(state.annotations)
         prompt += "\n\nAnnotations (JSON):\n" + ann[:4000]
+    if state.region_info:
+        prompt += ("\n\nThe images are crops of the annotated regions"
+                   + (" (the first image of each page is a low-resolution overview)" if state.region_info.get("overview") else "")
+                   + "; read the small print in the crops.")
+    if state.page_window:
+        pages = state.page_window["pages"]
+        prompt += (f"\n\nThese images are pages {pages[0]}-{pages[-1]} of a {state.page_window['of']}-page document. "
+                   "Extract only what is visible on these pages: items in page order (a row cut at the page edge as it "
+                   "appears); header fields and totals only if shown here, otherwise null.")
+    return prompt
+
+def tool_vision_analyze_images(state: AgentState, images: List[str]) -> Dict[str, Any]:
+    with mem_stage(state, "vision_llm"):
+        return _vision_analyze_images(state, images)
+
+def _vision_analyze_images(state: AgentState, images: List[str]) -> Dict[str, Any]:
+    prompt = _vision_prompt(state)
+    dims = [_dataurl_dims(u) for u in images or []]
+    _record_estimate(state, "vision", estimate_text_tokens(SYSTEM_PROMPT + prompt),
+                     sum(estimate_image_tokens(w, h) for w, h in dims),
+                     pages=len(dims), width=max((w for w, _ in dims), default=None))
 
     if HF_ENABLED:
-        content = hf_backend.generate_multimodal(prompt, images or [], max_new_tokens=512, temperature=0.2)
+        hf_stats = {}
+        t0 = time.perf_counter()
+        if state.token_sink is not None:
+            content = _hf_stream(state, "vision", prompt, images=images or [], stats=hf_stats)
+        else:
+            content = hf_backend.generate_multimodal(prompt, images or [], max_new_tokens=512, temperature=0.2,
+                                                     stats=hf_stats,
+                                                     cancel_check=state.cancel.check if state.cancel is not None else None)
+        _record_llm_call(state.llm_calls, {
+            "role": "vision",
+            "elapsedMs": round((time.perf_counter() - t0) * 1000.0, 1),
+            "promptTokens": hf_stats.get("prompt_tokens"),
+            "completionTokens": hf_stats.get("completion_tokens"),
+            "queueMs": hf_stats.get("queue_ms"),
+            "stoppedAtJson": hf_stats.get("stopped_at_json"),
+            "imageCacheHits": hf_stats.get("image_cache_hits"),
+        })
         return {"raw_json": content}
     else:
         user_content = [{"type":"text","text": prompt}]
         user_content += [{"type":"image_url","image_url":{"url":u}} for u in images]
-        messages = [{"role":"system","content":SYSTEM_PROMPT}, {"role":"user","content": user_content}]
-        j = openai_compat_chat(VISION_LLM_URL, messages, response_format={"type":"json_object"}, params={"temperature":0.2})
+        messages = _analyze_messages(user_content)
+        j = openai_compat_chat(VISION_POOL, messages, response_format={"type":"json_object"}, params={"temperature":0.2},
+                               affinity=state.session_id, stats=state.llm_calls,
+                               cancel=state.cancel)
         content = j.get("choices",[{}])[0].get("message",{}).get("content","")
         return {"raw_json": content}
 
@@ -380,18 +1534,19 @@ def normalize_result(d: Dict[str, Any]) -> Dict[str, Any]:
                 d["totals"][k] = hr_number_to_float(v)
     return d
 
-def tool_normalize_and_validate(state: AgentState, raw_json: str) -> Dict[str, Any]:
+def parse_llm_json(raw_json: str) -> Dict[str, Any]:
     try:
-        candidate = json.loads(raw_json)
+        return json.loads(raw_json)
     except:
         # naive repair: uzmi prvi {…}
         start = raw_json.find("{")
         end   = raw_json.rfind("}")
         if start>=0 and end>start:
-            candidate = json.loads(raw_json[start:end+1])
-        else:
-            raise
-    candidate = normalize_result(candidate)
+            return json.loads(raw_json[start:end+1])
+        raise
+
+def tool_normalize_and_validate(state: AgentState, raw_json: str) -> Dict[str, Any]:
+    candidate = normalize_result(parse_llm_json(raw_json))
     try:
         Draft202012Validator(RESULT_SCHEMA).validate(candidate)
         state.result_json = candidate
@@ -400,6 +1555,47 @@ def tool_normalize_and_validate(state: AgentState, raw_json: str) -> Dict[str, A
         # Minimal repair hook: ukloni null-ove koji krše required itd.
         return {"ok": False, "error": str(e)[:200], "partial": candidate}
 
+# ---------- PREDLOŠCI DOBAVLJAČA ----------
+TEMPLATES = (TemplateStore(TEMPLATE_STORE, hr_number_to_float, parse_hr_date, learn_min=TEMPLATE_LEARN_MIN,
+                           spot_check_every=TEMPLATE_SPOT_CHECK_EVERY) if TEMPLATES_ENABLED else None)
+
+def items_match_totals(d: Dict[str, Any]) -> bool:
+    """Sum of item totals equals subtotal or totalAmount (0.5 % / 5 cent tolerance)."""
+    items = d.get("items") or []
+    if not items:
+        return False
+    try:
+        s = sum(float(i.get("totalPrice") or 0) for i in items)
+    except (TypeError, ValueError):
+        return False
+    for k in ("subtotal", "totalAmount"):
+        v = (d.get("totals") or {}).get(k)
+        if isinstance(v, (int, float)) and abs(s - v) <= max(0.05, 0.005 * abs(v)):
+            return True
+    return False
+
+def results_agree(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    ta, tb = (a.get("totals") or {}).get("totalAmount"), (b.get("totals") or {}).get("totalAmount")
+    return (str(a.get("documentNumber") or "").strip() == str(b.get("documentNumber") or "").strip()
+            and isinstance(ta, (int, float)) and isinstance(tb, (int, float)) and abs(ta - tb) < 0.01
+            and len(a.get("items") or []) == len(b.get("items") or []))
+
+def try_template(state: AgentState) -> Optional[str]:
+    """Rule-based extraction through a learned supplier template; returns the supplier OIB on success."""
+    m = TEMPLATES.match(state.file_bytes)
+    if m is None:
+        return None
+    res = tool_normalize_and_validate(state, json.dumps(TEMPLATES.extract(m), ensure_ascii=False))
+    if not res.get("ok") or not items_match_totals(state.result_json or {}):
+        state.result_json = None
+        metric_inc("template_rejected_total")
+        return None
+    return m.oib
+
+# ---------- DUPLIKATI ----------
+DEDUP = (DedupIndex(DEDUP_INDEX, hr_number_to_float, text_threshold=DEDUP_TEXT_THRESHOLD,
+                    image_only_distance=DEDUP_IMAGE_ONLY_DIST) if DEDUP_ENABLED else None)
+
 # ---------- TOOL REGISTAR ----------
 def call_tool(name: str, args: Dict[str, Any], state: AgentState) -> Dict[str, Any]:
     if name=="probe_pdf":                  return tool_probe_pdf(state)
@@ -417,8 +1613,11 @@ def run_agent_with_tools(state: AgentState) -> Dict[str, Any]:
         {"role":"system","content": SYSTEM_PROMPT},
         {"role":"user","content": "You will be given a PDF or image via tools. Decide the best path: probe_pdf -> (extract_pdf_text->text_analyze) OR (rasterize_pdf_pages->vision_analyze_images). Finish with normalize_and_validate."}
     ]
+    if state.session_id is None:
+        state.session_id = uuid.uuid4().hex
     # šaljemo "tools" i čekamo tool_calls
-    j = openai_compat_chat(TEXT_LLM_URL, messages, tools=TOOLS, params={"temperature":0})
+    j = openai_compat_chat(TEXT_POOL, messages, tools=TOOLS, params={"temperature":0}, affinity=state.session_id,
+                           stats=state.llm_calls, cancel=state.cancel)
     choice = j.get("choices",[{}])[0]
     msg = choice.get("message",{})
     # petlja dok ima tool_calls
@@ -428,6 +1627,8 @@ def run_agent_with_tools(state: AgentState) -> Dict[str, Any]:
         if not tool_calls:
             break
         for tc in tool_calls:
+            if state.cancel is not None:
+                state.cancel.check()
             nm = tc["function"]["name"]
             args = {}
             try:
@@ -453,42 +1654,795 @@ def run_agent_with_tools(state: AgentState) -> Dict[str, Any]:
                 res = {"error":"unknown tool"}
             tool_msgs.append({"role":"tool","name":nm,"content": json.dumps(res)})
         messages = messages + [msg] + tool_msgs
-        j = openai_compat_chat(TEXT_LLM_URL, messages, tools=TOOLS, params={"temperature":0})
+        j = openai_compat_chat(TEXT_POOL, messages, tools=TOOLS, params={"temperature":0}, affinity=state.session_id,
+                               stats=state.llm_calls, cancel=state.cancel)
         msg = j.get("choices",[{}])[0].get("message",{})
         tool_msgs = []
 
+    TEXT_POOL.forget(state.session_id)
+    VISION_POOL.forget(state.session_id)
     return state.result_json or {"error":"no result"}
 
+# ---------- PUTEVI (text / vision) ----------
+_PATH_LATENCY: Dict[str, deque] = {"text": deque(maxlen=500), "vision": deque(maxlen=500)}
+
+def _timed_path(path: str, fn: Callable[[AgentState], None], state: AgentState) -> None:
+    t0 = time.perf_counter()
+    fn(state)
+    if state.result_json is not None:
+        _PATH_LATENCY[path].append(time.perf_counter() - t0)
+
+def _run_text_path(state: AgentState) -> None:
+    _ = tool_extract_pdf_text(state)
+    raw = tool_text_analyze(state, state.text)
+    if raw.get("error"):
+        raise RuntimeError(raw["error"])
+    _ = tool_normalize_and_validate(state, raw.get("raw_json", "{}"))
+
+def _run_vision_path(state: AgentState) -> None:
+    _ = tool_rasterize_pdf_pages(state, max_pages=state.max_pages, width=1024)
+    raw = tool_vision_analyze_images(state, state.images_dataurls or [])
+    _ = tool_normalize_and_validate(state, raw.get("raw_json", "{}"))
+
+def has_weak_text_layer(state: AgentState) -> bool:
+    """Text layer exists but is too thin to trust (scan with OCR stubs, headers only...)."""
+    chars = len((state.text or "").strip())
+    return 0 < chars < HEDGE_WEAK_TEXT_CHARS * max(1, state.page_count or 1)
+
+def hedge_delay_s(path: str) -> float:
+    """Delay before the second path starts: HEDGE_DELAY_S or a latency percentile of `path`."""
+    if HEDGE_DELAY_S >= 0:
+        return HEDGE_DELAY_S
+    lat = sorted(_PATH_LATENCY[path])
+    if len(lat) < HEDGE_MIN_SAMPLES:
+        return 0.0
+    return lat[min(len(lat) - 1, int(HEDGE_PERCENTILE * len(lat)))]
+
+def run_hedged(state: AgentState) -> Dict[str, Any]:
+    """Run text and vision paths concurrently; the first validated result wins, the other is cancelled."""
+    runners = {"text": _run_text_path, "vision": _run_vision_path}
+    branches: Dict[Any, tuple] = {}
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hedge")
+
+    def launch(path: str):
+        br = state.model_copy(update={"cancel": CancelToken(parent=state.cancel), "llm_calls": [], "mem_info": None,
+                                      "images_dataurls": None, "result_json": None})
+        fut = executor.submit(_timed_path, path, runners[path], br)
+        branches[fut] = (path, br)
+        return fut
+
+    winner, errors = None, []
+
+    def collect(done) -> None:
+        nonlocal winner
+        for f in done:
+            path, br = branches[f]
+            if f.exception() is not None:
+                errors.append(f"{path}: {str(f.exception())[:100]}")
+            elif br.result_json is not None and winner is None:
+                winner = (path, br)
+
+    delay = hedge_delay_s("text")
+    launch("text")
+    pending = set(branches)
+    if delay > 0:
+        # drugi put kreće tek ako prvi nije gotov (ili nije prošao validaciju) unutar percentila
+        done, pending = wait(pending, timeout=delay)
+        collect(done)
+    if winner is None:
+        pending.add(launch("vision"))
+    while winner is None and pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        collect(done)
+    for path, br in branches.values():
+        if winner is None or br is not winner[1]:
+            br.cancel.cancel("hedge_lost")
+    # prekid zatvara socket / izbacuje HF zahtjev, pa gubitnik brzo završi: pozivi se spajaju ovdje,
+    # prije _meta; grana koja ne stigne ostaje bez poziva u odgovoru (samo u /agent/metrics)
+    finished, _ = wait(list(branches), timeout=HEDGE_LOSER_WAIT_S)
+    executor.shutdown(wait=False)
+    dropped = [path for f, (path, _) in branches.items() if f not in finished]
+    for f, (_, br) in branches.items():
+        if f in finished:
+            state.llm_calls.extend(br.llm_calls)
+    state.hedge_info = {"delayS": round(delay, 3), "launched": [p for p, _ in branches.values()],
+                        "winner": winner[0] if winner else None, "errors": errors}
+    if winner is not None and len(branches) > 1:
+        state.hedge_info.update(hedgeLoser=next(p for p, br in branches.values() if br is not winner[1]),
+                                callsDropped=bool(dropped))
+    if winner is None and state.cancel is not None:
+        state.cancel.check()  # oba puta prekinuta zbog roka/odlaska klijenta
+    if winner is None:
+        return {"error": "hedged_pipeline_failed: " + "; ".join(errors)[:200]}
+    state.result_json = winner[1].result_json
+    state.images_dataurls = winner[1].images_dataurls
+    state.estimate = winner[1].estimate
+    return state.result_json
+
+WINDOW_CACHE = WindowCache(VISION_WINDOW_CACHE)
+
+def run_vision_windows(state: AgentState) -> Dict[str, Any]:
+    """Every page of a scanned PDF through the VLM: page windows run concurrently, results merged.
+
+    Windows are rendered one after another in this thread (pdfium) and sent to the vision pool
+    as soon as they are ready. Window results are cached, so a re-run that covers more pages (or
+    retries after a failed window) only sends the missing windows.
+    """
+    t0 = time.perf_counter()
+    sizes = get_page_sizes(state.file_bytes, VISION_FULL_MAX_PAGES)
+    requested_width = RENDER_MAX_WIDTH if RENDER_MODE == "adaptive" else 1024
+    # u memoriji su najviše (workers + 1) prozora slika: plafon smanjuje širinu, zatim broj prozora u letu
+    in_flight = min(len(sizes), (max(1, VISION_WINDOW_WORKERS) + 1) * max(1, VISION_WINDOW_PAGES))
+    mem_pages, width = fit_render_memory(state, sizes, in_flight, requested_width, "vision_windows")
+    max_in_flight = max(1, mem_pages // max(1, VISION_WINDOW_PAGES))
+    budget = VISION_WINDOW_TOKENS
+    if budget <= 0 and CTX_BUDGET_TOKENS > 0:
+        budget = CTX_BUDGET_TOKENS - CTX_RESERVE_TOKENS - estimate_text_tokens(SYSTEM_PROMPT + _vision_prompt(state)) - 80
+    windows = plan_windows([estimate_image_tokens(*_rendered_dims(sz, width)) for sz in sizes],
+                           max(1, VISION_WINDOW_PAGES), budget)
+    # ključ po traženoj širini: širina smanjena zbog memorije ovisi o opterećenju, ne o dokumentu
+    doc_key = (hashlib.sha256(state.file_bytes).hexdigest(), requested_width, RENDER_MODE, MODEL_LABEL,
+               zlib.crc32(_vision_prompt(state).encode("utf-8")))
+
+    def one(pages: List[int], images: List[str]) -> tuple:
+        sub = AgentState(file_bytes=state.file_bytes, is_pdf=True, text_context=state.text_context,
+                         annotations=state.annotations, page_window={"pages": [p + 1 for p in pages], "of": len(sizes)},
+                         cancel=CancelToken(parent=state.cancel) if state.cancel is not None else None)
+        w0 = time.perf_counter()
+        try:
+            raw = tool_vision_analyze_images(sub, images)
+            res = normalize_result(parse_llm_json(raw.get("raw_json", "{}")))
+            if not isinstance(res, dict):
+                raise ValueError("window result is not a JSON object")
+            WINDOW_CACHE.put(doc_key + (tuple(pages),), res)
+            return sub, res, None, (time.perf_counter() - w0) * 1000.0
+        except Exception as e:
+            return sub, None, e, (time.perf_counter() - w0) * 1000.0
+        finally:
+            slots.release()
+
+    workers = max(1, min(VISION_WINDOW_WORKERS, len(windows), max_in_flight))
+    slots = threading.BoundedSemaphore(max(1, min(workers + 1, max_in_flight)))
+    futures: List[Any] = []
+    cached: Dict[int, Dict[str, Any]] = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="vwin") as ex:
+        for k, pages in enumerate(windows):
+            hit = WINDOW_CACHE.get(doc_key + (tuple(pages),))
+            if hit is not None:
+                cached[k] = hit
+                futures.append(None)
+                continue
+            # renderiraj sljedeći prozor tek kad se oslobodi mjesto (slike čekaju VLM u memoriji)
+            while not slots.acquire(timeout=0.5):
+                if state.cancel is not None:
+                    state.cancel.check()
+            try:
+                if state.cancel is not None:
+                    state.cancel.check()
+                images = rasterize_pdf_pages_pypdfium2(state.file_bytes, width=width, cancel=state.cancel, pages=pages,
+                                                       max_width=width)
+            except BaseException:
+                slots.release()
+                raise
+            futures.append(ex.submit(one, pages, images))
+        outcomes = [f.result() if f is not None else None for f in futures]
+    if state.cancel is not None:
+        state.cancel.check()
+
+    results, info, errors = [], [], []
+    for k, (pages, out) in enumerate(zip(windows, outcomes)):
+        entry = {"pages": [p + 1 for p in pages], "cached": out is None}
+        if out is None:
+            results.append(cached[k])
+        else:
+            sub, res, err, ms = out
+            state.llm_calls.extend(sub.llm_calls)
+            entry["elapsedMs"] = round(ms, 1)
+            if err is not None:
+                if isinstance(err, (NoHealthyEndpoint, RequestCancelled)):
+                    raise err
+                errors.append(f"pages {pages[0] + 1}-{pages[-1] + 1}: {str(err)[:100]}")
+                entry["error"] = str(err)[:100]
+            results.append(res)
+        info.append(entry)
+    state.windows_info = {"pages": len(sizes), "windows": info, "workers": workers,
+                          "elapsedMs": round((time.perf_counter() - t0) * 1000.0, 1)}
+    metric_inc("vision_window_requests_total")
+    metric_inc("vision_windows_total", len(windows))
+    metric_inc("vision_windows_cached_total", len(cached))
+    if errors:
+        # uspjeli prozori su u cacheu -> ponovni pokušaj šalje samo neuspjele
+        return {"error": "vision_window_failed: " + "; ".join(errors)[:300]}
+    merged, joined = merge_windows(results)
+    state.windows_info["joinedItems"] = joined
+    try:
+        Draft202012Validator(RESULT_SCHEMA).validate(merged)
+    except ValidationError as e:
+        return {"error": f"vision_windows_invalid: {str(e)[:200]}"}
+    state.result_json = merged
+    return merged
+
+def run_bundle(state: AgentState, segments: List[Any], total_pages: Optional[int] = None) -> Dict[str, Any]:
+    """Process the documents of a bundle PDF concurrently; returns {"documents": [...]}.
+
+    Only the first BUNDLE_MAX_PAGES pages are split; bundle_info reports pages seen vs. total.
+    """
+    t0 = time.perf_counter()
+
+    def one(seg) -> tuple:
+        sub = AgentState(file_bytes=extract_pages(state.file_bytes, seg.pages), is_pdf=True,
+                         max_pages=state.max_pages, hedge=state.hedge, full_document=state.full_document,
+                         text_context=state.text_context,
+                         cancel=CancelToken(parent=state.cancel) if state.cancel is not None else None)
+        try:
+            return sub, run_agent(sub), None
+        except Exception as e:
+            return sub, {"error": str(e)[:300]}, e
+
+    workers = max(1, min(BUNDLE_WORKERS, len(segments)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bundle") as ex:
+        outcomes = list(ex.map(one, segments))
+    if state.cancel is not None:
+        state.cancel.check()
+    if all(isinstance(err, NoHealthyEndpoint) for _, _, err in outcomes):
+        raise outcomes[0][2]
+    docs = []
+    for seg, (sub, result, _) in zip(segments, outcomes):
+        state.llm_calls.extend(sub.llm_calls)
+        info = seg.info()
+        docs.append({"pages": info["pages"], "boundary": info["boundary"], "result": result,
+                     "_meta": request_meta(sub)})
+    metric_inc("bundle_requests_total")
+    metric_inc("bundle_documents_total", len(docs))
+    seen = sum(len(seg.pages) for seg in segments)
+    total = max(total_pages or 0, seen)
+    state.bundle_info = {"documents": len(docs), "workers": workers, "pagesSeen": seen, "pagesTotal": total,
+                         "truncated": total > seen,
+                         "elapsedMs": round((time.perf_counter() - t0) * 1000.0, 1)}
+    if total > seen:
+        metric_inc("bundle_truncated_total")
+    return {"documents": docs}
+
+def run_request(state: AgentState) -> Dict[str, Any]:
+    """API entry: bundle split (if requested and the PDF holds several documents), else run_agent."""
+    if state.split and state.is_pdf:
+        try:
+            segments = split_bundle(state.file_bytes, max_pages=BUNDLE_MAX_PAGES)
+        except Exception as e:
+            print(f"Bundle split failed: {e}")
+            segments = []
+        if len(segments) > 1:
+            return run_bundle(state, segments, total_pages=get_page_count(state.file_bytes))
+    return run_agent(state)
+
 def run_agent(state: AgentState) -> Dict[str, Any]:
+    """Entry: near-duplicate lookup (if enabled), then templates / LLM pipeline.
+
+    A validated result is added to the duplicate index, so a later re-scan or re-export of the
+    same document returns it without any LLM call.
+    """
+    if DEDUP is None or uses_regions(state):
+        return run_with_templates(state)
+    try:
+        fp = DEDUP.fingerprint(state.file_bytes, state.is_pdf)
+        hit = DEDUP.lookup(fp)
+    except Exception as e:
+        print(f"Dedup lookup failed: {e}")
+        return run_with_templates(state)
+    if hit is not None:
+        state.result_json = hit.result
+        state.dedup_info = hit.info()
+        metric_inc("dedup_hits_total")
+        metric_inc(f"dedup_{hit.kind}_hits_total")
+        return hit.result
+    result = run_with_templates(state)
+    if state.result_json is not None:
+        try:
+            DEDUP.add(fp, state.result_json)
+        except Exception as e:
+            print(f"Dedup add failed: {e}")
+    return result
+
+def run_with_templates(state: AgentState) -> Dict[str, Any]:
+    """Supplier template fast path (if enabled), else the LLM pipeline.
+
+    Template hits skip the LLM except for every TEMPLATE_SPOT_CHECK_EVERY-th one, which is
+    compared with the LLM result; validated LLM results on PDFs feed template learning.
+    """
+    if TEMPLATES is None or not state.is_pdf or uses_regions(state):
+        return run_llm_pipeline(state)
+    oib = try_template(state)
+    if oib is not None:
+        tpl_result = state.result_json
+        if not TEMPLATES.record_hit(oib):
+            state.template_info = {"supplierOib": oib, "spotCheck": False}
+            metric_inc("template_hits_total")
+            return tpl_result
+        state.result_json = None
+        result = run_llm_pipeline(state)
+        if state.result_json is None:
+            # LLM nije dao valjan rezultat -> provjera ne vrijedi, vrati predložak
+            state.result_json = tpl_result
+            state.template_info = {"supplierOib": oib, "spotCheck": False}
+            return tpl_result
+        agreed = results_agree(tpl_result, state.result_json)
+        TEMPLATES.report_spot_check(oib, agreed)
+        state.template_info = {"supplierOib": oib, "spotCheck": True, "agreed": agreed}
+        metric_inc("template_spot_checks_total")
+        if not agreed:
+            metric_inc("template_spot_check_failures_total")
+    else:
+        result = run_llm_pipeline(state)
+    if state.result_json is not None:
+        try:
+            TEMPLATES.observe(state.file_bytes, state.result_json)
+        except Exception as e:
+            print(f"Template observe failed: {e}")
+    return result
+
+def run_llm_pipeline(state: AgentState) -> Dict[str, Any]:
     """Entry that selects pipeline based on AGENT_POLICY and backend.
     - rule_based: deterministic path using local tools + HF backend if enabled
     - llm_tools: original tool-calling via OpenAI-compatible server
+    - hedge (opt-in): PDF with a weak text layer runs text and vision paths concurrently
+    - full_document (opt-in): PDF without a text layer goes through the VLM in page windows
     """
+    # has_text=False (batch CPU pool) još treba probe: tek on pokušava OCR prije vision puta
+    if state.full_document and state.is_pdf and not uses_regions(state):
+        if not state.has_text:
+            _ = tool_probe_pdf(state)
+        if not (state.text and state.text.strip()):
+            return run_vision_windows(state)
+    if state.hedge and state.is_pdf:
+        _ = tool_probe_pdf(state)
+        if has_weak_text_layer(state):
+            return run_hedged(state)
     if AGENT_POLICY == "rule_based":
         try:
             if state.is_pdf:
-                _ = tool_probe_pdf(state)
+                if not state.has_text:
+                    _ = tool_probe_pdf(state)
                 if state.text and state.text.strip():
-                    _ = tool_extract_pdf_text(state)
-                    raw = tool_text_analyze(state, state.text)
-                    _ = tool_normalize_and_validate(state, raw.get("raw_json", "{}"))
+                    _timed_path("text", _run_text_path, state)
                 else:
-                    _ = tool_rasterize_pdf_pages(state, max_pages=MAX_PAGES_DEF, width=1024)
-                    raw = tool_vision_analyze_images(state, state.images_dataurls or [])
-                    _ = tool_normalize_and_validate(state, raw.get("raw_json", "{}"))
+                    _timed_path("vision", _run_vision_path, state)
             else:
                 if not state.images_dataurls:
-                    state.images_dataurls = [data_url(state.file_bytes)]
+                    state.images_dataurls = [prepare_upload_image(state.file_bytes)]
                 raw = tool_vision_analyze_images(state, state.images_dataurls)
                 _ = tool_normalize_and_validate(state, raw.get("raw_json", "{}"))
             return state.result_json or {"error":"no result"}
+        except (NoHealthyEndpoint, RequestCancelled):
+            raise
         except Exception as e:
             return {"error": f"rule_based_pipeline_failed: {str(e)[:200]}"}
     # fallback to original behavior
     return run_agent_with_tools(state)
 
+def request_meta(state: AgentState) -> Dict[str, Any]:
+    """Per-request profil koji se vraća uz rezultat (ključ `_meta`)."""
+    return {
+        "estimate": state.estimate,
+        "hedge": state.hedge_info,
+        "template": state.template_info,
+        "dedup": state.dedup_info,
+        "regions": state.region_info,
+        "bundle": state.bundle_info,
+        "windows": state.windows_info,
+        "ocr": state.ocr_info,
+        "memory": state.mem_info,
+        "admission": state.admission_info,
+        "llmCalls": state.llm_calls,
+        "promptEvalSavedMs": round(sum(c.get("promptEvalSavedMs") or 0 for c in state.llm_calls), 1),
+    }
+
+def new_state(file_bytes: bytes, is_pdf: bool, params: Dict[str, Any],
+              cancel: Optional[CancelToken] = None) -> AgentState:
+    """AgentState from the analyze form fields (shared by /agent/analyze-file and queued jobs)."""
+    max_pages = params.get("max_pages")
+    hedge, region_mode, split = params.get("hedge"), params.get("region_mode"), params.get("split")
+    full_document = params.get("full_document")
+    state = AgentState(file_bytes=file_bytes, is_pdf=is_pdf, max_pages=max(1, min(int(max_pages or MAX_PAGES_DEF), 10)),
+                       mem_info={},
+                       hedge=HEDGE_MODE if hedge is None else hedge,
+                       region_mode=REGION_MODE if region_mode is None else region_mode,
+                       split=BUNDLE_SPLIT if split is None else split,
+                       full_document=VISION_FULL_DOC if full_document is None else full_document,
+                       cancel=cancel)
+    # Attach optional multimodal context
+    if params.get("text_context"):
+        state.text_context = params["text_context"]
+    annotations = params.get("annotations")
+    if annotations:
+        try:
+            state.annotations = json.loads(annotations)
+        except Exception:
+            state.annotations = annotations
+    return state
+
+def process_state(state: AgentState) -> Dict[str, Any]:
+    """Blocking analysis of a prepared state: image upload prep, run_request, `_meta`."""
+    rss0 = mem_profile.process_rss()
+    if state.mem_info is not None:
+        state.mem_info.update(rssBeforeBytes=rss0,
+                              ceilingBytes=int(MEM_REQUEST_CEILING_MB * 1024 * 1024) or None)
+    try:
+        # hint: ako je slika, odmah pripremi images_dataurls; agent će pozvati vision tool
+        if not state.is_pdf:
+            with mem_stage(state, "image_prep"):
+                state.images_dataurls = region_images(state) or [prepare_upload_image(state.file_bytes)]
+        result = run_request(state)
+    finally:
+        record_memory(state, rss0)
+    if isinstance(result, dict):
+        result["_meta"] = request_meta(state)
+    return result
+
+def record_memory(state: AgentState, rss0: Optional[int]) -> None:
+    """RSS after the request, bytes held by the state, per-stage peaks -> mem_info and metrics."""
+    rss1 = mem_profile.process_rss()
+    held = mem_profile.state_bytes(state.file_bytes, state.text, state.images_dataurls)
+    if state.mem_info is not None:
+        state.mem_info.update(rssAfterBytes=rss1, stateBytes=held,
+                              rssDeltaBytes=(rss1 - rss0) if rss0 is not None and rss1 is not None else None)
+        for name, st in (state.mem_info.get("stages") or {}).items():
+            if st.get("peakBytes") is not None:
+                metric_max(f"mem_stage_{name}_peak_bytes_max", st["peakBytes"])
+            elif st.get("peakSkipped"):
+                metric_inc(f"mem_stage_{name}_peak_skipped_total")
+            if st.get("rssDeltaBytes") is not None:
+                metric_max(f"mem_stage_{name}_rss_delta_bytes_max", st["rssDeltaBytes"])
+    if rss1 is not None:
+        metric_max("mem_rss_bytes_max", rss1)
+    metric_max("mem_state_bytes_max", held["total"])
+    metric_inc("mem_state_bytes_total", held["total"])
+    metric_inc("mem_requests_total")
+
+# ---------- POSLOVI (JOB QUEUE) ----------
+JOBS = (JobQueue(JOB_DB, max_attempts=JOB_MAX_ATTEMPTS, backoff_s=JOB_RETRY_BACKOFF_S)
+        if JOBS_ENABLED else None)
+
+def callback_allowed(url: str) -> bool:
+    """http(s) URL whose host (or host:port) is on JOB_CALLBACK_ALLOW; "*.domain" covers subdomains."""
+    try:
+        u = urllib.parse.urlsplit(url)
+        host, port = (u.hostname or "").lower(), u.port
+    except ValueError:
+        return False
+    if u.scheme not in ("http", "https") or not host or u.username or u.password:
+        return False
+    for rule in JOB_CALLBACK_ALLOW:
+        name, _, rport = rule.partition(":")
+        if rport and str(port or (443 if u.scheme == "https" else 80)) != rport:
+            continue
+        if host == name or (name.startswith("*.") and host.endswith(name[1:])):
+            return True
+    return False
+
+def _send_callback(job_id: str, url: str, attempts: int = 3) -> None:
+    """POST the final job status to the client's callback URL (best effort, short retries)."""
+    if not callback_allowed(url):     # lista se mogla promijeniti od predaje posla
+        metric_inc("job_callbacks_rejected_total")
+        JOBS.set_callback_status(job_id, "rejected: host not in JOB_CALLBACK_ALLOW")
+        return
+    body = JOBS.get(job_id)
+    status = "not_sent"
+    for i in range(attempts):
+        try:
+            # bez preusmjeravanja: 3xx ne smije odvesti tijelo posla na host izvan liste
+            r = requests.post(url, json=body, timeout=JOB_CALLBACK_TIMEOUT_S, allow_redirects=False)
+            status = f"http_{r.status_code}"
+            if r.status_code < 500:
+                break
+        except Exception as e:
+            status = f"error: {str(e)[:150]}"
+        if i + 1 < attempts:
+            time.sleep(2 ** i)
+    metric_inc("job_callbacks_ok_total" if status.startswith("http_2") else "job_callbacks_failed_total")
+    JOBS.set_callback_status(job_id, status)
+
+def run_job(job: Any, worker_id: str, stop: threading.Event) -> str:
+    """Process one leased job; returns its new status (done | queued | failed | released).
+
+    A heartbeat thread renews the lease every JOB_VISIBILITY_S / 3; if the lease is lost (another
+    worker took the job after an expiry) or the worker is stopping, the analysis is cancelled.
+    """
+    token = request_token(job.params.get("deadline_s"), ceiling_s=JOB_DEADLINE_S)
+    done = threading.Event()
+
+    def heartbeat():
+        last = time.monotonic()
+        while not done.wait(min(1.0, JOB_VISIBILITY_S / 3.0)):
+            if stop.is_set():
+                token.cancel("shutdown")
+                return
+            if time.monotonic() - last < JOB_VISIBILITY_S / 3.0:
+                continue
+            last = time.monotonic()
+            try:
+                if not JOBS.heartbeat(job.id, worker_id, JOB_VISIBILITY_S):
+                    token.cancel("lease_lost")
+                    return
+            except Exception as e:
+                print(f"Job heartbeat failed: {e}")
+
+    threading.Thread(target=heartbeat, name=f"{worker_id}-hb", daemon=True).start()
+    t0 = time.perf_counter()
+    try:
+        is_pdf = job.content_type == "application/pdf" or (job.filename or "").lower().endswith(".pdf")
+        state = new_state(job.file_bytes, is_pdf, job.params, cancel=token)
+        result = process_state(state)
+        error = result.get("error") if isinstance(result, dict) else "no result"
+    except RequestCancelled as e:
+        result, error = None, f"cancelled: {e}"
+    except Exception as e:
+        result, error = None, str(e)[:300] or type(e).__name__
+    finally:
+        done.set()
+    metric_inc("job_seconds_total", time.perf_counter() - t0)
+    if token.reason in ("shutdown", "lease_lost"):
+        if token.reason == "shutdown":
+            JOBS.release(job.id, worker_id)
+        metric_inc(f"jobs_{token.reason}_total")
+        return "released"
+    if error is None:
+        status = "done" if JOBS.complete(job.id, worker_id, result) else "released"
+    else:
+        status = JOBS.fail(job.id, worker_id, str(error)) or "released"
+    metric_inc(f"jobs_{status}_total")     # callback šalje _callback_loop, ne ova nit
+    return status
+
+_RUNNING_JOBS: Dict[str, str] = {}     # worker -> job id (za nodes tablicu)
+_JOB_PURGE = {"next": 0.0}
+_JOB_PURGE_LOCK = threading.Lock()
+
+def _maybe_purge_jobs() -> None:
+    """Delete finished jobs older than JOB_RETENTION_S; at most once a minute per process."""
+    if JOB_RETENTION_S <= 0:
+        return
+    with _JOB_PURGE_LOCK:
+        if time.monotonic() < _JOB_PURGE["next"]:
+            return
+        _JOB_PURGE["next"] = time.monotonic() + 60.0
+    n = JOBS.purge(JOB_RETENTION_S)
+    if n:
+        metric_inc("jobs_purged_total", n)
+
+def job_worker_loop(worker_id: str, stop: threading.Event) -> None:
+    """Lease and run jobs until `stop` is set (one thread per worker)."""
+    while not stop.is_set():
+        try:
+            expired = JOBS.expire_leases()
+            if expired:
+                metric_inc("jobs_lease_expired_total", len(expired))
+                metric_inc("jobs_failed_total", len(expired))
+            _maybe_purge_jobs()
+            job = JOBS.lease(worker_id, JOB_VISIBILITY_S)
+        except Exception as e:
+            print(f"Job lease failed: {e}")
+            job = None
+        if job is None:
+            stop.wait(JOB_POLL_S)
+            continue
+        if job.attempts > 1:
+            metric_inc("jobs_redelivered_total")
+        _RUNNING_JOBS[worker_id] = job.id
+        try:
+            run_job(job, worker_id, stop)
+        finally:
+            _RUNNING_JOBS.pop(worker_id, None)
+
+def _callback_loop(stop: threading.Event) -> None:
+    """Send callbacks of finished jobs (also those failed by an expired lease) off the worker threads."""
+    hold_s = 4 * JOB_CALLBACK_TIMEOUT_S + 10      # 3 pokušaja + pauze 1 s i 2 s
+    while not stop.is_set():
+        try:
+            claim = JOBS.claim_callback(hold_s)
+        except Exception as e:
+            print(f"Job callback claim failed: {e}")
+            claim = None
+        if claim is None:
+            stop.wait(JOB_POLL_S)
+            continue
+        try:
+            _send_callback(*claim)
+        except Exception as e:
+            print(f"Job callback failed: {e}")
+
+def _node_heartbeat_loop(node_id: str, workers: int, stop: threading.Event) -> None:
+    while True:
+        try:
+            JOBS.node_beat(node_id, socket.gethostname(), os.getpid(), workers, sorted(_RUNNING_JOBS.values()))
+            JOBS.purge_nodes(stale_s=3 * JOB_NODE_HEARTBEAT_S)
+        except Exception as e:
+            print(f"Node heartbeat failed: {e}")
+        if stop.wait(JOB_NODE_HEARTBEAT_S):
+            return
+
+def start_job_workers(n: int, role: str) -> tuple:
+    """Start n worker threads for this process (node id: role-host-pid); returns (node_id, stop, threads)."""
+    node_id = f"{role}-{socket.gethostname()}-{os.getpid()}"
+    stop = threading.Event()
+    threads = [threading.Thread(target=job_worker_loop, args=(f"{node_id}-{i}", stop), name=f"job-{i}", daemon=True)
+               for i in range(n)]
+    threads.append(threading.Thread(target=_node_heartbeat_loop, args=(node_id, n, stop), name="job-node", daemon=True))
+    threads.append(threading.Thread(target=_callback_loop, args=(stop,), name="job-callback", daemon=True))
+    for t in threads:
+        t.start()
+    return node_id, stop, threads
+
+def stop_job_workers(node_id: str, stop: threading.Event, threads: List[threading.Thread], timeout_s: float = 10.0) -> None:
+    """Cancel running jobs (they go back to the queue without using an attempt) and deregister the node."""
+    stop.set()
+    for t in threads:
+        t.join(timeout_s)
+    with suppress(Exception):
+        JOBS.remove_node(node_id)
+
+# ---------- BATCH ----------
+_BATCH_CPU_POOL: Optional[ProcessPoolExecutor] = None
+_BATCH_CPU_LOCK = threading.Lock()
+_UPLOAD_EXT = (".pdf", ".jpg", ".jpeg", ".png", ".webp", ".tif", ".tiff", ".bmp", ".gif")
+
+def batch_cpu_pool() -> Optional[ProcessPoolExecutor]:
+    global _BATCH_CPU_POOL
+    if BATCH_CPU_PROCESSES <= 0:
+        return None
+    with _BATCH_CPU_LOCK:
+        if _BATCH_CPU_POOL is None:
+            _BATCH_CPU_POOL = ProcessPoolExecutor(max_workers=BATCH_CPU_PROCESSES,
+                                                  mp_context=multiprocessing.get_context("spawn"))
+        return _BATCH_CPU_POOL
+
+def batch_workers() -> int:
+    """Documents in flight: enough to keep every LLM endpoint (and slot) busy."""
+    if BATCH_WORKERS > 0:
+        return BATCH_WORKERS
+    return max(2, max(len(TEXT_POOL), len(VISION_POOL)) * max(1, LLM_SLOTS))
+
+def unpack_batch(uploads: List[tuple]) -> List[tuple]:
+    """[(filename, content_type, bytes)] with ZIP archives expanded; ValueError on limits."""
+    docs: List[tuple] = []
+    total = 0
+    for name, ctype, data in uploads:
+        if (name or "").lower().endswith(".zip") or ctype in ("application/zip", "application/x-zip-compressed") \
+                or data[:4] == b"PK\x03\x04":
+            with zipfile.ZipFile(io.BytesIO(data)) as zf:
+                for info in zf.infolist():
+                    base = info.filename.rsplit("/", 1)[-1]
+                    if info.is_dir() or info.filename.startswith("__MACOSX/") or base.startswith(".") \
+                            or not base.lower().endswith(_UPLOAD_EXT):
+                        continue
+                    # provjera prije raspakiranja (zip bomb)
+                    total += info.file_size
+                    if total > BATCH_MAX_BYTES or len(docs) >= BATCH_MAX_FILES:
+                        raise ValueError(f"batch too large (max {BATCH_MAX_FILES} files, {BATCH_MAX_BYTES} bytes)")
+                    docs.append((info.filename, None, zf.read(info)))
+        else:
+            total += len(data)
+            if total > BATCH_MAX_BYTES or len(docs) >= BATCH_MAX_FILES:
+                raise ValueError(f"batch too large (max {BATCH_MAX_FILES} files, {BATCH_MAX_BYTES} bytes)")
+            docs.append((name, ctype, data))
+    return docs
+
+async def _batch_document(index: int, name: str, ctype: Optional[str], data: bytes, params: Dict[str, Any],
+                          batch_token: CancelToken, threads: ThreadPoolExecutor, key: str) -> Dict[str, Any]:
+    """One document of a batch -> NDJSON record (never raises, except on batch cancel)."""
+    loop = asyncio.get_running_loop()
+    is_pdf = ctype == "application/pdf" or (name or "").lower().endswith(".pdf") or data[:5] == b"%PDF-"
+    limits = [d for d in (params.get("deadline_s"), REQUEST_DEADLINE_S) if d and d > 0]
+    state = new_state(data, is_pdf, params, cancel=CancelToken(parent=batch_token, deadline_s=min(limits) if limits else None))
+    rec: Dict[str, Any] = {"index": index, "filename": name}
+    ticket = None
+    try:
+        if ADMISSION is not None:
+            cost = await loop.run_in_executor(threads, admission_cost, state)
+            try:
+                ticket = await ADMISSION.acquire(key, cost["units"])
+            except AdmissionRejected as e:
+                metric_inc("admission_rejected_total")
+                return dict(rec, status="rejected", error=f"admission rejected: {e.reason}",
+                            retryAfterS=max(1, int(math.ceil(e.retry_after_s))))
+            state.admission_info = dict(cost, waitedMs=round((time.monotonic() - ticket.requested_at) * 1000.0, 1))
+        pool = batch_cpu_pool()
+        if pool is not None and is_pdf:
+            try:
+                state.text, state.page_count = await loop.run_in_executor(pool, pdf_probe.probe, data)
+                state.has_text = state.text is not None
+            except Exception as e:
+                print(f"Batch CPU probe failed: {e}")
+            state.cancel.check()
+        result = await loop.run_in_executor(threads, process_state, state)
+        if isinstance(result, dict) and result.get("error"):
+            return dict(rec, status="error", error=result.get("error"), result=result)
+        return dict(rec, status="done", result=result)
+    except RequestCancelled as e:
+        if batch_token.cancelled:
+            raise
+        return dict(rec, status="error", error=f"request cancelled: {e}", httpStatus=504)
+    except NoHealthyEndpoint as e:
+        return dict(rec, status="error", error=str(e)[:300], httpStatus=503)
+    except Exception as e:
+        return dict(rec, status="error", error=str(e)[:300], httpStatus=500)
+    finally:
+        if ticket is not None:
+            await ADMISSION.release(ticket)
+
+# ---------- HEALTH SNAPSHOT ----------
+_STORE_STATUS: Dict[str, Any] = {}
+
+def store_status() -> Dict[str, Any]:
+    """SQLite-backed parts of /agent/health (COUNT summaries, job nodes); blocking, never on the event loop."""
+    return {
+        "templates": TEMPLATES.summary() if TEMPLATES is not None else None,
+        "dedup": DEDUP.summary() if DEDUP is not None else None,
+        "ocr": OCR.summary() if OCR is not None else None,
+        "jobs": dict(JOBS.counts(), workers=JOB_WORKERS,
+                     nodes=JOBS.nodes(stale_s=3 * JOB_NODE_HEARTBEAT_S)) if JOBS is not None else None,
+        "at": time.time(),
+    }
+
+async def _store_status_loop():
+    """Refresh the snapshot every HEALTH_STORE_INTERVAL_S; a worker holding the DB write lock
+    delays only this task, not the health endpoint or other requests."""
+    while True:
+        try:
+            _STORE_STATUS.update(await asyncio.to_thread(store_status))
+        except Exception as e:
+            print(f"Store status refresh failed: {e}")
+        await asyncio.sleep(HEALTH_STORE_INTERVAL_S)
+
 # ---------- API ----------
-app = FastAPI()
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    tasks = []
+    if HEALTH_STORE_INTERVAL_S > 0:
+        tasks.append(asyncio.create_task(_store_status_loop()))
+    if HF_ENABLED and HF_EAGER_LOAD:
+        # u pozadini: server odmah odgovara, /agent/health javlja "loading" dok model ne bude spreman
+        threading.Thread(target=hf_backend.load_model, name="hf-load", daemon=True).start()
+    if LLM_BACKEND == "openai_compat" and HEALTH_INTERVAL_S > 0:
+        for pool in (TEXT_POOL, VISION_POOL):
+            pool.background_probing = True
+        tasks.append(asyncio.create_task(_health_loop()))
+    # JOB_WORKERS=0: API čvor samo prima uploade, obrađuju ih agent_worker.py procesi
+    job_workers = start_job_workers(JOB_WORKERS, "api") if JOBS is not None and JOB_WORKERS > 0 else None
+    yield
+    if job_workers is not None:
+        await asyncio.to_thread(stop_job_workers, *job_workers)
+    for t in tasks:
+        t.cancel()
+    for t in tasks:
+        with suppress(asyncio.CancelledError):
+            await t
+
+app = FastAPI(lifespan=_lifespan)
+
+ADMISSION = (AdmissionController(ADMISSION_CAPACITY, budgets=parse_budgets(ADMISSION_BUDGETS),
+                                 default_budget=tuple(float(v) for v in ADMISSION_DEFAULT_BUDGET.split("/", 1)),
+                                 max_wait_s=ADMISSION_MAX_WAIT_S, retry_after_s=ADMISSION_RETRY_AFTER_S)
+             if ADMISSION_ENABLED else None)
+
+async def _watch_disconnect(request: Request, token: CancelToken) -> None:
+    """Klijent zatvorio konekciju -> prekini pdfminer/rendering i LLM poziv (llama.cpp oslobađa slot)."""
+    while not token.cancelled:
+        if await request.is_disconnected():
+            token.cancel("client_disconnected")
+            return
+        await asyncio.sleep(DISCONNECT_POLL_S)
+
+def request_token(deadline_s: Optional[float], ceiling_s: float = REQUEST_DEADLINE_S) -> CancelToken:
+    """Per-request CancelToken; a client-supplied deadline may only shorten the ceiling
+    (REQUEST_DEADLINE_S, JOB_DEADLINE_S for background jobs)."""
+    limits = [d for d in (deadline_s, ceiling_s) if d and d > 0]
+    return CancelToken(deadline_s=min(limits) if limits else None)
+
+def cancelled_response(e: RequestCancelled) -> JSONResponse:
+    reason = str(e)
+    metric_inc(f"requests_cancelled_{reason}_total")
+    # 499: klijent je otišao (nitko ne čita odgovor); 504: isteklo vrijeme zahtjeva
+    return JSONResponse(status_code=499 if reason == "client_disconnected" else 504,
+                        content={"error": f"request cancelled: {reason}"})
 
 # Add CORS middleware
 app.add_middleware(
@@ -499,56 +2453,297 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+async def admit(request: Request, state: AgentState):
+    """Admission for one request -> (ticket or None, 429 response or None)."""
+    if ADMISSION is None:
+        return None, None
+    cost = await run_in_threadpool(admission_cost, state)
+    key = request.headers.get(ADMISSION_KEY_HEADER) or "anonymous"
+    try:
+        ticket = await ADMISSION.acquire(key, cost["units"])
+    except AdmissionRejected as e:
+        metric_inc("admission_rejected_total")
+        retry = max(1, int(math.ceil(e.retry_after_s)))
+        return None, JSONResponse(status_code=429, headers={"Retry-After": str(retry)},
+                                  content={"error": f"admission rejected: {e.reason}", "costUnits": cost["units"],
+                                           "retryAfterS": retry})
+    state.admission_info = dict(cost, waitedMs=round((time.monotonic() - ticket.requested_at) * 1000.0, 1))
+    metric_inc("admission_admitted_total")
+    metric_inc("admission_units_total", cost["units"])
+    return ticket, None
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """StreamingResponse that gives its admission ticket back when the response ends, also when
+    the body is never iterated (client gone before the first chunk, send error)."""
+
+    def __init__(self, content: Any, ticket: Any, **kwargs: Any):
+        super().__init__(content, **kwargs)
+        self.ticket = ticket
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.ticket is not None:
+                ticket, self.ticket = self.ticket, None
+                await ADMISSION.release(ticket)
+
 @app.post("/agent/analyze-file")
 async def analyze_file(
+    request: Request,
     file: UploadFile,
     max_pages: int = Form(MAX_PAGES_DEF),
     text_context: Optional[str] = Form(None),
     annotations: Optional[str] = Form(None),
     analysis_type: Optional[str] = Form(None),
+    hedge: Optional[bool] = Form(None),
+    region_mode: Optional[bool] = Form(None),
+    split: Optional[bool] = Form(None),
+    full_document: Optional[bool] = Form(None),
+    deadline_s: Optional[float] = Form(None),
 ):
     fb = await file.read()
     is_pdf = file.content_type=="application/pdf" or file.filename.lower().endswith(".pdf")
-    state = AgentState(file_bytes=fb, is_pdf=is_pdf)
+    params = {"max_pages": max_pages, "text_context": text_context, "annotations": annotations,
+              "hedge": hedge, "region_mode": region_mode, "split": split,
+              "full_document": full_document}
+    state = new_state(fb, is_pdf, params, cancel=request_token(deadline_s))
+    ticket, rejected = await admit(request, state)
+    if rejected is not None:
+        return rejected
 
-    # hint: ako je slika, odmah pripremi images_dataurls; agent će pozvati vision tool
-    if not is_pdf:
-        state.images_dataurls = [data_url(fb)]
+    token = state.cancel
+    watcher = asyncio.create_task(_watch_disconnect(request, token))
+    # rok i bez provjera u kodu: zatvara socket blokiranog LLM poziva
+    left = token.remaining()
+    timer = asyncio.get_running_loop().call_later(max(0.0, left), token.cancel, "deadline") if left is not None else None
+    try:
+        # u threadpoolu (CPU priprema slike, blokirajući LLM pozivi), da paralelni zahtjevi koriste sve endpointe
+        return await run_in_threadpool(process_state, state)
+    except RequestCancelled as e:
+        return cancelled_response(e)
+    except NoHealthyEndpoint as e:
+        return JSONResponse(status_code=503, content={"error": str(e)[:300]})
+    except Exception as e:
+        if token.cancelled:
+            return cancelled_response(RequestCancelled(token.reason or "cancelled"))
+        return JSONResponse(status_code=500, content={"error": str(e)[:300]})
+    finally:
+        if timer is not None:
+            timer.cancel()
+        watcher.cancel()
+        if ticket is not None:
+            await ADMISSION.release(ticket)
 
-    # Attach optional multimodal context
-    if text_context:
-        state.text_context = text_context
-    if annotations:
+@app.post("/agent/analyze-stream")
+async def analyze_stream(
+    request: Request,
+    file: UploadFile,
+    max_pages: int = Form(MAX_PAGES_DEF),
+    text_context: Optional[str] = Form(None),
+    annotations: Optional[str] = Form(None),
+    region_mode: Optional[bool] = Form(None),
+    deadline_s: Optional[float] = Form(None),
+):
+    """analyze-file as NDJSON events: token / field while the HF model generates, then result or error.
+
+    One LLM answer per document, so hedging, bundle splitting and page windows are off here.
+    With the openai_compat backend only the final event is sent.
+    """
+    fb = await file.read()
+    is_pdf = file.content_type=="application/pdf" or file.filename.lower().endswith(".pdf")
+    params = {"max_pages": max_pages, "text_context": text_context, "annotations": annotations,
+              "hedge": False, "region_mode": region_mode, "split": False, "full_document": False}
+    state = new_state(fb, is_pdf, params, cancel=request_token(deadline_s))
+    ticket, rejected = await admit(request, state)
+    if rejected is not None:
+        return rejected
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+    state.token_sink = lambda ev: loop.call_soon_threadsafe(events.put_nowait, ev)
+    metric_inc("stream_requests_total")
+
+    def line(ev: Dict[str, Any]) -> bytes:
+        return (json.dumps(ev, ensure_ascii=False) + "\n").encode("utf-8")
+
+    async def stream():
+        token = state.cancel
+        watcher = asyncio.create_task(_watch_disconnect(request, token))
+        left = token.remaining()
+        timer = loop.call_later(max(0.0, left), token.cancel, "deadline") if left is not None else None
+        task = asyncio.ensure_future(run_in_threadpool(process_state, state))
         try:
-            state.annotations = json.loads(annotations)
-        except Exception:
-            state.annotations = annotations
+            while True:
+                get = asyncio.ensure_future(events.get())
+                done, _ = await asyncio.wait({get, task}, return_when=asyncio.FIRST_COMPLETED)
+                if get in done:
+                    yield line(get.result())
+                    continue
+                get.cancel()
+                break
+            while not events.empty():
+                yield line(events.get_nowait())
+            try:
+                yield line({"event": "result", "result": task.result()})
+            except RequestCancelled as e:
+                metric_inc(f"requests_cancelled_{e}_total")
+                yield line({"event": "error", "error": f"request cancelled: {e}", "httpStatus": 504})
+            except NoHealthyEndpoint as e:
+                yield line({"event": "error", "error": str(e)[:300], "httpStatus": 503})
+            except Exception as e:
+                yield line({"event": "error", "error": str(e)[:300], "httpStatus": 500})
+        finally:
+            if not task.done():
+                token.cancel("client_disconnected")
+            if timer is not None:
+                timer.cancel()
+            watcher.cancel()
+
+    return AdmittedStreamingResponse(stream(), ticket, media_type="application/x-ndjson")
+
+@app.post("/agent/analyze-batch")
+async def analyze_batch(
+    request: Request,
+    files: List[UploadFile],
+    max_pages: int = Form(MAX_PAGES_DEF),
+    text_context: Optional[str] = Form(None),
+    hedge: Optional[bool] = Form(None),
+    split: Optional[bool] = Form(None),
+    full_document: Optional[bool] = Form(None),
+    deadline_s: Optional[float] = Form(None),
+):
+    """Many files and/or ZIP archives; one NDJSON line per document in completion order, then a summary.
 
+    Documents run BATCH_WORKERS at a time (enough to keep every LLM endpoint busy); pdfminer
+    runs in a process pool when BATCH_CPU_PROCESSES > 0. deadline_s applies per document.
+    """
     try:
-        result = run_agent(state)
-        return result
-    except Exception as e:
-        return JSONResponse(status_code=500, content={"error": str(e)[:300]})
+        uploads = [(f.filename, f.content_type, await f.read()) for f in files]
+        docs = await run_in_threadpool(unpack_batch, uploads)
+    except (ValueError, zipfile.BadZipFile) as e:
+        return JSONResponse(status_code=400, content={"error": str(e)[:300]})
+    if not docs:
+        return JSONResponse(status_code=400, content={"error": "no PDF or image files in the upload"})
+    params = {"max_pages": max_pages, "text_context": text_context, "hedge": hedge, "split": split,
+              "full_document": full_document, "deadline_s": deadline_s}
+    key = request.headers.get(ADMISSION_KEY_HEADER) or "anonymous"
+    metric_inc("batch_requests_total")
+    metric_inc("batch_documents_total", len(docs))
+
+    async def stream():
+        batch_token = CancelToken()
+        watcher = asyncio.create_task(_watch_disconnect(request, batch_token))
+        workers = batch_workers()
+        threads = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch")
+        slots = asyncio.Semaphore(workers)
+        t0 = time.perf_counter()
+        counts: Dict[str, int] = {}
+
+        async def run(i: int, doc: tuple) -> Dict[str, Any]:
+            async with slots:
+                batch_token.check()
+                return await _batch_document(i, *doc, params, batch_token, threads, key)
+
+        tasks = [asyncio.create_task(run(i, doc)) for i, doc in enumerate(docs)]
+        try:
+            for fut in asyncio.as_completed(tasks):
+                rec = await fut
+                counts[rec["status"]] = counts.get(rec["status"], 0) + 1
+                yield json.dumps(rec, ensure_ascii=False) + "\n"
+            yield json.dumps({"summary": {"documents": len(docs), **counts, "workers": workers,
+                                          "elapsedMs": round((time.perf_counter() - t0) * 1000.0, 1)}}) + "\n"
+        except RequestCancelled:
+            metric_inc(f"requests_cancelled_{batch_token.reason or 'cancelled'}_total")
+        finally:
+            # klijent otišao / generator zatvoren: prekini dokumente u tijeku (LLM socketi se zatvaraju)
+            if not all(t.done() for t in tasks):
+                batch_token.cancel("client_disconnected")
+            for t in tasks:
+                t.cancel()
+            with suppress(Exception):
+                await asyncio.gather(*tasks, return_exceptions=True)
+            watcher.cancel()
+            threads.shutdown(wait=False, cancel_futures=True)
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.post("/agent/jobs", status_code=202)
+async def submit_job(
+    file: UploadFile,
+    max_pages: int = Form(MAX_PAGES_DEF),
+    text_context: Optional[str] = Form(None),
+    annotations: Optional[str] = Form(None),
+    analysis_type: Optional[str] = Form(None),
+    hedge: Optional[bool] = Form(None),
+    region_mode: Optional[bool] = Form(None),
+    split: Optional[bool] = Form(None),
+    full_document: Optional[bool] = Form(None),
+    deadline_s: Optional[float] = Form(None),
+    callback_url: Optional[str] = Form(None),
+):
+    """Store the upload and return at once; poll GET /agent/jobs/{id} or wait for the callback."""
+    if JOBS is None:
+        return JSONResponse(status_code=404, content={"error": "job API disabled (JOBS_ENABLED=0)"})
+    if callback_url and not callback_allowed(callback_url):
+        return JSONResponse(status_code=400, content={
+            "error": "callback_url must be an http(s) URL whose host is listed in JOB_CALLBACK_ALLOW"})
+    fb = await file.read()
+    params = {"max_pages": max_pages, "text_context": text_context, "annotations": annotations,
+              "hedge": hedge, "region_mode": region_mode, "split": split,
+              "full_document": full_document, "deadline_s": deadline_s}
+    job_id = await run_in_threadpool(JOBS.enqueue, fb, file.filename, file.content_type, params, callback_url)
+    metric_inc("jobs_submitted_total")
+    return {"id": job_id, "status": "queued", "statusUrl": f"/agent/jobs/{job_id}"}
+
+@app.get("/agent/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await run_in_threadpool(JOBS.get, job_id) if JOBS is not None else None
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "unknown job"})
+    return job
+
+@app.get("/agent/metrics")
+async def agent_metrics():
+    with _METRICS_LOCK:
+        return dict(METRICS)
 
 @app.get("/agent/health")
 async def agent_health():
     backend = LLM_BACKEND
     policy = AGENT_POLICY
+    # snapshot iz pozadine; bez njega (HEALTH_STORE_INTERVAL_S=0, prvi zahtjevi) čitanje u threadpoolu
+    stores = dict(_STORE_STATUS) or await run_in_threadpool(store_status)
     status = {
         "backend": backend,
         "policy": policy,
         "hfEnabled": HF_ENABLED,
         "hfModelId": os.getenv("HF_MODEL_ID", "google/gemma-3-4b-it") if backend == "hf" else None,
+        "hfScheduler": hf_backend.scheduler_summary() if HF_ENABLED else None,
+        "hfModel": hf_backend.load_info() if HF_ENABLED else None,
+        "hfImageCache": hf_backend.image_cache_summary() if HF_ENABLED else None,
         "textLLMUrl": TEXT_LLM_URL,
         "visionLLMUrl": VISION_LLM_URL,
+        "textLLMEndpoints": TEXT_POOL.snapshot(),
+        "visionLLMEndpoints": VISION_POOL.snapshot(),
+        "templates": stores["templates"],
+        "dedup": stores["dedup"],
+        "admission": ADMISSION.snapshot() if ADMISSION is not None else None,
+        "visionWindowCache": WINDOW_CACHE.summary(),
+        "ocr": stores["ocr"],
+        "memory": {"rssBytes": mem_profile.process_rss(), "tracemalloc": mem_profile.tracing(),
+                   "ceilingMb": MEM_REQUEST_CEILING_MB or None},
+        "jobs": stores["jobs"],
+        "storeStatusAgeS": round(time.time() - stores["at"], 1),
         "textLLMReachable": None,
         "visionLLMReachable": None,
         "ok": True,
         "errors": []
     }
     if backend == "openai_compat":
-        status["textLLMReachable"] = _check_openai_server(TEXT_LLM_URL)
-        status["visionLLMReachable"] = _check_openai_server(VISION_LLM_URL)
+        # Cache iz pozadinskog health checka — ovdje nema mrežnih poziva
+        status["healthIntervalS"] = HEALTH_INTERVAL_S
+        status["textLLMReachable"] = TEXT_POOL.any_healthy
+        status["visionLLMReachable"] = VISION_POOL.any_healthy
         if not status["textLLMReachable"]:
             status["ok"] = False
             status["errors"].append("text_llm_unreachable")
@@ -562,6 +2757,13 @@ async def agent_health():
         if not HF_ENABLED:
             status["ok"] = False
             status["errors"].append("hf_backend_not_available")
+        else:
+            # lijeno učitavanje (not_loaded) je spremno: model se učita na prvom zahtjevu
+            hf_state = status["hfModel"]["state"]
+            status["hfReady"] = hf_backend.is_ready()
+            if hf_state in ("loading", "failed"):
+                status["ok"] = False
+                status["errors"].append(f"hf_model_{hf_state}")
     return status
 
 if __name__ == "__main__":
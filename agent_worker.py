@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Headless worker: runs the agent pipeline on jobs leased from the shared job queue (no HTTP)
+
+The API node accepts uploads into the queue (`POST /agent/jobs`; with JOB_WORKERS=0 it does
+no PDF/LLM work itself); any number of these worker processes lease the jobs and run them against the llama.cpp pool from TEXT_LLM_URL / VISION_LLM_URL. Leases are
+renewed by heartbeats; a crashed worker's jobs are re-delivered once JOB_VISIBILITY_S passes.
+SIGTERM / Ctrl+C puts running jobs straight back into the queue.
+
+Configuration is the same environment as agent_server.py (JOB_DB, JOB_VISIBILITY_S, LLM URLs,
+feature flags); the flags below override it. The SQLite queue (WAL) must be on a local disk,
+so it is shared by processes on one box; workers on other boxes need a JobQueue with the same
+lease/heartbeat/complete/fail/release methods on a networked store.
+
+Usage:
+  python agent_worker.py --workers 4 --db /srv/agent/jobs.sqlite
+"""
+import argparse
+import os
+import signal
+import sys
+import threading
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="PDF agent queue worker")
+    ap.add_argument("--workers", type=int, default=int(os.getenv("JOB_WORKERS", "2")) or 2,
+                    help="concurrent jobs in this process (default: JOB_WORKERS or 2)")
+    ap.add_argument("--db", default=None, help="job queue database (default: JOB_DB)")
+    ap.add_argument("--visibility", type=float, default=None, help="lease length in seconds (default: JOB_VISIBILITY_S)")
+    args = ap.parse_args()
+
+    # agent_server čita konfiguraciju pri importu
+    if args.db:
+        os.environ["JOB_DB"] = args.db
+    if args.visibility:
+        os.environ["JOB_VISIBILITY_S"] = str(args.visibility)
+    os.environ["JOBS_ENABLED"] = "1"
+    import agent_server
+
+    stopping = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stopping.set())
+
+    node_id, stop, threads = agent_server.start_job_workers(max(1, args.workers), "worker")
+    print(f"Worker {node_id}: {args.workers} threads on {agent_server.JOB_DB} "
+          f"(text: {agent_server.TEXT_LLM_URL}, vision: {agent_server.VISION_LLM_URL})")
+    while not stopping.wait(1.0):
+        pass
+    print(f"Worker {node_id}: stopping, returning running jobs to the queue")
+    agent_server.stop_job_workers(node_id, stop, threads)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
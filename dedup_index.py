@@ -0,0 +1,264 @@
+"""
+Near-duplicate document index: re-scans and re-exports of an already processed invoice
+
+- Exact duplicates are found by the sha256 of the upload
+- Near duplicates by two fingerprints, each bucketed LSH-style in SQLite so a lookup only
+  touches a few candidate rows, not the whole index:
+  * dHash (64 bit) of the rendered first page, split into 4 bands of 16 bits; two hashes
+    within Hamming distance 3 always share a band
+  * MinHash (64 permutations) of word 3-gram shingles of the text layer, 16 bands x 4 rows;
+    documents with Jaccard similarity ~0.5+ are likely to share a band
+- A text match is accepted only if the estimated Jaccard similarity is above the threshold
+  and the prior result's documentNumber and totalAmount both occur in the new text, so two
+  invoices of the same supplier (same layout, different number) are never confused
+- Documents without a text layer (scans) can only match by dHash; that needs an explicit
+  distance (DEDUP_IMAGE_ONLY_DIST) because there is nothing to cross-check against
+
+Usage from agent_server:
+  index = DedupIndex("dedup_index.sqlite", parse_number=hr_number_to_float)
+  fp = index.fingerprint(file_bytes, is_pdf)
+  hit = index.lookup(fp)               # -> DedupHit | None
+  index.add(fp, result)                # after a validated result
+"""
+
+from __future__ import annotations
+import hashlib
+import io
+import json
+import re
+import sqlite3
+import struct
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pypdfium2 as pdfium
+from PIL import Image, ImageOps
+
+NUM_PERM = 64
+MH_BANDS = 16                      # 16 bands x 4 rows
+DH_BANDS = 4                       # 4 bands x 16 bits
+MAX_BUCKET = 64                    # kandidata po bucketu (zajednički boilerplate ne smije skenirati sve)
+_MERSENNE = (1 << 61) - 1
+_MAX32 = (1 << 32) - 1
+# fiksni koeficijenti permutacija (deterministično između procesa)
+_PERMS = [(int.from_bytes(hashlib.blake2b(b"a%d" % i, digest_size=8).digest(), "big") % _MERSENNE | 1,
+           int.from_bytes(hashlib.blake2b(b"b%d" % i, digest_size=8).digest(), "big") % _MERSENNE)
+          for i in range(NUM_PERM)]
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_NUMBER_RE = re.compile(r"-?\d[\d.,]*\d|\d")
+
+
+# ---------- fingerprints ----------
+def dhash(img: Image.Image, size: int = 8) -> int:
+    """Difference hash: sign of horizontal gradients on a (size+1) x size grayscale thumbnail."""
+    g = img.convert("L").resize((size + 1, size), Image.LANCZOS)
+    px = list(g.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = px[row * (size + 1) + col]
+            right = px[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+    return bits
+
+
+def shingles(text: str, k: int = 3) -> set:
+    words = [w.lower() for w in _WORD_RE.findall(text or "")]
+    if len(words) < k:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + k]) for i in range(len(words) - k + 1)}
+
+
+def minhash(sh: set) -> Optional[List[int]]:
+    if not sh:
+        return None
+    base = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big") for s in sh]
+    return [min(((a * x + b) % _MERSENNE) & _MAX32 for x in base) for a, b in _PERMS]
+
+
+def _hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def _jaccard_est(a: List[int], b: List[int]) -> float:
+    return sum(1 for x, y in zip(a, b) if x == y) / float(len(a))
+
+
+def _dh_keys(h: int) -> List[Tuple[int, int]]:
+    return [(i, (h >> (16 * i)) & 0xFFFF) for i in range(DH_BANDS)]
+
+
+def _mh_keys(sig: List[int]) -> List[Tuple[int, int]]:
+    rows = NUM_PERM // MH_BANDS
+    out = []
+    for i in range(MH_BANDS):
+        chunk = struct.pack(">%dI" % rows, *sig[i * rows:(i + 1) * rows])
+        # band brojevi 100+ da dHash i MinHash dijele istu tablicu
+        out.append((100 + i, int.from_bytes(hashlib.blake2b(chunk, digest_size=7).digest(), "big")))
+    return out
+
+
+def _alnum(s: str) -> str:
+    return "".join(ch for ch in (s or "").lower() if ch.isalnum())
+
+
+class Fingerprint:
+    def __init__(self, sha256: str, dhash: Optional[int], minhash: Optional[List[int]], text: str):
+        self.sha256 = sha256
+        self.dhash = dhash
+        self.minhash = minhash
+        self.text = text
+
+
+class DedupHit:
+    def __init__(self, kind: str, doc_id: int, result: Dict[str, Any],
+                 similarity: Optional[float] = None, distance: Optional[int] = None):
+        self.kind = kind              # exact | text | image
+        self.doc_id = doc_id
+        self.result = result
+        self.similarity = similarity
+        self.distance = distance
+
+    def info(self) -> Dict[str, Any]:
+        return {"kind": self.kind, "docId": self.doc_id, "similarity": self.similarity, "distance": self.distance}
+
+
+# ---------- index ----------
+class DedupIndex:
+    def __init__(self, path: str, parse_number: Callable[[str], Optional[float]],
+                 text_threshold: float = 0.9, image_only_distance: int = -1, max_pages: int = 2):
+        self.path = path
+        self.parse_number = parse_number
+        self.text_threshold = float(text_threshold)
+        self.image_only_distance = int(image_only_distance)
+        self.max_pages = int(max_pages)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (
+                id INTEGER PRIMARY KEY,
+                sha256 TEXT UNIQUE NOT NULL,
+                dhash TEXT,
+                minhash BLOB,
+                result TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS lsh (
+                band INTEGER NOT NULL,
+                key INTEGER NOT NULL,
+                doc_id INTEGER NOT NULL,
+                PRIMARY KEY (band, key, doc_id)
+            ) WITHOUT ROWID;
+        """)
+        self._db.commit()
+
+    # --- fingerprint ---
+    def fingerprint(self, file_bytes: bytes, is_pdf: bool) -> Fingerprint:
+        sha = hashlib.sha256(file_bytes).hexdigest()
+        text, img = "", None
+        if is_pdf:
+            pdf = pdfium.PdfDocument(file_bytes)
+            try:
+                parts = []
+                for i in range(min(len(pdf), self.max_pages)):
+                    page = pdf[i]
+                    tp = page.get_textpage()
+                    parts.append(tp.get_text_bounded())
+                    tp.close()
+                    if i == 0:
+                        w, _ = page.get_size()
+                        img = page.render(scale=128.0 / max(w, 1.0)).to_pil()
+                    page.close()
+                text = "\n".join(parts)
+            finally:
+                pdf.close()
+        else:
+            img = ImageOps.exif_transpose(Image.open(io.BytesIO(file_bytes)))
+        dh = dhash(img) if img is not None else None
+        return Fingerprint(sha, dh, minhash(shingles(text)), text)
+
+    # --- lookup ---
+    def _cross_check(self, result: Dict[str, Any], text: str) -> bool:
+        """Prior documentNumber and totalAmount must both appear in the new document text."""
+        doc_no = _alnum(str(result.get("documentNumber") or ""))
+        total = (result.get("totals") or {}).get("totalAmount")
+        if not doc_no or not isinstance(total, (int, float)):
+            return False
+        if doc_no not in _alnum(text):
+            return False
+        for tok in _NUMBER_RE.findall(text):
+            v = self.parse_number(tok)
+            if v is not None and abs(v - total) < 0.005:
+                return True
+        return False
+
+    def lookup(self, fp: Fingerprint) -> Optional[DedupHit]:
+        with self._lock:
+            row = self._db.execute("SELECT id, result FROM docs WHERE sha256 = ?", (fp.sha256,)).fetchone()
+            if row:
+                return DedupHit("exact", row[0], json.loads(row[1]), similarity=1.0, distance=0)
+            keys = []
+            if fp.dhash is not None:
+                keys += _dh_keys(fp.dhash)
+            if fp.minhash is not None:
+                keys += _mh_keys(fp.minhash)
+            ids = set()
+            for band, key in keys:
+                for (doc_id,) in self._db.execute(
+                        # najnoviji kandidati: pretrpan band (isti layout dobavljača) inače vraća samo najstarije
+                        "SELECT doc_id FROM lsh WHERE band = ? AND key = ? ORDER BY doc_id DESC LIMIT ?",
+                        (band, key, MAX_BUCKET)):
+                    ids.add(doc_id)
+            if not ids:
+                return None
+            marks = ",".join("?" * len(ids))
+            cands = self._db.execute(
+                f"SELECT id, dhash, minhash, result FROM docs WHERE id IN ({marks})", tuple(ids)).fetchall()
+        best: Optional[DedupHit] = None
+        for doc_id, dh_hex, mh_blob, result_s in cands:
+            dist = _hamming(fp.dhash, int(dh_hex, 16)) if (fp.dhash is not None and dh_hex) else None
+            if fp.minhash is not None and mh_blob:
+                sim = _jaccard_est(fp.minhash, list(struct.unpack(">%dI" % NUM_PERM, mh_blob)))
+                if sim < self.text_threshold:
+                    continue
+                result = json.loads(result_s)
+                if not self._cross_check(result, fp.text):
+                    continue
+                hit = DedupHit("text", doc_id, result, similarity=round(sim, 3), distance=dist)
+            elif fp.minhash is None and dist is not None and dist <= self.image_only_distance:
+                hit = DedupHit("image", doc_id, json.loads(result_s), distance=dist)
+            else:
+                continue
+            if best is None or ((hit.similarity or 0), -(hit.distance or 0)) > ((best.similarity or 0), -(best.distance or 0)):
+                best = hit
+        return best
+
+    # --- add ---
+    def add(self, fp: Fingerprint, result: Dict[str, Any]) -> bool:
+        """Store a validated result; results without documentNumber/totalAmount cannot be cross-checked."""
+        if not result.get("documentNumber") or not isinstance((result.get("totals") or {}).get("totalAmount"), (int, float)):
+            return False
+        mh_blob = struct.pack(">%dI" % NUM_PERM, *fp.minhash) if fp.minhash is not None else None
+        dh_hex = format(fp.dhash, "016x") if fp.dhash is not None else None
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT OR IGNORE INTO docs (sha256, dhash, minhash, result, created) VALUES (?, ?, ?, ?, ?)",
+                (fp.sha256, dh_hex, mh_blob, json.dumps(result, ensure_ascii=False), time.time()))
+            if cur.rowcount == 0:
+                return False
+            doc_id = cur.lastrowid
+            keys = (_dh_keys(fp.dhash) if fp.dhash is not None else []) + \
+                   (_mh_keys(fp.minhash) if fp.minhash is not None else [])
+            self._db.executemany("INSERT OR IGNORE INTO lsh (band, key, doc_id) VALUES (?, ?, ?)",
+                                 [(b, k, doc_id) for b, k in keys])
+            self._db.commit()
+        return True
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            (n,) = self._db.execute("SELECT COUNT(*) FROM docs").fetchone()
+        return {"documents": n}
@@ -1,30 +1,93 @@
 """
 Hugging Face Transformers backend for Gemma 3 4B-IT (multimodal)
 
-- Loads the model lazily on first use to keep startup fast
+- Loads the model lazily on first use to keep startup fast, or eagerly with load_model()
+  (agent_server calls it in the background when HF_EAGER_LOAD=1); loading is single-flight,
+  concurrent first requests wait for the one load instead of loading the model twice
+- load_info() reports readiness, load time and memory footprint for /agent/health
+- Generation stops as soon as the first top-level JSON object of the answer closes (brace and
+  bracket depth outside strings), and only the new tokens are decoded, without the prompt
+- stream_generate() yields decoded text pieces while the model generates (TextIteratorStreamer);
+  a consumer that stops iterating (client gone, deadline) stops the generation at the next token
 - Supports text-only and image+text generations
+- Image prompts: the processor outputs of each image (pixel_values, grid sizes ...) are cached
+  by content hash and model ID (LRU, bounded by tensor bytes), so a retry, repair or hedged call
+  with the same pages skips decoding and preprocessing; a miss is first downscaled (PIL) to the
+  image processor's target resolution, so the heavy preprocessing runs on a small image
 - Basic VRAM controls via env vars
+- Keeps the KV cache of a static text prompt prefix so it is evaluated only once
+- All generation runs on one scheduler thread: concurrent text prompts with the same
+  generation settings, the same prefix and similar length go into one `generate` batch (the
+  prefix KV cache is repeated per row, the suffixes are padded after it), image prompts run one
+  at a time, so requests never fight over the GPU/CPU
+- cancel_check (generate_text_only, generate_multimodal, stream_generate) is polled while the
+  caller waits; when it raises, a queued request is dropped and a running one stops at the
+  next token (its row only, the rest of the batch goes on)
+- CPU profile (default on boxes without CUDA): intra-op threads = physical cores, one inter-op
+  thread; opt-in (HF_CPU_QUANTIZE=1) float32 weights with dynamic int8 quantization of the
+  language model's Linear layers (vision tower and projector stay float32); optionally
+  torch.compile (inductor cache on disk) or an ONNX Runtime export (saved on disk, text models
+  only, needs `optimum[onnxruntime]`), so the work is done once per model, not per start.
+  hf_benchmark.py compares the profiles
 
 Env vars:
   LLM_BACKEND         = 'hf' to enable this backend (checked by agent_server)
   HF_MODEL_ID         = default 'google/gemma-3-4b-it'
   HF_DTYPE            = 'bfloat16' | 'float16' | 'float32' (auto if missing)
   HF_LOAD_IN_4BIT     = '1' to use bitsandbytes 4-bit quantization (optional)
+  HF_PREFIX_CACHE     = '0' to disable the prompt-prefix KV cache (default on)
+  HF_BATCH_MAX        = max text prompts per generate call (default 4; 1 = no batching)
+  HF_BATCH_WAIT_MS    = how long the first queued prompt waits for others to join (default 5)
+  HF_BATCH_LEN_RATIO  = longest/shortest prompt allowed in one batch, limits padding (default 1.5)
+  HF_JSON_STOP        = '0' to always generate up to max_new_tokens (default on)
+  HF_PROFILE          = 'auto' (cpu without CUDA) | 'cpu' | 'default'
+  HF_CPU_THREADS      = intra-op threads (default 0 = physical cores)
+  HF_CPU_INTEROP_THREADS = inter-op threads (default 1; generate has no parallel ops to overlap)
+  HF_CPU_QUANTIZE     = '1' for dynamic int8 Linear layers of the language model (default 0)
+  HF_CPU_RUNTIME      = 'eager' | 'compile' | 'onnx' (default eager)
+  HF_COMPILE_CACHE    = directory for the inductor cache and ONNX exports (default hf_compile_cache)
+  HF_IMAGE_CACHE_MB   = preprocessed image cache size (default 512; 0 = off)
+  HF_IMAGE_PRERESIZE  = '0' to hand full-size images to the image processor (default on)
 
 Usage from agent_server:
   from hf_backend import generate_text_only, generate_multimodal
+  text = generate_text_only(prompt, prefix=SYSTEM_PREFIX, cancel_check=token.check)
+  for piece in stream_generate(prompt, images=None, cancel_check=token.check): ...
 """
 
 from __future__ import annotations
 import os
 import io
-from typing import List, Optional
+import copy
+import gc
+import hashlib
+import math
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Any, Callable, Dict, Iterator, List, Optional
 
 from PIL import Image
 
 _MODEL = None
 _PROCESSOR = None
 _DEVICE = None
+_LOAD_LOCK = threading.Lock()
+_LOAD_INFO: Dict[str, Any] = {"state": "not_loaded"}   # not_loaded | loading | ready | failed
+
+# prefix text -> (prefix input_ids, past_key_values, eval ms)
+_PREFIX_CACHE: "OrderedDict[str, tuple]" = OrderedDict()
+_PREFIX_CACHE_MAX = 4
+_PREFIX_LOCK = threading.Lock()
+
+_BATCH_MAX = max(1, int(os.getenv("HF_BATCH_MAX", "4")))
+_BATCH_WAIT_S = float(os.getenv("HF_BATCH_WAIT_MS", "5")) / 1000.0
+_BATCH_LEN_RATIO = max(1.0, float(os.getenv("HF_BATCH_LEN_RATIO", "1.5")))
+_JSON_STOP = os.getenv("HF_JSON_STOP", "1").strip() != "0"
+_IMAGE_CACHE_BYTES = int(float(os.getenv("HF_IMAGE_CACHE_MB", "512")) * 1024 * 1024)
+_IMAGE_PRERESIZE = os.getenv("HF_IMAGE_PRERESIZE", "1").strip() != "0"
 
 
 def _get_dtype():
@@ -60,67 +123,918 @@ def _maybe_from_data_url(s: str) -> Image.Image:
 
 def _ensure_loaded():
     global _MODEL, _PROCESSOR, _DEVICE
-    if _MODEL is not None and _PROCESSOR is not None:
+    if _MODEL is not None:
         return
+    with _LOAD_LOCK:
+        # drugi zahtjev je čekao na lock dok je prvi učitavao -> model je već tu
+        if _MODEL is not None:
+            return
+        _load()
+
+
+def _load():
+    """Readiness around _load_model(): "loading" before the torch import (it alone takes seconds),
+    "failed" with the error if anything in the load raises; _load_model() sets "ready"."""
+    _LOAD_INFO.clear()
+    _LOAD_INFO.update({"state": "loading", "startedAt": time.time()})
+    t0 = time.perf_counter()
+    try:
+        _load_model(t0)
+    except Exception as e:
+        _LOAD_INFO.update({"state": "failed", "error": str(e)[:300],
+                           "loadMs": round((time.perf_counter() - t0) * 1000.0, 1)})
+        raise
+
 
+def _load_model(t0: float):
+    global _MODEL, _PROCESSOR, _DEVICE
     from transformers import AutoModelForCausalLM, AutoProcessor
     import torch
+    import mem_profile
 
     # Default to a multimodal model that supports images and text
     model_id = os.getenv("HF_MODEL_ID", "Qwen/Qwen2-VL-7B-Instruct")
+    profile = _profile()
     dtype = _get_dtype()
     load_in_4bit = (os.getenv("HF_LOAD_IN_4BIT", "0").strip() == "1")
+    # opt-in: int8 mijenja izlaz ekstrakcije, postojeća CPU instalacija ne smije to dobiti nadogradnjom
+    quantize = profile == "cpu" and os.getenv("HF_CPU_QUANTIZE", "0").strip() == "1"
+    runtime = (os.getenv("HF_CPU_RUNTIME", "eager").strip().lower() or "eager") if profile == "cpu" else "eager"
+    if quantize:
+        dtype = torch.float32   # quantize_dynamic radi samo nad float32 Linear slojevima
 
     kwargs = {
         "torch_dtype": dtype,
         "device_map": "auto",
         "low_cpu_mem_usage": True,
     }
+    if profile == "cpu":
+        kwargs.pop("device_map")
     if load_in_4bit:
         # bitsandbytes optional; user must install it
         kwargs["load_in_4bit"] = True
 
-    _MODEL = AutoModelForCausalLM.from_pretrained(model_id, **kwargs)
-    _PROCESSOR = AutoProcessor.from_pretrained(model_id)
+    _LOAD_INFO.update({"modelId": model_id, "dtype": str(dtype).replace("torch.", ""),
+                       "profile": profile, "runtime": runtime})
+    rss0 = mem_profile.process_rss()
+    if profile == "cpu":
+        _LOAD_INFO.update(_cpu_threads())
+    model = None
+    if runtime == "onnx":
+        try:
+            model, cached = _load_onnx(model_id)
+            _LOAD_INFO.update({"onnxCached": cached, "quantized": False})
+        except Exception as e:
+            # optimum nije instaliran ili model nema ONNX export -> torch put
+            print(f"HF ONNX runtime unavailable, using eager: {e}")
+            _LOAD_INFO.update({"runtime": "eager", "runtimeError": str(e)[:200]})
+    if model is None:
+        model = AutoModelForCausalLM.from_pretrained(model_id, **kwargs)
+        if quantize:
+            model, n = _quantize_language_model(model)
+            _LOAD_INFO.update({"quantized": n > 0, "quantizedLinear": n})
+    processor = AutoProcessor.from_pretrained(model_id)
+    if _LOAD_INFO["runtime"] == "compile":
+        _compile(model, processor)
     # Figure out primary device
-    if hasattr(_MODEL, "device"):
-        _DEVICE = _MODEL.device
+    if hasattr(model, "device"):
+        device = model.device
     else:
-        _DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    rss1 = mem_profile.process_rss()
+    _LOAD_INFO.update({
+        "state": "ready",
+        "loadMs": round((time.perf_counter() - t0) * 1000.0, 1),
+        "device": str(device),
+        "footprintBytes": model.get_memory_footprint() if hasattr(model, "get_memory_footprint") else None,
+        "rssDeltaBytes": (rss1 - rss0) if rss0 is not None and rss1 is not None else None,
+        "cudaAllocatedBytes": torch.cuda.memory_allocated() if torch.cuda.is_available() else None,
+    })
+    # _MODEL zadnji: brza provjera u _ensure_loaded ne smije vidjeti napola učitano stanje
+    _PROCESSOR, _DEVICE = processor, device
+    _MODEL = model
 
 
-def generate_text_only(prompt: str, max_new_tokens: int = 512, temperature: float = 0.2) -> str:
-    _ensure_loaded()
+def unload() -> None:
+    """Drop the model, e.g. to load it again with another profile (hf_benchmark.py)."""
+    global _MODEL, _PROCESSOR, _DEVICE
+    with _LOAD_LOCK:
+        _MODEL = _PROCESSOR = _DEVICE = None
+        with _PREFIX_LOCK:
+            _PREFIX_CACHE.clear()
+        if _IMAGE_CACHE is not None:
+            _IMAGE_CACHE.clear()
+        _LOAD_INFO.clear()
+        _LOAD_INFO["state"] = "not_loaded"
+    gc.collect()
+
+
+def load_model() -> Dict[str, Any]:
+    """Eager load (server start); a failure is recorded in load_info() instead of raised."""
+    try:
+        _ensure_loaded()
+    except Exception as e:
+        print(f"HF model load failed: {e}")
+    return load_info()
+
+
+def is_ready() -> bool:
+    return _MODEL is not None
+
+
+def load_info() -> Dict[str, Any]:
+    return dict(_LOAD_INFO)
+
+
+# ---------- CPU profile ----------
+def _quantize_language_model(model) -> tuple:
+    """Dynamic int8 for the Linear layers of the decoder and LM head only; a vision tower and
+    projector keep float32 (image features are sensitive to the int8 activation scales)."""
+    import torch
+
+    decoder = model.get_decoder() if hasattr(model, "get_decoder") else None
+    if decoder is None:
+        return model, 0
+    keep = {id(m) for m in decoder.modules()}
+    head = model.get_output_embeddings() if hasattr(model, "get_output_embeddings") else None
+    if head is not None:
+        keep.add(id(head))
+    spec = {name: torch.ao.quantization.default_dynamic_qconfig for name, m in model.named_modules()
+            if isinstance(m, torch.nn.Linear) and id(m) in keep}
+    if not spec:
+        return model, 0
+    return torch.ao.quantization.quantize_dynamic(model, spec, dtype=torch.qint8), len(spec)
+
+
+def _profile() -> str:
+    import torch
+    profile = (os.getenv("HF_PROFILE", "auto").strip().lower() or "auto")
+    if profile == "auto":
+        return "default" if torch.cuda.is_available() else "cpu"
+    return profile
+
+
+def _cpu_threads() -> Dict[str, Any]:
+    import torch
+    threads = int(os.getenv("HF_CPU_THREADS", "0") or 0)
+    if threads <= 0:
+        try:
+            import psutil
+            threads = psutil.cpu_count(logical=False) or os.cpu_count() or 1
+        except Exception:  # opcionalno
+            threads = os.cpu_count() or 1
+    torch.set_num_threads(threads)
+    interop = max(1, int(os.getenv("HF_CPU_INTEROP_THREADS", "1") or 1))
+    try:
+        torch.set_num_interop_threads(interop)
+    except RuntimeError:
+        # dozvoljeno samo prije prvog paralelnog rada u procesu (npr. drugo učitavanje)
+        interop = torch.get_num_interop_threads()
+    return {"threads": threads, "interopThreads": interop}
+
+
+def _cache_dir(*parts: str) -> str:
+    path = os.path.join(os.getenv("HF_COMPILE_CACHE", "hf_compile_cache"), *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _load_onnx(model_id: str) -> tuple:
+    """ONNX Runtime model from the on-disk export; the first start exports and saves it."""
+    from optimum.onnxruntime import ORTModelForCausalLM
+    import onnxruntime
+
+    opts = onnxruntime.SessionOptions()
+    opts.intra_op_num_threads = int(_LOAD_INFO.get("threads") or 0)
+    opts.inter_op_num_threads = int(_LOAD_INFO.get("interopThreads") or 1)
+    path = _cache_dir("onnx", model_id.strip("/").replace("/", "--").replace(":", "_"))
+    if os.path.isfile(os.path.join(path, "config.json")):
+        return ORTModelForCausalLM.from_pretrained(path, session_options=opts), True
+    model = ORTModelForCausalLM.from_pretrained(model_id, export=True, session_options=opts)
+    model.save_pretrained(path)
+    return model, False
+
+
+def _compile(model, processor) -> None:
+    """torch.compile of forward with the inductor cache on disk; warm-up here, not on the first request."""
+    import torch
+    # torch postavlja TORCHINDUCTOR_CACHE_DIR na /tmp već pri prvom importu inductora -> prepiši
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = _cache_dir("inductor")
+    os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] = "1"
+    eager = model.forward
+    t0 = time.perf_counter()
+    try:
+        model.forward = torch.compile(eager, dynamic=True)
+        ids = processor(text="{", return_tensors="pt")
+        with torch.inference_mode():
+            model.generate(**ids, max_new_tokens=2, do_sample=False)
+        _LOAD_INFO["compileMs"] = round((time.perf_counter() - t0) * 1000.0, 1)
+    except Exception as e:
+        # npr. nema C++ kompajlera na čvoru -> eager
+        model.forward = eager
+        print(f"HF torch.compile failed, using eager: {e}")
+        _LOAD_INFO.update({"runtime": "eager", "runtimeError": str(e)[:200]})
+
+
+def _prefix_entry(prefix: str):
+    """Return (ids, past_key_values, eval_ms) for the prefix, computing it once."""
+    import torch
+
+    with _PREFIX_LOCK:
+        entry = _PREFIX_CACHE.get(prefix)
+        if entry is not None:
+            _PREFIX_CACHE.move_to_end(prefix)
+            return entry, True
+        ids = _PROCESSOR(text=prefix, return_tensors="pt").to(_DEVICE)
+        t0 = time.perf_counter()
+        with torch.inference_mode():
+            out = _MODEL(**ids, use_cache=True)
+        entry = (ids["input_ids"], out.past_key_values, (time.perf_counter() - t0) * 1000.0)
+        _PREFIX_CACHE[prefix] = entry
+        while len(_PREFIX_CACHE) > _PREFIX_CACHE_MAX:
+            _PREFIX_CACHE.popitem(last=False)
+        return entry, False
+
+
+# ---------- generation ----------
+def _tokenizer():
+    return getattr(_PROCESSOR, "tokenizer", _PROCESSOR)
+
+
+def _gen_kwargs(max_new_tokens: int, temperature: float) -> Dict[str, Any]:
+    return {
+        "max_new_tokens": max_new_tokens,
+        "do_sample": True if temperature and temperature > 0 else False,
+        "temperature": float(temperature or 0.0),
+    }
+
+
+def _cancel_criteria(reqs: List["_Request"]):
+    """Per-row stop for requests whose caller gave up; the other rows of the batch go on."""
+    from transformers import StoppingCriteria
+    import torch
+
+    class _Cancelled(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            return torch.tensor([r.cancelled.is_set() for r in reqs], dtype=torch.bool, device=input_ids.device)
+
+    return _Cancelled()
+
+
+class JsonDepth:
+    """Brace/bracket depth of a generated JSON answer, fed piece by piece.
+
+    Text before the first '{' (a ```json fence, a sentence) is ignored; quotes and brackets
+    inside strings do not count. `closed` is set when the top-level object ends.
+    """
+    __slots__ = ("depth", "in_string", "escape", "closed")
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.closed = False
+
+    def feed(self, text: str) -> bool:
+        for ch in text:
+            if self.closed:
+                break
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif self.depth == 0:
+                if ch == "{":
+                    self.depth = 1
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+            elif ch in "}]":
+                self.depth -= 1
+                self.closed = self.depth == 0
+        return self.closed
+
+
+def _json_criteria(prompt_len: int, rows: int):
+    """Per-row stop once the row's JSON object closed; rows of a batch finish independently."""
+    from transformers import StoppingCriteria
+    import torch
+
+    tok = _tokenizer()
+
+    class _JsonClosed(StoppingCriteria):
+        def __init__(self):
+            self.pos = prompt_len
+            self.rows = [JsonDepth() for _ in range(rows)]
+
+        def __call__(self, input_ids, scores, **kwargs):
+            for row, depth in enumerate(self.rows):
+                if depth.closed:
+                    continue
+                for tid in input_ids[row, self.pos:].tolist():
+                    if depth.feed(tok.decode([tid], skip_special_tokens=True)):
+                        break
+            self.pos = input_ids.shape[1]
+            return torch.tensor([d.closed for d in self.rows], dtype=torch.bool, device=input_ids.device)
+
+    return _JsonClosed()
+
+
+def _stop_kwargs(reqs: List["_Request"], prompt_len: int) -> tuple:
+    """generate kwargs (streamer, stopping_criteria) for one call + the JSON criterion (or None)."""
+    from transformers import StoppingCriteriaList
+
+    kwargs: Dict[str, Any] = {}
+    criteria = [_cancel_criteria(reqs)]
+    json_stop = _json_criteria(prompt_len, len(reqs)) if _JSON_STOP else None
+    if json_stop is not None:
+        criteria.append(json_stop)
+    if len(reqs) == 1 and reqs[0].streamer is not None:
+        kwargs["streamer"] = reqs[0].streamer
+    kwargs["stopping_criteria"] = StoppingCriteriaList(criteria)
+    return kwargs, json_stop
+
+
+def _json_closed(json_stop, row: int) -> bool:
+    return bool(json_stop is not None and json_stop.rows[row].closed)
+
+
+def _prefix_for(req: "_Request") -> Optional[str]:
+    """req.prefix when the prefix KV cache can serve this prompt, else None."""
+    prefix = req.prefix
+    # ONNX Runtime model drži vlastiti format cachea -> bez prefiksa
+    if (req.kind != "text" or not prefix or not req.prompt.startswith(prefix) or len(req.prompt) <= len(prefix)
+            or os.getenv("HF_PREFIX_CACHE", "1").strip() == "0" or _LOAD_INFO.get("runtime") == "onnx"):
+        return None
+    return prefix
+
+
+def _repeat_cache(past, rows: int):
+    """Prefix KV cache (batch 1) repeated for `rows` rows; Cache objects in place, legacy tuples copied."""
+    if rows == 1:
+        return past
+    if hasattr(past, "batch_repeat_interleave"):
+        past.batch_repeat_interleave(rows)
+        return past
+    return tuple(tuple(t.repeat_interleave(rows, dim=0) for t in layer) for layer in past)
+
+
+def _prefix_batch(reqs: List["_Request"], prefix_ids, pad_id: int) -> Optional[Dict[str, Any]]:
+    """input_ids/attention_mask as [prefix][padding][suffix] rows, or None if a prompt does not
+    tokenize to the cached prefix followed by more tokens."""
+    import torch
+
+    n = prefix_ids.shape[0]
+    suffixes = []
+    for r in reqs:
+        ids = _PROCESSOR(text=r.prompt, return_tensors="pt")["input_ids"][0].to(prefix_ids.device)
+        if ids.shape[0] <= n or not torch.equal(ids[:n], prefix_ids):
+            return None
+        suffixes.append(ids[n:])
+    width = max(sfx.shape[0] for sfx in suffixes)
+    input_ids = torch.full((len(reqs), n + width), pad_id, dtype=prefix_ids.dtype, device=prefix_ids.device)
+    mask = torch.zeros_like(input_ids)
+    input_ids[:, :n] = prefix_ids
+    mask[:, :n] = 1
+    # padding između prefiksa i sufiksa: maska ga skriva, pozicije se računaju iz maske
+    for i, sfx in enumerate(suffixes):
+        input_ids[i, n + width - sfx.shape[0]:] = sfx
+        mask[i, n + width - sfx.shape[0]:] = 1
+    return {"input_ids": input_ids, "attention_mask": mask}
+
+
+def _run_text(req: "_Request") -> tuple:
+    """One text prompt; reuses the prefix KV cache when the prompt starts with req.prefix."""
     import torch
 
+    prompt, prefix = req.prompt, _prefix_for(req)
     inputs = _PROCESSOR(text=prompt, return_tensors="pt").to(_DEVICE)
+    input_ids = inputs["input_ids"]
+    gen_kwargs: Dict[str, Any] = {}
+    cached_tokens, saved_ms = 0, 0.0
+    if prefix:
+        (prefix_ids, past, eval_ms), hit = _prefix_entry(prefix)
+        n = prefix_ids.shape[1]
+        # tokenizacija preko granice prefiksa mora dati iste tokene, inače cache ne vrijedi
+        if n < input_ids.shape[1] and torch.equal(input_ids[0, :n], prefix_ids[0].to(input_ids.device)):
+            gen_kwargs["past_key_values"] = copy.deepcopy(past)  # generate mijenja cache in-place
+            cached_tokens = n
+            saved_ms = eval_ms if hit else 0.0
+    n_in = input_ids.shape[1]
+    stop_kwargs, json_stop = _stop_kwargs([req], n_in)
     with torch.inference_mode():
-        out = _MODEL.generate(
-            **inputs,
-            max_new_tokens=max_new_tokens,
-            do_sample=True if temperature and temperature > 0 else False,
-            temperature=float(temperature or 0.0),
-        )
-    return _PROCESSOR.decode(out[0], skip_special_tokens=True)
+        out = _MODEL.generate(**inputs, **gen_kwargs, **_gen_kwargs(req.max_new_tokens, req.temperature),
+                              **stop_kwargs)
+    stats = {
+        "prompt_tokens": int(n_in),
+        "cached_prompt_tokens": cached_tokens,
+        "prompt_eval_saved_ms": round(saved_ms, 1),
+        "completion_tokens": int(out.shape[1] - n_in),
+        "stopped_at_json": _json_closed(json_stop, 0),
+    }
+    return _PROCESSOR.decode(out[0, n_in:], skip_special_tokens=True), stats
 
 
-def generate_multimodal(prompt: str, images: List[str] | List[Image.Image], max_new_tokens: int = 512, temperature: float = 0.2) -> str:
-    _ensure_loaded()
+def _run_text_batch(reqs: List["_Request"]) -> List[tuple]:
+    """Several text prompts in one generate call. With a shared cached prefix (same batch key)
+    every row starts from the prefix KV cache; otherwise the full prompts are left-padded."""
     import torch
 
-    pil_images: List[Image.Image] = []
-    for im in images:
-        if isinstance(im, Image.Image):
-            pil_images.append(im)
-        else:
-            pil_images.append(_maybe_from_data_url(str(im)))
+    tok = _tokenizer()
+    if tok.pad_token_id is None:
+        tok.pad_token = tok.eos_token
+    # decoder-only: padding lijevo, da svi redovi nastavljaju generirati s istog mjesta
+    tok.padding_side = "left"
+    gen_kwargs: Dict[str, Any] = {}
+    cached_tokens, saved_ms = 0, 0.0
+    inputs = None
+    prefix = _prefix_for(reqs[0])
+    if prefix:
+        (prefix_ids, past, eval_ms), hit = _prefix_entry(prefix)
+        inputs = _prefix_batch(reqs, prefix_ids[0].to(_DEVICE), tok.pad_token_id)
+        if inputs is not None:
+            # generate mijenja cache in-place: kopija pa ponavljanje po redovima
+            gen_kwargs["past_key_values"] = _repeat_cache(copy.deepcopy(past), len(reqs))
+            cached_tokens = prefix_ids.shape[1]
+            saved_ms = eval_ms if hit else 0.0
+    if inputs is None:
+        inputs = _PROCESSOR(text=[r.prompt for r in reqs], padding=True, return_tensors="pt").to(_DEVICE)
+    n_in = inputs["input_ids"].shape[1]
+    stop_kwargs, json_stop = _stop_kwargs(reqs, n_in)
+    with torch.inference_mode():
+        out = _MODEL.generate(**inputs, pad_token_id=tok.pad_token_id, **gen_kwargs,
+                              **_gen_kwargs(reqs[0].max_new_tokens, reqs[0].temperature), **stop_kwargs)
+    results = []
+    for i in range(len(reqs)):
+        stats = {
+            "prompt_tokens": int(inputs["attention_mask"][i].sum()),
+            "cached_prompt_tokens": cached_tokens,
+            "prompt_eval_saved_ms": round(saved_ms, 1),
+            "completion_tokens": int((out[i, n_in:] != tok.pad_token_id).sum()),
+            "stopped_at_json": _json_closed(json_stop, i),
+        }
+        results.append((_PROCESSOR.decode(out[i, n_in:], skip_special_tokens=True), stats))
+    return results
+
 
-    inputs = _PROCESSOR(text=prompt, images=pil_images, return_tensors="pt").to(_DEVICE)
+def _run_multimodal(req: "_Request") -> tuple:
+    import torch
+
+    inputs, cache_hits = _process_images(req.prompt, req.images)
+    inputs = inputs.to(_DEVICE)
+    n_in = inputs["input_ids"].shape[1]
+    stop_kwargs, json_stop = _stop_kwargs([req], n_in)
     with torch.inference_mode():
-        out = _MODEL.generate(
-            **inputs,
-            max_new_tokens=max_new_tokens,
-            do_sample=True if temperature and temperature > 0 else False,
-            temperature=float(temperature or 0.0),
-        )
-    return _PROCESSOR.decode(out[0], skip_special_tokens=True)
+        out = _MODEL.generate(**inputs, **_gen_kwargs(req.max_new_tokens, req.temperature), **stop_kwargs)
+    stats = {"prompt_tokens": int(n_in),
+             "completion_tokens": int(out.shape[1] - n_in),
+             "stopped_at_json": _json_closed(json_stop, 0),
+             "image_cache_hits": cache_hits}
+    return _PROCESSOR.decode(out[0, n_in:], skip_special_tokens=True), stats
+
+
+# ---------- image feature cache ----------
+class _ImageFeatureCache:
+    """LRU of per-image processor outputs (dict of tensors), bounded by tensor bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[tuple, tuple]" = OrderedDict()   # key -> (features, bytes)
+        self._images: Dict[str, int] = {}                          # ključ sadržaja -> broj unosa
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: tuple, features: Dict[str, Any]) -> None:
+        size = sum(v.element_size() * v.nelement() for v in features.values() if hasattr(v, "element_size"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._forget(key, old[1])
+            self._data[key] = (features, size)
+            self._images[key[0]] = self._images.get(key[0], 0) + 1
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                evicted_key, (_, evicted) = self._data.popitem(last=False)
+                self._forget(evicted_key, evicted)
+
+    def _forget(self, key: tuple, size: int) -> None:
+        self.bytes -= size
+        n = self._images.get(key[0], 0) - 1
+        if n > 0:
+            self._images[key[0]] = n
+        else:
+            self._images.pop(key[0], None)
+
+    def contains(self, image_key: str) -> bool:
+        with self._lock:
+            return image_key in self._images
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._images.clear()
+            self.bytes = 0
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._data), "bytes": self.bytes, "maxBytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+
+_IMAGE_CACHE = _ImageFeatureCache(_IMAGE_CACHE_BYTES) if _IMAGE_CACHE_BYTES > 0 else None
+
+
+def image_cache_summary() -> Optional[Dict[str, Any]]:
+    return _IMAGE_CACHE.summary() if _IMAGE_CACHE is not None else None
+
+
+class _Uncacheable(Exception):
+    """The processor called its image processor in a way the per-image cache cannot serve."""
+
+
+def _image_key(im) -> str:
+    """Model ID + content hash (data URL payload, file bytes or pixels) + pre-resize setting."""
+    h = hashlib.sha256()
+    if isinstance(im, Image.Image):
+        h.update(f"{im.mode}:{im.size}".encode())
+        h.update(im.tobytes())
+    elif str(im).startswith("data:"):
+        s = str(im)
+        h.update(s[s.find(",") + 1:].encode("ascii", "ignore"))   # base64 bez dekodiranja
+    else:
+        with open(str(im), "rb") as f:
+            h.update(f.read())
+    return f"{_LOAD_INFO.get('modelId')}:{h.hexdigest()}:{int(_IMAGE_PRERESIZE)}"
+
+
+def _target_scale(ip, width: int, height: int) -> float:
+    """Downscale factor to the image processor's working resolution (1.0 = leave as is)."""
+    if not getattr(ip, "do_resize", True):
+        return 1.0
+    size = getattr(ip, "size", None)
+    size = size if isinstance(size, dict) else {}
+    max_pixels = getattr(ip, "max_pixels", None)
+    if max_pixels:
+        # Qwen2-VL: size je u pikselima (min/max_pixels), ne u rubovima
+        scale = math.sqrt(max_pixels / float(width * height))
+    elif size.get("height") and size.get("width"):
+        scale = max(size["height"] / height, size["width"] / width)
+    elif size.get("shortest_edge"):
+        scale = size["shortest_edge"] / min(width, height)
+    elif size.get("longest_edge"):
+        scale = size["longest_edge"] / max(width, height)
+    else:
+        return 1.0
+    return min(1.0, scale)
+
+
+def _to_pil(im, ip) -> Image.Image:
+    img = im.convert("RGB") if isinstance(im, Image.Image) else _maybe_from_data_url(str(im))
+    if _IMAGE_PRERESIZE and ip is not None:
+        scale = _target_scale(ip, *img.size)
+        if scale < 1.0:
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            # reducing_gap: PIL prvo cjelobrojno smanji (brzo), pa tek onda bicubic
+            img = img.resize(size, Image.BICUBIC, reducing_gap=2.0)
+    return img
+
+
+def _concat_features(parts: List[Dict[str, Any]]) -> Dict[str, Any]:
+    import torch
+    out: Dict[str, Any] = {}
+    for k in parts[0]:
+        vals = [p[k] for p in parts]
+        if isinstance(vals[0], torch.Tensor):
+            try:
+                out[k] = torch.cat(vals, dim=0)
+            except RuntimeError:
+                # npr. LLaVA-NeXT: broj patcheva se poravnava unutar batcha
+                raise _Uncacheable(k)
+        elif isinstance(vals[0], list):
+            out[k] = [x for v in vals for x in v]
+        else:
+            out[k] = vals[0]
+    return out
+
+
+class _CachingImageProcessor:
+    """Stands in for processor.image_processor during one call and serves each image from the cache."""
+
+    def __init__(self, inner, keys: Dict[int, str], placeholders: set):
+        self.inner = inner
+        self.keys = keys                  # id(PIL slike) -> ključ sadržaja
+        self.placeholders = placeholders  # id-evi 1x1 slika čiji su featurei već u cacheu
+        self.hits = 0
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def __call__(self, images=None, *args, **kwargs):
+        from transformers import BatchFeature
+
+        flat = list(images) if isinstance(images, (list, tuple)) else [images]
+        if args or not flat or any(id(im) not in self.keys for im in flat):
+            raise _Uncacheable("images")
+        kwargs["return_tensors"] = "pt"
+        sig = repr(sorted((k, repr(v)) for k, v in kwargs.items()))
+        parts = []
+        for im in flat:
+            key = (self.keys[id(im)], sig)
+            feats = _IMAGE_CACHE.get(key)
+            if feats is None:
+                if id(im) in self.placeholders:
+                    raise _Uncacheable("evicted")
+                feats = dict(self.inner(images=[im], **kwargs))
+                _IMAGE_CACHE.put(key, feats)
+            else:
+                self.hits += 1
+            parts.append(feats)
+        return BatchFeature(data=_concat_features(parts))
+
+
+def _process_images(prompt: str, images: list) -> tuple:
+    """Processor inputs for an image prompt -> (inputs, images served from the cache)."""
+    ip = getattr(_PROCESSOR, "image_processor", None)
+    if _IMAGE_CACHE is not None and ip is not None and images:
+        keys = [_image_key(im) for im in images]
+        pil: List[Image.Image] = []
+        placeholders = set()
+        for im, key in zip(images, keys):
+            if _IMAGE_CACHE.contains(key):
+                # sadržaj dolazi iz cachea; procesoru treba samo slika za broj/tip
+                img = Image.new("RGB", (1, 1))
+                placeholders.add(id(img))
+            else:
+                img = _to_pil(im, ip)
+            pil.append(img)
+        wrapper = _CachingImageProcessor(ip, {id(p): k for p, k in zip(pil, keys)}, placeholders)
+        _PROCESSOR.image_processor = wrapper
+        try:
+            return _PROCESSOR(text=prompt, images=pil, return_tensors="pt"), wrapper.hits
+        except _Uncacheable:
+            pass   # procesor ovog modela -> bez cachea
+        except Exception:
+            if not placeholders:
+                raise
+            # procesor je sam pregledao 1x1 placeholder (npr. provjera veličine) -> bez cachea
+        finally:
+            _PROCESSOR.image_processor = ip
+    return _PROCESSOR(text=prompt, images=[_to_pil(im, ip) for im in images], return_tensors="pt"), 0
+
+
+# ---------- scheduler ----------
+class _Request:
+    __slots__ = ("kind", "prompt", "images", "max_new_tokens", "temperature", "prefix", "future", "enqueued",
+                 "streamer", "cancelled")
+
+    def __init__(self, kind: str, prompt: str, max_new_tokens: int, temperature: float,
+                 prefix: Optional[str] = None, images: Optional[list] = None, streamer=None):
+        self.kind = kind                  # 'text' | 'multimodal'
+        self.prompt = prompt
+        self.images = images or []
+        self.max_new_tokens = int(max_new_tokens)
+        self.temperature = float(temperature or 0.0)
+        self.prefix = prefix
+        self.future: Future = Future()
+        self.enqueued = time.monotonic()
+        self.streamer = streamer          # TextIteratorStreamer -> uvijek sam u generate pozivu
+        self.cancelled = threading.Event()
+
+    @property
+    def batch_key(self) -> Optional[tuple]:
+        # u isti batch idu samo tekstualni promptovi s istim postavkama generiranja i istim
+        # prefiksom, da cijeli batch krene od istog KV cachea
+        if self.kind != "text" or self.streamer is not None:
+            return None
+        return (self.max_new_tokens, self.temperature, _prefix_for(self))
+
+
+class _Scheduler:
+    """Request queue + one worker thread that owns every generate call."""
+
+    def __init__(self, max_batch: int, max_wait_s: float, len_ratio: float):
+        self.max_batch = max_batch
+        self.max_wait_s = max_wait_s
+        self.len_ratio = len_ratio
+        self._cond = threading.Condition()
+        self._queue: List[_Request] = []
+        self._thread: Optional[threading.Thread] = None
+        self.batches = 0
+        self.requests = 0
+        self.batched_requests = 0
+        self.largest_batch = 0
+        self.busy_s = 0.0
+        self.completion_tokens = 0
+
+    def enqueue(self, req: _Request) -> Future:
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="hf-scheduler", daemon=True)
+                self._thread.start()
+            self._queue.append(req)
+            self._cond.notify_all()
+        return req.future
+
+    def submit(self, req: _Request, cancel_check: Optional[Callable[[], None]] = None) -> tuple:
+        """Enqueue and wait; cancel_check is called every half second while waiting, and if it
+        raises the request is cancelled (dropped from the queue, or its row stops generating)."""
+        if cancel_check is not None:
+            cancel_check()
+        future = self.enqueue(req)
+        while True:
+            try:
+                return future.result(timeout=0.5 if cancel_check is not None else None)
+            except FutureTimeout:
+                try:
+                    cancel_check()
+                except BaseException:
+                    req.cancelled.set()
+                    raise
+
+    def _compatible(self, head: _Request) -> List[_Request]:
+        if head.batch_key is None or self.max_batch <= 1:
+            return [head]
+        n = max(1, len(head.prompt))
+        out = [head]
+        for r in self._queue:
+            if r is head or r.batch_key != head.batch_key:
+                continue
+            m = max(1, len(r.prompt))   # duljina u znakovima je dovoljna za grupiranje
+            if max(n, m) / min(n, m) <= self.len_ratio:
+                out.append(r)
+                if len(out) >= self.max_batch:
+                    break
+        return out
+
+    def _take(self) -> List[_Request]:
+        with self._cond:
+            while True:
+                # odustali zahtjevi iz reda ne zauzimaju mjesto u batchu
+                for r in [r for r in self._queue if r.cancelled.is_set()]:
+                    self._queue.remove(r)
+                    r.future.set_exception(RuntimeError("cancelled before generation"))
+                if self._queue:
+                    break
+                self._cond.wait()
+            head = self._queue[0]
+            batch = self._compatible(head)
+            if head.batch_key is not None and self.max_batch > 1:
+                deadline = head.enqueued + self.max_wait_s
+                while len(batch) < self.max_batch:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._cond.wait(left)
+                    batch = self._compatible(head)
+            for r in batch:
+                self._queue.remove(r)
+            return batch
+
+    def _run(self, batch: List[_Request]) -> List[tuple]:
+        if batch[0].kind == "multimodal":
+            return [_run_multimodal(batch[0])]
+        if len(batch) == 1:
+            return [_run_text(batch[0])]
+        try:
+            return _run_text_batch(batch)
+        except Exception:
+            # npr. OOM zbog većeg batcha: isti zahtjevi jedan po jedan
+            return [_run_text(r) for r in batch]
+
+    def _loop(self) -> None:
+        while True:
+            batch = self._take()
+            for r in batch:
+                if r.cancelled.is_set():
+                    # pozivatelj je odustao dok je batch čekao na druge zahtjeve
+                    r.future.set_exception(RuntimeError("cancelled before generation"))
+            batch = [r for r in batch if not r.cancelled.is_set()]
+            if not batch:
+                continue
+            started = time.monotonic()
+            try:
+                results = self._run(batch)
+            except BaseException as e:
+                for r in batch:
+                    if r.streamer is not None:
+                        r.streamer.end()      # iterator potrošača inače čeka zauvijek
+                    r.future.set_exception(e)
+                continue
+            busy = time.monotonic() - started
+            with self._cond:
+                self.batches += 1
+                self.requests += len(batch)
+                self.batched_requests += len(batch) if len(batch) > 1 else 0
+                self.largest_batch = max(self.largest_batch, len(batch))
+                self.busy_s += busy
+                self.completion_tokens += sum(st.get("completion_tokens", 0) for _, st in results)
+            for r, (text, stats) in zip(batch, results):
+                if r.cancelled.is_set():
+                    r.future.set_exception(RuntimeError("cancelled during generation"))
+                    continue
+                stats = dict(stats, batch_size=len(batch), queue_ms=round((started - r.enqueued) * 1000.0, 1))
+                r.future.set_result((text, stats))
+
+    def summary(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "maxBatch": self.max_batch,
+                "waitMs": round(self.max_wait_s * 1000.0, 1),
+                "queued": len(self._queue),
+                "batches": self.batches,
+                "requests": self.requests,
+                "batchedRequests": self.batched_requests,
+                "largestBatch": self.largest_batch,
+                "avgBatch": round(self.requests / self.batches, 2) if self.batches else None,
+                "completionTokensPerS": round(self.completion_tokens / self.busy_s, 1) if self.busy_s > 0 else None,
+            }
+
+
+_SCHEDULER = _Scheduler(_BATCH_MAX, _BATCH_WAIT_S, _BATCH_LEN_RATIO)
+
+
+def scheduler_summary() -> Dict[str, Any]:
+    return _SCHEDULER.summary()
+
+
+def generate_text_only(prompt: str, max_new_tokens: int = 512, temperature: float = 0.2,
+                       prefix: Optional[str] = None, stats: Optional[Dict[str, Any]] = None,
+                       cancel_check: Optional[Callable[[], None]] = None) -> str:
+    """Text generation. If `prompt` starts with the static `prefix`, the prefix KV cache is reused,
+    also when the prompt is batched with others that share the prefix.
+
+    `stats` (optional dict) is filled with prompt_tokens, cached_prompt_tokens,
+    prompt_eval_saved_ms, completion_tokens, batch_size and queue_ms. `cancel_check` is called
+    while waiting; whatever it raises is re-raised here after the request is cancelled.
+    """
+    _ensure_loaded()
+    text, st = _SCHEDULER.submit(_Request("text", prompt, max_new_tokens, temperature, prefix=prefix), cancel_check)
+    if stats is not None:
+        stats.update(st)
+    return text
+
+
+def generate_multimodal(prompt: str, images: List[str] | List[Image.Image], max_new_tokens: int = 512, temperature: float = 0.2,
+                        stats: Optional[Dict[str, Any]] = None, cancel_check: Optional[Callable[[], None]] = None) -> str:
+    _ensure_loaded()
+    text, st = _SCHEDULER.submit(_Request("multimodal", prompt, max_new_tokens, temperature, images=list(images or [])),
+                                 cancel_check)
+    if stats is not None:
+        stats.update(st)
+    return text
+
+
+def stream_generate(prompt: str, images: Optional[list] = None, max_new_tokens: int = 512,
+                    temperature: float = 0.2, prefix: Optional[str] = None,
+                    stats: Optional[Dict[str, Any]] = None,
+                    cancel_check: Optional[Callable[[], None]] = None) -> Iterator[str]:
+    """Yield generated text pieces (prompt excluded) as they are decoded.
+
+    Runs on the scheduler thread like the other calls, never batched. `cancel_check` is called
+    between pieces; if it raises, or the caller stops iterating, generation stops at the next
+    token. `stats` is filled when the generation has finished.
+    """
+    _ensure_loaded()
+    from transformers import TextIteratorStreamer
+
+    # timeout: i dok zahtjev čeka u redu, cancel_check se poziva svakih pola sekunde
+    streamer = TextIteratorStreamer(_tokenizer(), skip_prompt=True, skip_special_tokens=True, timeout=0.5)
+    kind = "multimodal" if images else "text"
+    req = _Request(kind, prompt, max_new_tokens, temperature, prefix=prefix, images=list(images or []),
+                   streamer=streamer)
+    future = _SCHEDULER.enqueue(req)
+    try:
+        while True:
+            try:
+                piece = next(streamer)
+            except queue.Empty:
+                piece = ""
+            except StopIteration:
+                break
+            if cancel_check is not None:
+                cancel_check()
+            if piece:
+                yield piece
+        _, st = future.result()
+        if stats is not None:
+            stats.update(st)
+    finally:
+        req.cancelled.set()
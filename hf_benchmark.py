@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the hf_backend inference profiles: time to first token and decode tokens/s
+
+Each profile loads the model through hf_backend (the same code path as agent_server with
+LLM_BACKEND=hf), runs a warm-up, then per run one generation of a single token (time to first
+token: prompt evaluation + first step) and one of `--max-new-tokens`; decode tokens/s is the
+difference of the two. Profiles:
+  default      stock eager PyTorch (HF_PROFILE=default)
+  cpu-fp32     CPU threads set, no quantization
+  cpu          CPU threads + dynamic int8 Linear layers
+  cpu-compile  cpu + torch.compile (inductor cache in HF_COMPILE_CACHE)
+  cpu-onnx     ONNX Runtime export cached in HF_COMPILE_CACHE (needs optimum[onnxruntime])
+
+JSON early stop and the prefix cache are off, so every run generates the same number of tokens.
+With --tiny DIR a small random Llama model (and tokenizer) is created in DIR first, so the
+benchmark runs offline; the absolute numbers are then only comparable between profiles.
+
+With --concurrency N, each profile is also measured under load: N clients submit prompts that
+share the static prefix at the same moment, once per scheduler mode:
+  serial        HF_BATCH_MAX=1, no prefix cache (one generate call per client)
+  batch         --batch-max prompts per generate call, prompts evaluated in full
+  batch+prefix  the same batches starting from the cached prefix KV
+reported as wall time, median/max client latency, completion tokens/s and average batch size.
+
+Usage:
+  python hf_benchmark.py --tiny /tmp/tiny-llama
+  python hf_benchmark.py --tiny /tmp/tiny-llama --profiles cpu --concurrency 8
+  python hf_benchmark.py --model D:\\models\\Qwen2.5-0.5B-Instruct --profiles default,cpu,cpu-compile --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+PROFILES = {
+    "default": {"HF_PROFILE": "default"},
+    "cpu-fp32": {"HF_PROFILE": "cpu", "HF_CPU_QUANTIZE": "0", "HF_CPU_RUNTIME": "eager"},
+    "cpu": {"HF_PROFILE": "cpu", "HF_CPU_QUANTIZE": "1", "HF_CPU_RUNTIME": "eager"},
+    "cpu-compile": {"HF_PROFILE": "cpu", "HF_CPU_QUANTIZE": "1", "HF_CPU_RUNTIME": "compile"},
+    "cpu-onnx": {"HF_PROFILE": "cpu", "HF_CPU_RUNTIME": "onnx"},
+}
+
+PREFIX = ("Extract the JSON (documentType, documentNumber, date, supplier, buyer, items, totals) "
+          "from this invoice text:\n")
+PROMPT = PREFIX + "RAČUN br. 125-1-1\nDatum: 02.01.2025.\nUkupno: 1.250,00 EUR\n"
+
+# mode -> (prompts per generate call; None = --batch-max, HF_PREFIX_CACHE)
+CONCURRENCY_MODES = {"serial": (1, "0"), "batch": (None, "0"), "batch+prefix": (None, "1")}
+
+
+def make_tiny_model(path: str) -> str:
+    """Random 6-layer Llama (~45M parameters, so int8 matmuls matter) with a byte-level BPE
+    tokenizer trained on a few lines; no download needed."""
+    if os.path.isfile(os.path.join(path, "config.json")):
+        return path
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    tok = Tokenizer(models.BPE())
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=2000, special_tokens=["<s>", "</s>", "<pad>"],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tok.train_from_iterator([PROMPT * 20, json.dumps({"documentType": "invoice", "items": [], "totals": {}})],
+                            trainer=trainer)
+    fast = PreTrainedTokenizerFast(tokenizer_object=tok, bos_token="<s>", eos_token="</s>", pad_token="<pad>",
+                                   model_input_names=["input_ids", "attention_mask"])
+    cfg = LlamaConfig(vocab_size=fast.vocab_size, hidden_size=768, intermediate_size=2048, num_hidden_layers=6,
+                      num_attention_heads=12, num_key_value_heads=12, max_position_embeddings=1024,
+                      bos_token_id=fast.bos_token_id, eos_token_id=fast.eos_token_id,
+                      pad_token_id=fast.pad_token_id)
+    model = LlamaForCausalLM(cfg)
+    # bez EOS-a: random model bi inače stao nasumično, a mjeri se uvijek isti broj tokena
+    model.generation_config.eos_token_id = None
+    model.save_pretrained(path)
+    fast.save_pretrained(path)
+    return path
+
+
+def run_profile(hb, name: str, runs: int, max_new_tokens: int) -> dict:
+    os.environ.update(PROFILES[name])
+    hb.unload()
+    info = hb.load_model()
+    if info.get("state") != "ready":
+        return {"profile": name, "error": info.get("error")}
+    hb.generate_text_only(PROMPT, max_new_tokens=4, temperature=0.0)   # warm-up
+    ttft, tps = [], []
+    for _ in range(runs):
+        # streamer šalje tekst tek na granici riječi, pa se prvi token mjeri zasebnim pozivom
+        t0 = time.perf_counter()
+        hb.generate_text_only(PROMPT, max_new_tokens=1, temperature=0.0)
+        first = time.perf_counter() - t0
+        stats = {}
+        t0 = time.perf_counter()
+        hb.generate_text_only(PROMPT, max_new_tokens=max_new_tokens, temperature=0.0, stats=stats)
+        total = time.perf_counter() - t0
+        ttft.append(first * 1000.0)
+        tokens = stats.get("completion_tokens") or 0
+        if tokens > 1 and total > first:
+            tps.append((tokens - 1) / (total - first))
+    info = hb.load_info()
+    return {
+        "profile": name,
+        "runtime": info.get("runtime"),
+        "quantized": bool(info.get("quantized")),
+        "threads": info.get("threads"),
+        "loadMs": info.get("loadMs"),
+        "compileMs": info.get("compileMs"),
+        "ttftMs": round(statistics.median(ttft), 1),
+        "tokensPerS": round(statistics.median(tps), 1) if tps else None,
+        "runtimeError": info.get("runtimeError"),
+    }
+
+
+def run_concurrency(hb, name: str, clients: int, batch_max: int, max_new_tokens: int) -> list:
+    """`clients` threads submit at once (one barrier), per scheduler mode; the model is already loaded."""
+    prompts = [PREFIX + f"RAČUN br. {100 + i}-1-1\nDatum: {1 + i % 28:02d}.01.2025.\nUkupno: {1250 + i},00 EUR\n"
+               for i in range(clients)]
+    sched = hb._SCHEDULER
+    saved = sched.max_batch, os.environ.get("HF_PREFIX_CACHE")
+    results = []
+    try:
+        for mode, (per_call, prefix_cache) in CONCURRENCY_MODES.items():
+            sched.max_batch = per_call or batch_max
+            os.environ["HF_PREFIX_CACHE"] = prefix_cache
+            hb.generate_text_only(prompts[0], max_new_tokens=1, temperature=0.0, prefix=PREFIX)   # warm-up, prefix KV
+            barrier = threading.Barrier(clients + 1)
+            latency = [0.0] * clients
+            stats = [{} for _ in range(clients)]
+
+            def client(i: int) -> None:
+                barrier.wait()
+                t0 = time.perf_counter()
+                hb.generate_text_only(prompts[i], max_new_tokens=max_new_tokens, temperature=0.0, prefix=PREFIX,
+                                      stats=stats[i])
+                latency[i] = (time.perf_counter() - t0) * 1000.0
+
+            threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+            for t in threads:
+                t.start()
+            barrier.wait()
+            t0 = time.perf_counter()
+            for t in threads:
+                t.join()
+            wall = time.perf_counter() - t0
+            tokens = sum(st.get("completion_tokens") or 0 for st in stats)
+            results.append({
+                "profile": name,
+                "mode": mode,
+                "clients": clients,
+                "wallMs": round(wall * 1000.0, 1),
+                "p50Ms": round(statistics.median(latency), 1),
+                "maxMs": round(max(latency), 1),
+                "tokensPerS": round(tokens / wall, 1) if wall > 0 else None,
+                "avgBatch": round(statistics.mean(st.get("batch_size") or 1 for st in stats), 2),
+                "cachedPromptTokens": stats[0].get("cached_prompt_tokens"),
+            })
+    finally:
+        sched.max_batch = saved[0]
+        if saved[1] is None:
+            os.environ.pop("HF_PREFIX_CACHE", None)
+        else:
+            os.environ["HF_PREFIX_CACHE"] = saved[1]
+    return results
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="hf_backend profile benchmark")
+    ap.add_argument("--model", default=os.getenv("HF_MODEL_ID"), help="local model directory or hub ID (default: HF_MODEL_ID)")
+    ap.add_argument("--tiny", metavar="DIR", help="create (once) and use a tiny random model in DIR")
+    ap.add_argument("--profiles", default="default,cpu-fp32,cpu,cpu-compile,cpu-onnx")
+    ap.add_argument("--runs", type=int, default=3)
+    ap.add_argument("--max-new-tokens", type=int, default=64)
+    ap.add_argument("--concurrency", type=int, default=0, metavar="N",
+                    help="also run N simultaneous clients per scheduler mode (0 = off)")
+    ap.add_argument("--batch-max", type=int, default=4, help="prompts per generate call in the batch modes")
+    ap.add_argument("--json", action="store_true", help="print results as JSON")
+    args = ap.parse_args()
+
+    if args.tiny:
+        args.model = make_tiny_model(args.tiny)
+    if not args.model:
+        ap.error("--model or --tiny is required")
+    unknown = [p for p in args.profiles.split(",") if p not in PROFILES]
+    if unknown:
+        ap.error(f"unknown profiles: {', '.join(unknown)} (known: {', '.join(PROFILES)})")
+
+    # hf_backend čita ove varijable pri importu
+    os.environ.update({"HF_MODEL_ID": args.model, "HF_JSON_STOP": "0", "HF_PREFIX_CACHE": "0",
+                       "HF_BATCH_MAX": "1"})
+    import hf_backend
+
+    results = []
+    for name in args.profiles.split(","):
+        try:
+            results.append(run_profile(hf_backend, name, args.runs, args.max_new_tokens))
+        except Exception as e:
+            results.append({"profile": name, "error": str(e)[:200]})
+        r = results[-1]
+        if not args.json:
+            if r.get("error"):
+                print(f"{name:12s} error: {r['error']}")
+            else:
+                print(f"{name:12s} runtime={r['runtime']:8s} int8={'yes' if r['quantized'] else 'no ':3s} "
+                      f"threads={r['threads']}  load={r['loadMs']:.0f} ms  ttft={r['ttftMs']:.1f} ms  "
+                      f"{r['tokensPerS'] or 0:.1f} tok/s" + (f"  ({r['runtimeError']})" if r.get("runtimeError") else ""))
+            sys.stdout.flush()
+        if args.concurrency > 0 and not r.get("error"):
+            try:
+                rows = run_concurrency(hf_backend, name, args.concurrency, args.batch_max, args.max_new_tokens)
+            except Exception as e:
+                rows = [{"profile": name, "mode": "concurrency", "error": str(e)[:200]}]
+            results.extend(rows)
+            if not args.json:
+                for c in rows:
+                    if c.get("error"):
+                        print(f"  {c['mode']:12s} error: {c['error']}")
+                    else:
+                        print(f"  {c['mode']:12s} clients={c['clients']}  wall={c['wallMs']:.0f} ms  "
+                              f"p50={c['p50Ms']:.0f} ms  max={c['maxMs']:.0f} ms  {c['tokensPerS'] or 0:.1f} tok/s  "
+                              f"batch={c['avgBatch']:.2f}  cached={c['cachedPromptTokens']}")
+                sys.stdout.flush()
+    if args.json:
+        print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+"""
+Durable job queue for asynchronous analyses (SQLite, WAL)
+
+- enqueue() stores the upload, its form parameters and an optional callback URL; the job ID is
+  returned at once so the client does not hold a connection open for the analysis
+- lease() hands the oldest runnable job to a worker for `visibility_s` seconds; a worker that
+  dies (or hangs) without heartbeat() lets the lease expire and the job is delivered again
+- fail(retry=True) puts the job back with exponential backoff until max_attempts, then it is
+  failed for good; complete() stores the result; expire_leases() fails jobs whose last attempt
+  lost its lease
+- A job that is done or failed for good drops its upload (file becomes an empty blob; the
+  column is NOT NULL in existing databases); purge() deletes finished jobs past a retention TTL
+- claim_callback() hands a finished job with a callback URL to one sender (any node), so the
+  callback is sent once, also for jobs failed by expire_leases()
+- Every state change is a single transaction (BEGIN IMMEDIATE), so several processes on one
+  box (API node + headless workers) can share the same database file
+- Worker nodes report in the `nodes` table (node_beat); /agent/health lists them with their
+  running jobs, and a node whose beat is older than `stale_s` is shown as not alive
+
+Usage from agent_server:
+  q = JobQueue("jobs.sqlite")
+  job_id = q.enqueue(file_bytes, "invoice.pdf", "application/pdf", {"max_pages": 3}, callback_url=None)
+  job = q.lease("worker-1", visibility_s=600)      # -> Job | None
+  q.heartbeat(job.id, "worker-1", 600); q.complete(job.id, "worker-1", result)
+"""
+
+from __future__ import annotations
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,                 -- queued | running | done | failed
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    available_at REAL NOT NULL,           -- queued jobs run from this time on (retry backoff)
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    lease_until REAL,
+    worker TEXT,
+    filename TEXT,
+    content_type TEXT,
+    params TEXT NOT NULL,
+    file BLOB NOT NULL,                   -- prazan kad je posao završen (done / failed)
+    result TEXT,
+    error TEXT,
+    callback_url TEXT,
+    callback_status TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_runnable ON jobs (status, available_at);
+CREATE INDEX IF NOT EXISTS jobs_lease ON jobs (status, lease_until);
+CREATE INDEX IF NOT EXISTS jobs_callback ON jobs (callback_status) WHERE callback_url IS NOT NULL;
+CREATE TABLE IF NOT EXISTS nodes (
+    id TEXT PRIMARY KEY,
+    host TEXT,
+    pid INTEGER,
+    workers INTEGER,
+    started REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    running TEXT                          -- JSON lista ID-eva poslova u obradi
+);
+"""
+
+
+class Job:
+    __slots__ = ("id", "attempts", "max_attempts", "filename", "content_type", "params", "file_bytes",
+                 "callback_url")
+
+    def __init__(self, row: sqlite3.Row):
+        self.id = row["id"]
+        self.attempts = row["attempts"]
+        self.max_attempts = row["max_attempts"]
+        self.filename = row["filename"]
+        self.content_type = row["content_type"]
+        self.params = json.loads(row["params"])
+        self.file_bytes = row["file"]
+        self.callback_url = row["callback_url"]
+
+
+class JobQueue:
+    def __init__(self, path: str, max_attempts: int = 3, backoff_s: float = 5.0):
+        self.path = path
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff_s = float(backoff_s)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30.0)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+
+    def _tx(self, fn):
+        """Run fn(db) in one write transaction (other processes wait on the file lock)."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                out = fn(self._db)
+                self._db.execute("COMMIT")
+                return out
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    # --- producer ---
+    def enqueue(self, file_bytes: bytes, filename: Optional[str], content_type: Optional[str],
+                params: Dict[str, Any], callback_url: Optional[str] = None) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._tx(lambda db: db.execute(
+            "INSERT INTO jobs (id, status, created, updated, available_at, max_attempts, filename, content_type,"
+            " params, file, callback_url) VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, now, now, now, self.max_attempts, filename, content_type,
+             json.dumps(params, ensure_ascii=False), sqlite3.Binary(file_bytes), callback_url)))
+        return job_id
+
+    # --- consumer ---
+    def expire_leases(self) -> List[str]:
+        """Fail running jobs whose lease expired on their last attempt; returns their IDs."""
+        now = time.time()
+        rows = self._tx(lambda db: db.execute(
+            "UPDATE jobs SET status = 'failed', updated = ?, worker = NULL, lease_until = NULL, file = x'',"
+            " error = COALESCE(error, 'lease expired') "
+            "WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts RETURNING id",
+            (now, now)).fetchall())
+        return [r["id"] for r in rows]
+
+    def lease(self, worker: str, visibility_s: float) -> Optional[Job]:
+        def take(db):
+            now = time.time()
+            row = db.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, lease_until = ?, updated = ? "
+                "WHERE id = (SELECT id FROM jobs WHERE (status = 'queued' AND available_at <= ?)"
+                "            OR (status = 'running' AND lease_until < ? AND attempts < max_attempts)"
+                "            ORDER BY created LIMIT 1) "
+                "RETURNING *", (worker, now + visibility_s, now, now, now)).fetchone()
+            return Job(row) if row is not None else None
+        return self._tx(take)
+
+    def heartbeat(self, job_id: str, worker: str, visibility_s: float) -> bool:
+        """Extend the lease; False if the job is no longer ours (expired and re-delivered)."""
+        now = time.time()
+        cur = self._tx(lambda db: db.execute(
+            "UPDATE jobs SET lease_until = ?, updated = ? WHERE id = ? AND worker = ? AND status = 'running'",
+            (now + visibility_s, now, job_id, worker)))
+        return cur.rowcount == 1
+
+    def complete(self, job_id: str, worker: str, result: Dict[str, Any]) -> bool:
+        cur = self._tx(lambda db: db.execute(
+            "UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_until = NULL, file = x'', updated = ? "
+            "WHERE id = ? AND worker = ? AND status = 'running'",
+            (json.dumps(result, ensure_ascii=False), time.time(), job_id, worker)))
+        return cur.rowcount == 1
+
+    def fail(self, job_id: str, worker: str, error: str, retry: bool = True) -> Optional[str]:
+        """Record a failed attempt; returns the new status (queued / failed) or None if not ours."""
+        def upd(db):
+            row = db.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ? AND worker = ? AND status = 'running'",
+                             (job_id, worker)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if retry and row["attempts"] < row["max_attempts"]:
+                delay = self.backoff_s * (2 ** (row["attempts"] - 1))
+                db.execute("UPDATE jobs SET status = 'queued', error = ?, worker = NULL, lease_until = NULL,"
+                           " available_at = ?, updated = ? WHERE id = ?", (error[:1000], now + delay, now, job_id))
+                return "queued"
+            db.execute("UPDATE jobs SET status = 'failed', error = ?, lease_until = NULL, file = x'', updated = ?"
+                       " WHERE id = ?", (error[:1000], now, job_id))
+            return "failed"
+        return self._tx(upd)
+
+    def release(self, job_id: str, worker: str) -> None:
+        """Give a leased job back without counting the attempt (graceful shutdown)."""
+        now = time.time()
+        self._tx(lambda db: db.execute(
+            "UPDATE jobs SET status = 'queued', attempts = MAX(0, attempts - 1), worker = NULL, lease_until = NULL,"
+            " available_at = ?, updated = ? WHERE id = ? AND worker = ? AND status = 'running'",
+            (now, now, job_id, worker)))
+
+    def purge(self, retention_s: float) -> int:
+        """Delete done/failed jobs last updated more than retention_s ago; returns the number deleted."""
+        cur = self._tx(lambda db: db.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?", (time.time() - retention_s,)))
+        return cur.rowcount
+
+    # --- callbacks ---
+    def claim_callback(self, hold_s: float) -> Optional[tuple]:
+        """(job_id, callback_url) of a finished job whose callback is not sent yet, or None.
+
+        The claim marks the job 'sending' for hold_s seconds (lease_until is unused once a job is
+        finished); a sender that dies meanwhile lets the claim expire and another node sends it.
+        """
+        def take(db):
+            now = time.time()
+            row = db.execute(
+                "UPDATE jobs SET callback_status = 'sending', lease_until = ? "
+                "WHERE id = (SELECT id FROM jobs WHERE callback_url IS NOT NULL AND status IN ('done', 'failed')"
+                "            AND (callback_status IS NULL OR (callback_status = 'sending' AND lease_until < ?))"
+                "            ORDER BY updated LIMIT 1) "
+                "RETURNING id, callback_url", (now + hold_s, now)).fetchone()
+            return (row["id"], row["callback_url"]) if row is not None else None
+        return self._tx(take)
+
+    def set_callback_status(self, job_id: str, status: str) -> None:
+        self._tx(lambda db: db.execute("UPDATE jobs SET callback_status = ?, lease_until = NULL WHERE id = ?",
+                                       (status[:200], job_id)))
+
+    # --- status ---
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, status, created, updated, attempts, max_attempts, filename, result, error, callback_url,"
+                " callback_status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row["id"],
+            "status": row["status"],
+            "filename": row["filename"],
+            "createdAt": row["created"],
+            "updatedAt": row["updated"],
+            "attempts": row["attempts"],
+            "maxAttempts": row["max_attempts"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "callbackStatus": row["callback_status"],
+        }
+
+    # --- worker nodes ---
+    def node_beat(self, node_id: str, host: str, pid: int, workers: int, running: List[str]) -> None:
+        now = time.time()
+        self._tx(lambda db: db.execute(
+            "INSERT INTO nodes (id, host, pid, workers, started, last_seen, running) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET workers = excluded.workers, last_seen = excluded.last_seen,"
+            " running = excluded.running", (node_id, host, pid, workers, now, now, json.dumps(running))))
+
+    def remove_node(self, node_id: str) -> None:
+        self._tx(lambda db: db.execute("DELETE FROM nodes WHERE id = ?", (node_id,)))
+
+    def purge_nodes(self, stale_s: float) -> None:
+        """Drop rows silent for 10x stale_s (crashed nodes); called from the node heartbeat thread."""
+        self._tx(lambda db: db.execute("DELETE FROM nodes WHERE last_seen < ?", (time.time() - 10 * stale_s,)))
+
+    def nodes(self, stale_s: float) -> List[Dict[str, Any]]:
+        """Known worker nodes (plain read); rows silent for 10x stale_s are left out."""
+        now = time.time()
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM nodes WHERE last_seen >= ? ORDER BY id",
+                                    (now - 10 * stale_s,)).fetchall()
+        return [{"id": r["id"], "host": r["host"], "pid": r["pid"], "workers": r["workers"],
+                 "alive": now - r["last_seen"] <= stale_s, "lastSeenS": round(now - r["last_seen"], 1),
+                 "running": json.loads(r["running"] or "[]")} for r in rows]
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows: List[sqlite3.Row] = self._db.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {r["status"]: r["n"] for r in rows}
@@ -0,0 +1,199 @@
+"""
+Pool of OpenAI-compatible (llama.cpp) endpoints with health-aware routing
+
+- A role (text / vision) is configured with a comma-separated list of base URLs
+- Each call goes to the healthy endpoint with the fewest outstanding requests
+- Consecutive failures open a circuit breaker that ejects the endpoint; after a
+  cooldown an active probe (GET /v1/models) decides whether it is reintroduced
+- Optional affinity keys pin a conversation to one endpoint so the server-side
+  KV cache of the shared prefix gets reused
+- check() runs the probe from a background task; its result (last-checked time,
+  recent latency) is cached for /agent/health and drives ejection, so calls to a
+  known-down role fail fast instead of waiting for the HTTP timeout
+
+Usage from agent_server:
+  TEXT_POOL = EndpointPool("text", os.getenv("TEXT_LLM_URL"))
+  ep = TEXT_POOL.acquire(affinity="conv-1")
+  try: ... requests.post(ep.url + "/v1/chat/completions", ...)
+  finally: TEXT_POOL.release(ep, ok=True)
+"""
+
+from __future__ import annotations
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Union
+
+import requests
+
+
+class NoHealthyEndpoint(RuntimeError):
+    """Every endpoint of the pool is currently ejected."""
+
+
+def split_urls(value: Optional[str]) -> List[str]:
+    """'http://a:8000, http://b:8000' -> ['http://a:8000', 'http://b:8000']"""
+    return [u.strip().rstrip("/") for u in (value or "").split(",") if u.strip()]
+
+
+def probe_endpoint(url: str, timeout: float = 3.0) -> bool:
+    try:
+        r = requests.get(url.rstrip("/") + "/v1/models", timeout=timeout)
+        return bool(r.ok)
+    except Exception:
+        return False
+
+
+class Endpoint:
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0          # in-flight requests
+        self.failures = 0             # consecutive failures (circuit breaker counter)
+        self.ejected_at: Optional[float] = None
+        self.probing = False
+        self.total = 0
+        self.errors = 0
+        # cached probe state (background health checks)
+        self.reachable: Optional[bool] = None
+        self.last_checked: Optional[float] = None   # wall-clock time.time()
+        self.latencies_ms: deque = deque(maxlen=20)
+
+    @property
+    def healthy(self) -> bool:
+        return self.ejected_at is None
+
+    def snapshot(self) -> Dict[str, Any]:
+        lat = list(self.latencies_ms)
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "reachable": self.reachable,
+            "lastChecked": (datetime.fromtimestamp(self.last_checked, timezone.utc).isoformat()
+                            if self.last_checked else None),
+            "latencyMs": round(lat[-1], 1) if lat else None,
+            "latencyAvgMs": round(sum(lat) / len(lat), 1) if lat else None,
+            "outstanding": self.outstanding,
+            "consecutiveFailures": self.failures,
+            "requests": self.total,
+            "errors": self.errors,
+        }
+
+
+class EndpointPool:
+    def __init__(self, role: str, urls: Union[str, List[str], None], failure_threshold: int = 3,
+                 cooldown_s: float = 15.0, affinity_size: int = 1024,
+                 probe: Callable[..., bool] = probe_endpoint):
+        if isinstance(urls, str) or urls is None:
+            urls = split_urls(urls)
+        if not urls:
+            raise ValueError(f"{role}: no LLM endpoints configured")
+        self.role = role
+        self.endpoints = [Endpoint(u) for u in urls]
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.cooldown_s = float(cooldown_s)
+        self.affinity_size = int(affinity_size)
+        self._probe = probe
+        self._lock = threading.Lock()
+        self._affinity: "OrderedDict[str, Endpoint]" = OrderedDict()
+        # True while a background task calls check(); acquire() then never probes inline
+        self.background_probing = False
+
+    @property
+    def primary_url(self) -> str:
+        return self.endpoints[0].url
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    @property
+    def any_healthy(self) -> bool:
+        with self._lock:
+            return any(ep.ejected_at is None for ep in self.endpoints)
+
+    # --- health ---
+    def check(self, ep: Endpoint, timeout: float = 3.0) -> bool:
+        """Probe one endpoint, cache the outcome and eject/reintroduce it."""
+        t0 = time.perf_counter()
+        ok = self._probe(ep.url, timeout)
+        elapsed_ms = (time.perf_counter() - t0) * 1000.0
+        with self._lock:
+            ep.reachable = ok
+            ep.last_checked = time.time()
+            if ok:
+                ep.latencies_ms.append(elapsed_ms)
+                # a breaker opened by failing calls still waits out its cooldown
+                if ep.ejected_at is not None and time.monotonic() - ep.ejected_at >= self.cooldown_s:
+                    ep.ejected_at = None
+                    ep.failures = 0
+            elif ep.ejected_at is None:
+                # a failed probe is a stronger signal than one failed call: eject right away
+                ep.ejected_at = time.monotonic()
+        return ok
+
+    # --- circuit breaker ---
+    def _reprobe_due(self) -> None:
+        """Actively probe ejected endpoints whose cooldown has elapsed."""
+        now = time.monotonic()
+        with self._lock:
+            due = [ep for ep in self.endpoints
+                   if ep.ejected_at is not None and not ep.probing and now - ep.ejected_at >= self.cooldown_s]
+            for ep in due:
+                ep.probing = True
+        for ep in due:
+            ok = self._probe(ep.url)
+            with self._lock:
+                ep.probing = False
+                if ok:
+                    ep.ejected_at = None
+                    ep.failures = 0
+                else:
+                    ep.ejected_at = time.monotonic()
+
+    # --- routing ---
+    def acquire(self, affinity: Optional[str] = None, exclude: Optional[List[Endpoint]] = None) -> Endpoint:
+        """Pick the healthy endpoint with the fewest outstanding requests (or the pinned one)."""
+        if not self.background_probing:
+            self._reprobe_due()
+        with self._lock:
+            healthy = [ep for ep in self.endpoints if ep.ejected_at is None and ep not in (exclude or [])]
+            if not healthy:
+                raise NoHealthyEndpoint(f"{self.role}: no healthy LLM endpoint ({len(self.endpoints)} configured)")
+            ep = None
+            if affinity is not None:
+                pinned = self._affinity.get(affinity)
+                if pinned is not None and pinned in healthy:
+                    ep = pinned
+                    self._affinity.move_to_end(affinity)
+            if ep is None:
+                # ties -> fewer total requests, so idle endpoints share load round-robin
+                ep = min(healthy, key=lambda e: (e.outstanding, e.total))
+                if affinity is not None:
+                    self._affinity[affinity] = ep
+                    self._affinity.move_to_end(affinity)
+                    while len(self._affinity) > self.affinity_size:
+                        self._affinity.popitem(last=False)
+            ep.outstanding += 1
+            ep.total += 1
+            return ep
+
+    def release(self, ep: Endpoint, ok: bool) -> None:
+        with self._lock:
+            ep.outstanding = max(0, ep.outstanding - 1)
+            if ok:
+                ep.failures = 0
+                return
+            ep.failures += 1
+            ep.errors += 1
+            if ep.failures >= self.failure_threshold and ep.ejected_at is None:
+                ep.ejected_at = time.monotonic()
+
+    def forget(self, affinity: Optional[str]) -> None:
+        if affinity is None:
+            return
+        with self._lock:
+            self._affinity.pop(affinity, None)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [ep.snapshot() for ep in self.endpoints]
@@ -0,0 +1,114 @@
+"""
+Memory instrumentation for the analyze pipeline
+
+- process_rss(): resident set size of this process (psutil if installed, /proc/self/statm on
+  Linux, otherwise the peak from getrusage), cheap enough to call around every stage
+- stage(): context manager recording the RSS change of a stage and, with tracemalloc started
+  (MEM_TRACE=1), the allocation high-water mark above the stage's starting point. The tracemalloc
+  peak is process-wide and reset_peak() resets it for everyone, so peakBytes is recorded only for
+  a stage that ran while no other stage was in flight (otherwise "peakSkipped": "concurrent");
+  allocations of other threads outside any stage still count towards it
+- state_bytes(): bytes held by the large AgentState fields (upload, text, image payloads)
+
+Usage from agent_server:
+  with stage(state.mem_info["stages"], "rasterize"):
+      urls = rasterize_pdf_pages_pypdfium2(...)
+"""
+
+from __future__ import annotations
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+try:
+    import psutil
+    _PROC = psutil.Process()
+except Exception:  # opcionalno
+    _PROC = None
+
+_PAGE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# stageovi u tijeku (svi zahtjevi); _epoch raste sa svakim početkom -> preklapanje se vidi na kraju
+_LOCK = threading.Lock()
+_active = 0
+_epoch = 0
+
+
+def process_rss() -> Optional[int]:
+    if _PROC is not None:
+        return _PROC.memory_info().rss
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * _PAGE
+    except Exception:
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except Exception:
+        return None
+
+
+def start_tracing(frames: int = 1) -> None:
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(max(1, frames))
+
+
+def tracing() -> bool:
+    return tracemalloc.is_tracing()
+
+
+@contextmanager
+def stage(record: Dict[str, Any], name: str) -> Iterator[None]:
+    global _active, _epoch
+    rss0 = process_rss()
+    traced = tracemalloc.is_tracing()
+    with _LOCK:
+        alone = _active == 0
+        _active += 1
+        _epoch += 1
+        epoch = _epoch
+        if traced and alone:
+            cur0 = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _LOCK:
+            _active -= 1
+            solo = alone and _epoch == epoch
+            peak = tracemalloc.get_traced_memory()[1] if traced and solo and tracemalloc.is_tracing() else None
+        rss1 = process_rss()
+        entry: Dict[str, Any] = {"elapsedMs": round((time.perf_counter() - t0) * 1000.0, 1),
+                                 "rssAfterBytes": rss1,
+                                 "rssDeltaBytes": (rss1 - rss0) if rss0 is not None and rss1 is not None else None}
+        if peak is not None:
+            entry["peakBytes"] = max(0, peak - cur0)
+        elif traced:
+            entry["peakSkipped"] = "concurrent"
+        prev = record.get(name)
+        if prev is not None:
+            # stage koji se ponavlja (npr. rasterize u agent petlji): zadrži veći izmjereni vrh
+            if "peakBytes" in entry or "peakBytes" in prev:
+                entry["peakBytes"] = max(prev.get("peakBytes") or 0, entry.get("peakBytes") or 0)
+                entry.pop("peakSkipped", None)
+            entry["elapsedMs"] = round(prev["elapsedMs"] + entry["elapsedMs"], 1)
+            entry["calls"] = prev.get("calls", 1) + 1
+        record[name] = entry
+
+
+def state_bytes(file_bytes: Optional[bytes], text: Optional[str], images: Optional[List[str]]) -> Dict[str, int]:
+    out = {
+        "fileBytes": len(file_bytes or b""),
+        # str drži 1-4 B po znaku; UTF-8 duljina je dovoljna procjena za HR tekst
+        "text": len((text or "").encode("utf-8")),
+        "images": sum(len(u) for u in images or []),
+    }
+    out["total"] = sum(out.values())
+    return out
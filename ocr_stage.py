@@ -0,0 +1,183 @@
+"""
+Local OCR for scanned PDF pages (Tesseract via pytesseract, CPU only, optional)
+
+- Pages are rendered in the calling thread (pdfium) as grayscale PNG and recognised in a process
+  pool, so several pages run on several cores and the GIL of the API process is not involved
+- Each page gets a mean word confidence (0-100, weighted by word length); agent_server sends
+  the document down the text path only when every page is confident enough
+- Results are cached in SQLite by the hash of the rendered page (+ language and DPI), so a
+  re-upload or a retried job does not OCR the same page again
+
+Optional dependency: `pip install pytesseract` plus the tesseract binary with the language data
+(hrv, eng). Without them available() is False and agent_server keeps the vision path.
+
+Usage from agent_server:
+  ocr = OcrStage("ocr_cache.sqlite", workers=4, lang="hrv+eng", dpi=300)
+  pages = ocr.ocr_pdf(file_bytes, [0, 1, 2], cancel_check=token.check)   # -> [PageOcr, ...]
+"""
+
+from __future__ import annotations
+import hashlib
+import io
+import multiprocessing
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pypdfium2 as pdfium
+
+try:
+    import pytesseract
+except ImportError:  # opcionalno
+    pytesseract = None
+
+
+def available() -> Tuple[bool, Optional[str]]:
+    """(ok, reason) — pytesseract importable and the tesseract binary runs."""
+    if pytesseract is None:
+        return False, "pytesseract not installed"
+    try:
+        pytesseract.get_tesseract_version()
+    except Exception as e:
+        return False, f"tesseract binary not available: {str(e)[:100]}"
+    return True, None
+
+
+def _ocr_png(png: bytes, lang: str, timeout_s: float) -> Tuple[str, float, int]:
+    """Worker process: (text, mean confidence, words) of one page image."""
+    from PIL import Image
+    img = Image.open(io.BytesIO(png))
+    data = pytesseract.image_to_data(img, lang=lang, output_type=pytesseract.Output.DICT, timeout=timeout_s)
+    lines: Dict[tuple, List[str]] = {}
+    conf_sum = weight = 0.0
+    words = 0
+    for i, word in enumerate(data["text"]):
+        word = (word or "").strip()
+        conf = float(data["conf"][i])
+        if not word or conf < 0:
+            continue
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        lines.setdefault(key, []).append(word)
+        conf_sum += conf * len(word)
+        weight += len(word)
+        words += 1
+    text = "\n".join(" ".join(ws) for _, ws in sorted(lines.items()))
+    return text, (conf_sum / weight if weight else 0.0), words
+
+
+class PageOcr:
+    __slots__ = ("page", "text", "confidence", "words", "cached")
+
+    def __init__(self, page: int, text: str, confidence: float, words: int, cached: bool):
+        self.page = page              # 0-based
+        self.text = text
+        self.confidence = confidence
+        self.words = words
+        self.cached = cached
+
+    def info(self) -> Dict[str, Any]:
+        return {"page": self.page + 1, "confidence": round(self.confidence, 1), "chars": len(self.text),
+                "cached": self.cached}
+
+
+class OcrStage:
+    def __init__(self, cache_path: str, workers: int = 2, lang: str = "hrv+eng", dpi: int = 300,
+                 page_timeout_s: float = 60.0):
+        self.lang = lang
+        self.dpi = int(dpi)
+        self.page_timeout_s = float(page_timeout_s)
+        self.workers = max(1, int(workers))
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(cache_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS ocr (
+            key TEXT PRIMARY KEY, text TEXT NOT NULL, confidence REAL NOT NULL, words INTEGER NOT NULL,
+            created REAL NOT NULL)""")
+        self._db.commit()
+        self.pages_ocr = 0
+        self.pages_cached = 0
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                # spawn: fork iz procesa s nitima (uvicorn, radnici) nije siguran; isto ponašanje kao na Windowsima
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def _render(self, pdf, i: int) -> bytes:
+        page = pdf[i]
+        try:
+            img = page.render(scale=self.dpi / 72.0, grayscale=True).to_pil().convert("L")
+        finally:
+            page.close()
+        buf = io.BytesIO()
+        img.save(buf, format="PNG", compress_level=1)
+        return buf.getvalue()
+
+    def _cache_get(self, key: str) -> Optional[Tuple[str, float, int]]:
+        with self._lock:
+            return self._db.execute("SELECT text, confidence, words FROM ocr WHERE key = ?", (key,)).fetchone()
+
+    def _cache_put(self, key: str, text: str, conf: float, words: int) -> None:
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO ocr (key, text, confidence, words, created) VALUES (?, ?, ?, ?, ?)",
+                             (key, text, conf, words, time.time()))
+            self._db.commit()
+
+    def ocr_pdf(self, file_bytes: bytes, pages: List[int],
+                cancel_check: Optional[Callable[[], None]] = None) -> List[PageOcr]:
+        """OCR the given 0-based pages; rendering overlaps with recognition of earlier pages."""
+        out: Dict[int, PageOcr] = {}
+        futures: Dict[Any, Tuple[int, str]] = {}
+        pdf = pdfium.PdfDocument(file_bytes)
+        try:
+            for i in pages:
+                if i >= len(pdf):
+                    break
+                if cancel_check is not None:
+                    cancel_check()
+                png = self._render(pdf, i)
+                key = hashlib.sha256(png).hexdigest() + f":{self.lang}:{self.dpi}"
+                hit = self._cache_get(key)
+                if hit is not None:
+                    out[i] = PageOcr(i, hit[0], hit[1], hit[2], cached=True)
+                    continue
+                futures[self._executor().submit(_ocr_png, png, self.lang, self.page_timeout_s)] = (i, key)
+        finally:
+            pdf.close()
+        try:
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                for f in done:
+                    i, key = futures[f]
+                    text, conf, words = f.result()
+                    self._cache_put(key, text, conf, words)
+                    out[i] = PageOcr(i, text, conf, words, cached=False)
+                if cancel_check is not None:
+                    cancel_check()
+        except BrokenProcessPool:
+            # proces je pao (npr. OOM) -> sljedeći poziv dobiva novi pool
+            with self._pool_lock:
+                self._pool = None
+            raise
+        finally:
+            for f in futures:
+                f.cancel()
+        with self._lock:
+            self.pages_ocr += sum(1 for p in out.values() if not p.cached)
+            self.pages_cached += sum(1 for p in out.values() if p.cached)
+        return [out[i] for i in sorted(out)]
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            (n,) = self._db.execute("SELECT COUNT(*) FROM ocr").fetchone()
+            return {"cachedPages": n, "pagesOcr": self.pages_ocr, "pagesFromCache": self.pages_cached,
+                    "workers": self.workers, "lang": self.lang, "dpi": self.dpi}
@@ -0,0 +1,157 @@
+"""
+Bundle segmentation: one uploaded PDF that contains several invoices/quotes
+
+Boundaries are decided page by page, strongest signal first:
+- page counters ("Stranica 1 od 3", "Str. 2", "Strana: 1 / 2", "Page: 1", a trailing "2/ 4"):
+  page 1 starts a document, any other number continues the current one
+- document numbers near the top of the page ("Ponuda br. 25/0001960", "Quote No. : 183",
+  "Ponuda Dugopolje 1508-2025/030-PD"): a different number starts a new document
+- a change of page style: a page without a counter after counted pages, or a switch between
+  a text layer and a scan
+- pages without a text layer (scans): the header band is compared by dHash with the first page
+  of the current document; a repeated header starts a new document
+Anything else continues the current document, so an unclear bundle degrades to one document.
+
+Usage from agent_server:
+  segs = split_bundle(file_bytes)            # -> [Segment(pages=[0, 1], reason="counter"), ...]
+  sub_pdf = extract_pages(file_bytes, segs[1].pages)
+"""
+
+from __future__ import annotations
+import io
+import re
+from typing import List, Optional, Tuple
+
+import pypdfium2 as pdfium
+
+_COUNTER_RE = re.compile(r"\b(?:stranica|strana|str|page|list)\s*[:.]?\s*(\d{1,3})(?:\s*(?:/|od|of)\s*(\d{1,3}))?\b",
+                         re.IGNORECASE)
+_TRAILING_COUNTER_RE = re.compile(r"(?<![\d/.,])(\d{1,3})\s*/\s*(\d{1,3})\s*$")
+_DOC_KW = r"(?:ponuda|račun|racun|predračun|predracun|otpremnica|narudžba|narudzba|narudžbenica|invoice|quote|offer|order)"
+# s oznakom broja: "Ponuda br. 25/0001960", "Quote No. : 0000000183", "PONUDA : 2202-IL/NV/ 25"
+_DOCNO_LABELED_RE = re.compile(_DOC_KW + r"\b[^\n]{0,25}?(?:\bbr(?:oj)?\b\.?|\bno\b\.?|\bnr\b\.?|#|:)\s*[:.]?\s*"
+                               r"([A-Z0-9][A-Z0-9\-/.]*\d[A-Z0-9\-/]*)", re.IGNORECASE)
+# bez oznake, ali s razdjelnikom u broju: "Ponuda Dugopolje 1508-2025/030-PD"
+_DOCNO_BARE_RE = re.compile(_DOC_KW + r"\b[^\n]{0,30}?\s([A-Z0-9]*\d[A-Z0-9]*[-/][A-Z0-9\-/]+)", re.IGNORECASE)
+_BANK_CONTEXT = ("žiro", "ziro", "transakc", "iban", "banka")
+
+
+class Segment:
+    __slots__ = ("pages", "reason", "doc_number")
+
+    def __init__(self, pages: List[int], reason: str, doc_number: Optional[str] = None):
+        self.pages = pages            # 0-based page indices
+        self.reason = reason          # why the segment starts: first | counter | style | docnumber | header
+        self.doc_number = doc_number
+
+    def info(self) -> dict:
+        return {"pages": [p + 1 for p in self.pages], "boundary": self.reason, "documentNumber": self.doc_number}
+
+
+# ---------- page features ----------
+def page_counter(text: str) -> Optional[Tuple[int, Optional[int]]]:
+    """(n, N) page counter, N may be None ("Str. 2")."""
+    for m in _COUNTER_RE.finditer(text):
+        n = int(m.group(1))
+        total = int(m.group(2)) if m.group(2) else None
+        if n >= 1 and (total is None or n <= total):
+            return n, total
+    tail = [ln for ln in text.splitlines() if ln.strip()][-3:]
+    for ln in tail:
+        m = _TRAILING_COUNTER_RE.search(ln)
+        if m:
+            n, total = int(m.group(1)), int(m.group(2))
+            if 1 <= n <= total <= 99:
+                return n, total
+    return None
+
+
+def doc_number(text: str) -> Optional[str]:
+    """Document number from the upper part of the page (footers carry bank accounts)."""
+    lines = [ln for ln in text.splitlines() if ln.strip()]
+    head = "\n".join(lines[:max(12, int(len(lines) * 0.4))])
+    for rx in (_DOCNO_LABELED_RE, _DOCNO_BARE_RE):
+        for m in rx.finditer(head):
+            before = head[max(0, m.start() - 12):m.start() + 12].lower()
+            value = m.group(1).strip(".-/")
+            digits = sum(ch.isdigit() for ch in value)
+            if any(k in before for k in _BANK_CONTEXT) or digits == 0 or digits >= 15:
+                continue
+            return value.upper()
+    return None
+
+
+def _header_hash(page) -> int:
+    """dHash of the top 20 % of the page (logo, supplier block)."""
+    pw, ph = page.get_size()
+    img = page.render(scale=256.0 / max(pw, 1.0)).to_pil().convert("L")
+    band = img.crop((0, 0, img.width, max(1, int(img.height * 0.2)))).resize((9, 8))
+    px = list(band.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (1 if px[row * 9 + col] > px[row * 9 + col + 1] else 0)
+    return bits
+
+
+# ---------- segmentation ----------
+def split_bundle(file_bytes: bytes, max_pages: int = 200, header_distance: int = 6,
+                 min_text_chars: int = 30) -> List[Segment]:
+    pdf = pdfium.PdfDocument(file_bytes)
+    try:
+        n_pages = min(len(pdf), max_pages)
+        segments: List[Segment] = []
+        seg_header: Optional[int] = None
+        prev_counter, prev_text = False, True
+        for i in range(n_pages):
+            page = pdf[i]
+            tp = page.get_textpage()
+            text = tp.get_text_bounded()
+            tp.close()
+            has_text = len(text.strip()) >= min_text_chars
+            counter = page_counter(text) if has_text else None
+            number = doc_number(text) if has_text else None
+            header = _header_hash(page) if not has_text else None
+            page.close()
+
+            if not segments:
+                segments.append(Segment([i], "first", number))
+                seg_header = header
+                prev_counter, prev_text = counter is not None, has_text
+                continue
+            cur = segments[-1]
+            reason = None
+            if counter is not None:
+                reason = "counter" if counter[0] == 1 else None
+            elif prev_counter or has_text != prev_text:
+                # dokumenti s brojačem ga imaju na svakoj stranici; sken usred digitalnog PDF-a je novi dokument
+                reason = "style"
+            elif number is not None and cur.doc_number is not None:
+                reason = "docnumber" if number != cur.doc_number else None
+            elif header is not None and seg_header is not None:
+                reason = "header" if bin(header ^ seg_header).count("1") <= header_distance else None
+            if reason:
+                segments.append(Segment([i], reason, number))
+                seg_header = header
+            else:
+                cur.pages.append(i)
+                if cur.doc_number is None:
+                    cur.doc_number = number
+            prev_counter, prev_text = counter is not None, has_text
+        return segments
+    finally:
+        pdf.close()
+
+
+def extract_pages(file_bytes: bytes, pages: List[int]) -> bytes:
+    """New PDF with only the given (0-based) pages."""
+    src = pdfium.PdfDocument(file_bytes)
+    dst = pdfium.PdfDocument.new()
+    try:
+        dst.import_pages(src, pages)
+        buf = io.BytesIO()
+        dst.save(buf)
+        return buf.getvalue()
+    finally:
+        dst.close()
+        src.close()
@@ -0,0 +1,53 @@
+"""
+PDF text layer and page count (pdfminer + pdfium), without the server's imports
+
+- extract_text(): pdfminer text, same output as high_level.extract_text, page by page so a
+  cancelled request stops between pages
+- page_count(): pdfium page count, 1 for a corrupted/invalid PDF
+- probe(): both at once; the batch CPU pool (spawn) runs it in child processes, which import
+  only this module instead of all of agent_server (FastAPI, models, pools, queues)
+
+Usage from agent_server:
+  text, pages = await loop.run_in_executor(process_pool, pdf_probe.probe, file_bytes)
+"""
+
+from __future__ import annotations
+import io
+from typing import Callable, Optional, Tuple
+
+import pypdfium2 as pdfium
+from pdfminer.converter import TextConverter        # pdfminer.six
+from pdfminer.layout import LAParams
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+
+
+def extract_text(file_bytes: bytes, cancel_check: Optional[Callable[[], None]] = None) -> str:
+    out = io.StringIO()
+    rsrc = PDFResourceManager()
+    device = TextConverter(rsrc, out, laparams=LAParams())
+    try:
+        interpreter = PDFPageInterpreter(rsrc, device)
+        for page in PDFPage.get_pages(io.BytesIO(file_bytes)):
+            if cancel_check is not None:
+                cancel_check()
+            interpreter.process_page(page)
+    finally:
+        device.close()
+    return out.getvalue()
+
+
+def page_count(file_bytes: bytes) -> int:
+    try:
+        pdf = pdfium.PdfDocument(file_bytes)
+        count = len(pdf)
+        pdf.close()
+        return count
+    except Exception:
+        return 1  # Fallback for corrupted/invalid PDFs
+
+
+def probe(file_bytes: bytes) -> Tuple[Optional[str], int]:
+    """(text or None without a text layer, page count) — pure-Python CPU work for a process pool."""
+    txt = extract_text(file_bytes) or ""
+    return (txt if txt.strip() else None), page_count(file_bytes)
@@ -0,0 +1,509 @@
+"""
+Supplier layout templates: LLM-free extraction for suppliers whose invoices never change layout
+
+- Reads the PDF text layer with positions (pypdfium2) and rebuilds visual lines, split into
+  segments on wide gaps, so labels, values and table rows stay together
+- A document is fingerprinted by the supplier OIB and IBAN plus the page positions of the
+  anchor labels ("Datum dokumenta:", "Ukupno:" ...)
+- Every validated LLM result is an observation: for each field we record which label (and
+  which occurrence of it) precedes the value, and for items the column layout of a row
+- After TEMPLATE_LEARN_MIN observations that agree, the rules become a template; matching
+  documents are then extracted by rules in milliseconds
+- Output keeps the raw document strings ("1.145,00", "02.07.2025.") so the caller runs the
+  usual normalize_result + schema validation on it
+- Observations, templates and hit counters live in SQLite (WAL); every change is one write
+  transaction that re-reads the supplier's rows, so the API process and agent_worker.py
+  processes sharing the file add to each other's observations instead of overwriting them.
+  A store from the earlier JSON format (same name, .json) is imported once
+
+Usage from agent_server:
+  store = TemplateStore("supplier_templates.sqlite", parse_number=hr_number_to_float, parse_date=parse_hr_date)
+  m = store.match(file_bytes)            # -> TemplateMatch | None
+  raw = store.extract(m)                 # -> dict in RESULT_SCHEMA shape (raw strings)
+  store.observe(file_bytes, result)      # after a validated LLM result
+"""
+
+from __future__ import annotations
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pypdfium2 as pdfium
+
+SCALAR_FIELDS = {
+    # field path -> value kind
+    "documentNumber": "string",
+    "date": "date",
+    "dueDate": "date",
+    "totals.subtotal": "number",
+    "totals.vatAmount": "number",
+    "totals.totalAmount": "number",
+}
+REQUIRED_FIELDS = ("documentNumber", "totals.totalAmount")
+ITEM_NUMERIC = ("quantity", "unitPrice", "discountPercent", "totalPrice")
+
+_OIB_RE = re.compile(r"(?<!\d)\d{11}(?!\d)")
+_NUM_RE = re.compile(r"^-?\d[\d.,]*%?$")
+_UNIT_RE = re.compile(r"^[A-Za-zČčĆćŽžŠšĐđ.²³]{1,6}$")
+_CURRENCY_SUFFIX = re.compile(r"\s*(€|EUR|HRK|kn|%)\s*$", re.IGNORECASE)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS suppliers (
+    oib TEXT PRIMARY KEY,
+    template TEXT,                        -- JSON; NULL dok se ne nauči
+    hits INTEGER NOT NULL DEFAULT 0,      -- izvlačenja predloškom od zadnjeg učenja (spot check)
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS observations (
+    id INTEGER PRIMARY KEY,
+    oib TEXT NOT NULL,
+    obs TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS observations_oib ON observations (oib, id);
+"""
+
+
+# ---------- layout ----------
+class Line:
+    __slots__ = ("page", "y", "segments")
+
+    def __init__(self, page: int, y: float, segments: List[Tuple[float, str]]):
+        self.page = page
+        self.y = y                  # 0 = top of the page, 1 = bottom
+        self.segments = segments    # [(x 0..1, text)] split on wide gaps
+
+    @property
+    def text(self) -> str:
+        return "  ".join(s for _, s in self.segments)
+
+
+def layout_lines(file_bytes: bytes, max_pages: int = 3, gap_pt: float = 4.0) -> List[Line]:
+    """Visual text lines with segment positions, built from pdfium text runs."""
+    lines: List[Line] = []
+    pdf = pdfium.PdfDocument(file_bytes)
+    try:
+        for pi in range(min(len(pdf), max_pages)):
+            page = pdf[pi]
+            pw, ph = page.get_size()
+            textpage = page.get_textpage()
+            runs = []
+            for i in range(textpage.count_rects()):
+                l, b, r, t = textpage.get_rect(i)
+                s = textpage.get_text_bounded(l, b, r, t).strip()
+                if s:
+                    runs.append((l, b, r, t, " ".join(s.split())))
+            textpage.close()
+            runs.sort(key=lambda x: (-(x[1] + x[3]) / 2, x[0]))
+            rows: List[Tuple[float, list]] = []
+            for run in runs:
+                yc, h = (run[1] + run[3]) / 2, run[3] - run[1]
+                if rows and abs(rows[-1][0] - yc) < max(2.0, 0.5 * h):
+                    rows[-1][1].append(run)
+                else:
+                    rows.append((yc, [run]))
+            for yc, row in rows:
+                row.sort(key=lambda x: x[0])
+                segments: List[Tuple[float, str]] = [(row[0][0], row[0][4])]
+                for prev, cur in zip(row, row[1:]):
+                    if cur[0] - prev[2] > gap_pt:
+                        segments.append((cur[0], cur[4]))
+                    else:
+                        segments[-1] = (segments[-1][0], segments[-1][1] + " " + cur[4])
+                lines.append(Line(pi, 1.0 - yc / ph if ph else 0.0,
+                                  [(x / pw if pw else 0.0, s) for x, s in segments]))
+    finally:
+        pdf.close()
+    return lines
+
+
+def _digits(s: Optional[str]) -> str:
+    return re.sub(r"\D", "", s or "")
+
+
+def _get(d: Dict[str, Any], path: str) -> Any:
+    for k in path.split("."):
+        d = d.get(k) if isinstance(d, dict) else None
+    return d
+
+
+def _set(d: Dict[str, Any], path: str, value: Any) -> None:
+    keys = path.split(".")
+    for k in keys[:-1]:
+        d = d.setdefault(k, {})
+    d[keys[-1]] = value
+
+
+# ---------- template match ----------
+class TemplateMatch:
+    def __init__(self, oib: str, template: Dict[str, Any], lines: List[Line]):
+        self.oib = oib
+        self.template = template
+        self.lines = lines
+
+
+class TemplateStore:
+    def __init__(self, path: str, parse_number: Callable[[str], Optional[float]],
+                 parse_date: Callable[[str], Optional[str]], learn_min: int = 3,
+                 spot_check_every: int = 20, pos_tolerance: float = 0.05, max_observations: int = 10):
+        legacy = os.path.splitext(path)[0] + ".json"
+        if path.endswith(".json"):
+            path = legacy[:-5] + ".sqlite"
+        self.path = path
+        self.parse_number = parse_number
+        self.parse_date = parse_date
+        self.learn_min = max(1, learn_min)
+        self.spot_check_every = spot_check_every
+        self.pos_tolerance = pos_tolerance
+        self.max_observations = max_observations
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        if os.path.exists(legacy):
+            self._import_json(legacy)
+
+    # --- storage ---
+    def _tx(self, fn):
+        """Run fn(db) in one write transaction (other processes wait on the file lock)."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                out = fn(self._db)
+                self._db.execute("COMMIT")
+                return out
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _import_json(self, legacy: str) -> None:
+        """One-time import of the earlier JSON store (only into an empty database)."""
+        try:
+            with open(legacy, "r", encoding="utf-8") as f:
+                suppliers = json.load(f).get("suppliers") or {}
+        except Exception:
+            return
+
+        def imp(db):
+            if db.execute("SELECT 1 FROM suppliers LIMIT 1").fetchone():
+                return
+            now = time.time()
+            for oib, sup in suppliers.items():
+                tpl = sup.get("template")
+                db.execute("INSERT INTO suppliers (oib, template, hits, updated) VALUES (?, ?, ?, ?)",
+                           (oib, json.dumps(tpl, ensure_ascii=False) if tpl else None, int(sup.get("hits") or 0), now))
+                db.executemany("INSERT INTO observations (oib, obs, created) VALUES (?, ?, ?)",
+                               [(oib, json.dumps(o, ensure_ascii=False), now) for o in sup.get("observations") or []])
+        self._tx(imp)
+
+    # --- value matching ---
+    def _value_matches(self, kind: str, candidate: str, value: Any) -> bool:
+        candidate = candidate.strip()
+        if not candidate or value is None:
+            return False
+        if kind == "date":
+            return self.parse_date(candidate) == value
+        if kind == "number":
+            num = self.parse_number(_CURRENCY_SUFFIX.sub("", candidate))
+            try:
+                return num is not None and abs(num - float(value)) < 0.005
+            except (TypeError, ValueError):
+                return False
+        return candidate == str(value).strip()
+
+    @staticmethod
+    def _nth(lines: List[Line], upto: int, label: str) -> int:
+        """How many times `label` starts a segment before line `upto`."""
+        return sum(1 for ln in lines[:upto] for _, s in ln.segments if s.startswith(label))
+
+    def _find_rule(self, lines: List[Line], kind: str, value: Any) -> Optional[Dict[str, Any]]:
+        """Locate the value and describe it relative to a label: inline, next segment or next line."""
+        for i, ln in enumerate(lines):
+            for j, (x, seg) in enumerate(ln.segments):
+                # "Datum dokumenta: 04.03.2025." -> label + value in one segment
+                parts = seg.split(" ")
+                for k in range(1, len(parts)):
+                    label, rest = " ".join(parts[:k]), " ".join(parts[k:])
+                    if re.search(r"[A-Za-zČčĆćŽžŠšĐđ]", label) and self._value_matches(kind, rest, value):
+                        return {"label": label, "nth": self._nth(lines, i, label), "mode": "inline",
+                                "pos": [ln.page, round(x, 4), round(ln.y, 4)]}
+                if not self._value_matches(kind, seg, value):
+                    continue
+                if j > 0 and re.search(r"[A-Za-zČčĆćŽžŠšĐđ]", ln.segments[j - 1][1]):
+                    lx, label = ln.segments[j - 1]
+                    return {"label": label, "nth": self._nth(lines, i, label), "mode": "next_segment",
+                            "pos": [ln.page, round(lx, 4), round(ln.y, 4)]}
+                if j == 0 and i > 0 and len(lines[i - 1].segments) == 1:
+                    prev = lines[i - 1]
+                    lx, label = prev.segments[0]
+                    return {"label": label, "nth": self._nth(lines, i - 1, label), "mode": "next_line",
+                            "pos": [prev.page, round(lx, 4), round(prev.y, 4)]}
+        return None
+
+    def _apply_rule(self, lines: List[Line], rule: Dict[str, Any]) -> Optional[str]:
+        label, seen = rule["label"], 0
+        for i, ln in enumerate(lines):
+            for j, (_, seg) in enumerate(ln.segments):
+                if not seg.startswith(label):
+                    continue
+                if seen < rule["nth"]:
+                    seen += 1
+                    continue
+                if rule["mode"] == "inline":
+                    return seg[len(label):].strip() or None
+                if rule["mode"] == "next_segment":
+                    return ln.segments[j + 1][1] if j + 1 < len(ln.segments) else None
+                if rule["mode"] == "next_line":
+                    return lines[i + 1].segments[0][1] if i + 1 < len(lines) and lines[i + 1].segments else None
+        return None
+
+    # --- item rows ---
+    @staticmethod
+    def _tail_kind(seg: str) -> Optional[str]:
+        """'N' numbers (with at most one unit after a number: "10 kom"), 'U' a unit alone, None
+        anything else ("Ključ 13" is a description)."""
+        toks = seg.split(" ")
+        nums = sum(1 for t in toks if _NUM_RE.match(t))
+        units = sum(1 for t in toks if _UNIT_RE.match(t))
+        if units > 1 or nums + units != len(toks):
+            return None
+        if nums and units and _UNIT_RE.match(toks[0]):
+            return None
+        return "N" if nums else "U"
+
+    @classmethod
+    def _split_row(cls, ln: Line) -> Optional[Tuple[List[str], List[str]]]:
+        """(head segments, tail tokens): the tail is the trailing run of numeric/unit-only segments."""
+        segs = [s for _, s in ln.segments]
+        k = len(segs)
+        while k > 0:
+            kind = cls._tail_kind(segs[k - 1])
+            # jedinica u svom stupcu ("kom") samo iza količine, inače je to kratak opis ("Lanac");
+            # broj na početku reda je redni broj, ne količina
+            if kind is None or (kind == "U" and (k < 3 or cls._tail_kind(segs[k - 2]) != "N")):
+                break
+            k -= 1
+        if k == len(segs) or k == 0:
+            return None
+        tail = [t for s in segs[k:] for t in s.split(" ")]
+        return segs[:k], tail
+
+    @staticmethod
+    def _tail_classes(tail: List[str]) -> str:
+        return "".join("P" if t.endswith("%") else "N" if _NUM_RE.match(t) else "U" for t in tail)
+
+    def _item_rule(self, lines: List[Line], item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        desc = " ".join(str(item.get("description") or "").split())[:12].casefold()
+        if len(desc) < 3:
+            return None
+        for ln in lines:
+            if desc not in ln.text.casefold():
+                continue
+            split = self._split_row(ln)
+            if not split:
+                continue
+            head, tail = split
+            cols: Dict[str, int] = {}
+            for field in ITEM_NUMERIC:
+                hits = [i for i, t in enumerate(tail) if self._value_matches("number", t, item.get(field))]
+                if hits:
+                    # kolona ukupno je desno, količina lijevo
+                    cols[field] = hits[-1] if field == "totalPrice" else hits[0]
+            units = [i for i, t in enumerate(tail) if str(item.get("unit") or "").casefold() == t.casefold()]
+            if units:
+                cols["unit"] = units[0]
+            if "quantity" not in cols or "totalPrice" not in cols:
+                continue
+            has_pos = bool(re.fullmatch(r"\d{1,4}", head[0])) and len(head) > 1
+            has_code = bool(item.get("code")) and len(head) > 1 + has_pos and head[int(has_pos)] == str(item["code"])
+            return {"classes": self._tail_classes(tail), "cols": cols, "position": has_pos, "code": has_code}
+        return None
+
+    def _extract_items(self, lines: List[Line], rule: Dict[str, Any]) -> List[Dict[str, Any]]:
+        items = []
+        for ln in lines:
+            split = self._split_row(ln)
+            if not split:
+                continue
+            head, tail = split
+            if self._tail_classes(tail) != rule["classes"]:
+                continue
+            n_fixed = int(rule["position"]) + int(rule["code"])
+            if len(head) <= n_fixed:
+                continue
+            item: Dict[str, Any] = {"position": None, "code": None, "discountPercent": None, "unit": ""}
+            if rule["position"]:
+                item["position"] = int(head[0]) if head[0].isdigit() else None
+            if rule["code"]:
+                item["code"] = head[int(rule["position"])]
+            item["description"] = " ".join(head[n_fixed:])
+            for field, idx in rule["cols"].items():
+                v = tail[idx]
+                item[field] = v.rstrip("%") if field == "discountPercent" else v
+            items.append(item)
+        return items
+
+    # --- learning ---
+    def observe(self, file_bytes: bytes, result: Dict[str, Any]) -> bool:
+        """Record a validated LLM result; returns True when the supplier's template is (re)learned."""
+        oib = _digits(_get(result, "supplier.oib"))
+        if len(oib) != 11 or not result.get("items"):
+            return False
+        try:
+            lines = layout_lines(file_bytes)
+        except Exception:
+            return False
+        if oib not in _digits(" ".join(ln.text for ln in lines)):
+            return False
+        obs: Dict[str, Any] = {"fields": {}, "items": None,
+                               "documentType": result.get("documentType"), "currency": result.get("currency"),
+                               "supplier": result.get("supplier"), "buyer": result.get("buyer")}
+        for path, kind in SCALAR_FIELDS.items():
+            rule = self._find_rule(lines, kind, _get(result, path))
+            if rule:
+                obs["fields"][path] = rule
+        item_rules = [r for r in (self._item_rule(lines, it) for it in result["items"]) if r]
+        if item_rules:
+            common, count = Counter(json.dumps(r, sort_keys=True) for r in item_rules).most_common(1)[0]
+            if count * 2 > len(item_rules):
+                obs["items"] = json.loads(common)
+        now = time.time()
+
+        def add(db):
+            db.execute("INSERT INTO observations (oib, obs, created) VALUES (?, ?, ?)",
+                       (oib, json.dumps(obs, ensure_ascii=False), now))
+            db.execute("DELETE FROM observations WHERE oib = ? AND id NOT IN "
+                       "(SELECT id FROM observations WHERE oib = ? ORDER BY id DESC LIMIT ?)",
+                       (oib, oib, self.max_observations))
+            # zadnja opažanja svih procesa, ne samo ovog
+            recent = [json.loads(r[0]) for r in db.execute(
+                "SELECT obs FROM observations WHERE oib = ? ORDER BY id DESC LIMIT ?", (oib, self.learn_min))][::-1]
+            template = self.learn(recent)
+            if template is None:
+                db.execute("INSERT INTO suppliers (oib, template, hits, updated) VALUES (?, NULL, 0, ?) "
+                           "ON CONFLICT(oib) DO NOTHING", (oib, now))
+                return False
+            db.execute("INSERT INTO suppliers (oib, template, hits, updated) VALUES (?, ?, 0, ?) "
+                       "ON CONFLICT(oib) DO UPDATE SET template = excluded.template, hits = 0, updated = excluded.updated",
+                       (oib, json.dumps(template, ensure_ascii=False), now))
+            return True
+        return self._tx(add)
+
+    def learn(self, recent: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Template from the last `learn_min` observations, or None while they disagree."""
+        recent = recent[-self.learn_min:]
+        if len(recent) < self.learn_min:
+            return None
+        fields: Dict[str, Any] = {}
+        for path in SCALAR_FIELDS:
+            rules = [o["fields"].get(path) for o in recent]
+            if any(r is None for r in rules):
+                continue
+            keys = {(r["label"], r["nth"], r["mode"]) for r in rules}
+            if len(keys) != 1:
+                continue
+            pos = [r["pos"] for r in rules]
+            stable = (len({p[0] for p in pos}) == 1 and
+                      max(p[1] for p in pos) - min(p[1] for p in pos) <= self.pos_tolerance and
+                      max(p[2] for p in pos) - min(p[2] for p in pos) <= self.pos_tolerance)
+            fields[path] = dict(rules[-1], stable=stable,
+                                pos=[pos[-1][0], sum(p[1] for p in pos) / len(pos), sum(p[2] for p in pos) / len(pos)])
+        item_keys = {json.dumps(o["items"], sort_keys=True) for o in recent}
+        if (any(p not in fields for p in REQUIRED_FIELDS) or len(item_keys) != 1 or recent[-1]["items"] is None
+                or not any(r["stable"] for r in fields.values())):
+            return None
+        last = recent[-1]
+        ibans = {_digits((o.get("supplier") or {}).get("iban")) for o in recent} - {""}
+        return {
+            "fields": fields,
+            "items": last["items"],
+            "documentType": Counter(o["documentType"] for o in recent).most_common(1)[0][0],
+            "currency": Counter(o["currency"] for o in recent).most_common(1)[0][0],
+            "supplier": last["supplier"],
+            "buyer": last["buyer"],
+            "iban": ibans.pop() if len(ibans) == 1 else None,
+        }
+
+    # --- matching / extraction ---
+    def match(self, file_bytes: bytes) -> Optional[TemplateMatch]:
+        """Find a learned template whose OIB/IBAN and anchor positions fit the document."""
+        with self._lock:
+            if self._db.execute("SELECT 1 FROM suppliers WHERE template IS NOT NULL LIMIT 1").fetchone() is None:
+                return None
+        try:
+            lines = layout_lines(file_bytes)
+        except Exception:
+            return None
+        text = " ".join(ln.text for ln in lines)
+        digits = _digits(text)
+        oibs = sorted({m.group(0) for m in _OIB_RE.finditer(text)})
+        if not oibs:
+            return None
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT oib, template FROM suppliers WHERE template IS NOT NULL AND oib IN ({','.join('?' * len(oibs))})",
+                oibs).fetchall()
+        templates = {oib: json.loads(t) for oib, t in rows}
+        for oib in sorted(templates):
+            tpl = templates[oib]
+            if tpl.get("iban") and tpl["iban"] not in digits:
+                continue
+            if all(self._anchor_in_place(lines, r) for r in tpl["fields"].values() if r.get("stable")):
+                return TemplateMatch(oib, tpl, lines)
+        return None
+
+    def _anchor_in_place(self, lines: List[Line], rule: Dict[str, Any]) -> bool:
+        page, x, y = rule["pos"]
+        for ln in lines:
+            if ln.page != page:
+                continue
+            for sx, seg in ln.segments:
+                if (seg.startswith(rule["label"]) and abs(sx - x) <= self.pos_tolerance
+                        and abs(ln.y - y) <= self.pos_tolerance):
+                    return True
+        return False
+
+    def extract(self, m: TemplateMatch) -> Dict[str, Any]:
+        tpl = m.template
+        out: Dict[str, Any] = {"documentType": tpl["documentType"], "currency": tpl["currency"],
+                               "date": None, "dueDate": None, "documentNumber": None,
+                               "supplier": dict(tpl.get("supplier") or {}), "buyer": {}, "totals": {}}
+        buyer = tpl.get("buyer") or {}
+        if len(_digits(buyer.get("oib"))) == 11 and _digits(buyer.get("oib")) in _digits(
+                " ".join(ln.text for ln in m.lines)):
+            out["buyer"] = dict(buyer)  # isti kupac (OIB je u dokumentu)
+        for path, rule in tpl["fields"].items():
+            value = self._apply_rule(m.lines, rule)
+            if value is not None and SCALAR_FIELDS[path] == "number":
+                value = _CURRENCY_SUFFIX.sub("", value)
+            _set(out, path, value)
+        out["items"] = self._extract_items(m.lines, tpl["items"])
+        return out
+
+    # --- spot checks ---
+    def record_hit(self, oib: str) -> bool:
+        """Count a template extraction; True when this one should be spot-checked by the LLM."""
+        row = self._tx(lambda db: db.execute(
+            "UPDATE suppliers SET hits = hits + 1 WHERE oib = ? RETURNING hits", (oib,)).fetchone())
+        return row is not None and self.spot_check_every > 0 and row[0] % self.spot_check_every == 0
+
+    def report_spot_check(self, oib: str, agreed: bool) -> None:
+        """A disagreeing spot check drops the template; it is relearned from fresh observations."""
+        if agreed:
+            return
+
+        def drop(db):
+            db.execute("UPDATE suppliers SET template = NULL, hits = 0, updated = ? WHERE oib = ?", (time.time(), oib))
+            db.execute("DELETE FROM observations WHERE oib = ?", (oib,))
+        self._tx(drop)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            n, t = self._db.execute("SELECT COUNT(*), COUNT(template) FROM suppliers").fetchone()
+        return {"suppliers": n, "templates": t}
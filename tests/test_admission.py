@@ -0,0 +1,125 @@
+"""
+admission: per-key token buckets (refill, Retry-After, shared default bucket) and the global cap
+
+Run: python -m pytest -q tests/test_admission.py
+"""
+import asyncio
+import math
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import admission  # noqa: E402
+from admission import DEFAULT_KEY, AdmissionController, AdmissionRejected, Bucket, parse_budgets  # noqa: E402
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(admission.time, "monotonic", c)
+    return c
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_parse_budgets():
+    assert parse_budgets("team-a=300/3, batch=50/0.5,bad") == {"team-a": (300.0, 3.0), "batch": (50.0, 0.5)}
+    assert parse_budgets("x=10") == {"x": (10.0, 0.0)}
+
+
+def test_bucket_refill(clock):
+    b = Bucket(10, 2)
+    b.take(10)
+    assert b.wait_for(4) == pytest.approx(2.0)
+    clock.now += 1.0
+    assert b.wait_for(4) == pytest.approx(1.0)
+    clock.now += 100.0
+    assert b.wait_for(4) == 0.0
+    assert b.tokens == 10               # ne puni se iznad kapaciteta
+
+
+def test_bucket_without_refill_never_refills(clock):
+    b = Bucket(5, 0)
+    b.take(5)
+    assert math.isinf(b.wait_for(1))
+
+
+def test_oversized_cost_waits_for_full_bucket(clock):
+    b = Bucket(10, 1)
+    assert b.wait_for(50) == 0.0
+    b.take(50)
+    assert b.tokens == 0
+    assert b.wait_for(50) == pytest.approx(10.0)
+
+
+def test_exhausted_key_gets_retry_after(clock):
+    ctl = AdmissionController(capacity=0, budgets={"team-a": (10, 2)})
+
+    async def go():
+        await ctl.acquire("team-a", 8)
+        with pytest.raises(AdmissionRejected) as e:
+            await ctl.acquire("team-a", 6)
+        return e.value
+
+    err = run(go())
+    assert err.reason == "api key budget exhausted"
+    assert err.retry_after_s == pytest.approx(2.0)       # nedostaju 4 jedinice po 2/s
+
+
+def test_unknown_keys_share_default_bucket(clock):
+    ctl = AdmissionController(capacity=0, budgets={"team-a": (100, 1)}, default_budget=(10, 1))
+
+    async def go():
+        await ctl.acquire("rotating-1", 6)
+        await ctl.acquire("team-a", 50)
+        with pytest.raises(AdmissionRejected):
+            await ctl.acquire("rotating-2", 6)           # novi ključ ne dobiva novi bucket
+
+    run(go())
+    assert set(ctl._buckets) == {DEFAULT_KEY, "team-a"}
+    snap = ctl.snapshot()
+    assert snap["keys"][DEFAULT_KEY]["admitted"] == 1
+    assert snap["keys"][DEFAULT_KEY]["rejected"] == 1
+
+
+def test_global_capacity_rejects_and_lone_request_admitted(clock):
+    ctl = AdmissionController(capacity=10, default_budget=(1000, 10), retry_after_s=7)
+
+    async def go():
+        big = await ctl.acquire("k", 50)                 # sam na serveru: prolazi iako je veći od kapaciteta
+        with pytest.raises(AdmissionRejected) as e:
+            await ctl.acquire("k", 1)
+        await ctl.release(big)
+        t = await ctl.acquire("k", 4)
+        return e.value, t
+
+    err, t = run(go())
+    assert err.reason == "server at capacity" and err.retry_after_s == 7
+    assert ctl.in_flight == 4 and ctl.running == 1 and t.cost == 4
+
+
+def test_waiting_request_admitted_after_release():
+    ctl = AdmissionController(capacity=10, default_budget=(1000, 10), max_wait_s=2.0)
+
+    async def go():
+        first = await ctl.acquire("k", 8)
+        waiter = asyncio.create_task(ctl.acquire("k", 5))
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        await ctl.release(first)
+        return await asyncio.wait_for(waiter, 1.0)
+
+    t = run(go())
+    assert t.cost == 5 and ctl.running == 1
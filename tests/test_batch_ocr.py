@@ -0,0 +1,93 @@
+"""
+agent_server batch path: scans probed in the CPU process pool still go through local OCR
+
+With BATCH_CPU_PROCESSES > 0 the pool sets has_text=False and page_count for a scan; the
+pipeline must still call tool_probe_pdf, whose try_ocr sends a confident OCR result down the
+text path instead of the VLM.
+
+Run: python -m pytest -q tests/test_batch_ocr.py
+"""
+import asyncio
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import agent_server  # noqa: E402
+from ocr_stage import PageOcr  # noqa: E402
+
+
+def scan_pdf(pages=2):
+    """PDF pages with only a filled rectangle (no text layer), like an image-only scan."""
+    stream = b"0.5 g 50 700 300 80 re f"
+    kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(pages)).encode()
+    objs = [b"<< /Type /Catalog /Pages 2 0 R >>",
+            b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % pages]
+    for i in range(pages):
+        objs.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents %d 0 R >>" % (4 + 2 * i))
+        objs.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objs, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objs) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objs) + 1, xref)
+    return bytes(out)
+
+
+class FakeOcr:
+    def __init__(self):
+        self.calls = 0
+
+    def ocr_pdf(self, file_bytes, pages, cancel_check=None):
+        self.calls += 1
+        return [PageOcr(p, "RAČUN br. 125-1-1\nUkupno: 1.250,00 EUR\n" * 3, 92.0, 30, False) for p in pages]
+
+
+@pytest.fixture
+def batch(monkeypatch):
+    ocr = FakeOcr()
+    paths = []
+
+    def timed_path(path, fn, state):
+        paths.append((path, state.text))
+        state.result_json = {"documentType": "invoice"}
+        return state.result_json
+
+    monkeypatch.setattr(agent_server, "OCR", ocr)
+    monkeypatch.setattr(agent_server, "AGENT_POLICY", "rule_based")
+    monkeypatch.setattr(agent_server, "BATCH_CPU_PROCESSES", 1)
+    monkeypatch.setattr(agent_server, "_timed_path", timed_path)
+    yield ocr, paths
+    pool = agent_server._BATCH_CPU_POOL
+    if pool is not None:
+        pool.shutdown()
+        agent_server._BATCH_CPU_POOL = None
+
+
+def run_document(data, params):
+    with ThreadPoolExecutor(2) as threads:
+        return asyncio.run(agent_server._batch_document(0, "scan.pdf", "application/pdf", data, params,
+                                                        agent_server.CancelToken(), threads, "test"))
+
+
+def test_pool_probed_scan_goes_through_ocr(batch):
+    ocr, paths = batch
+    rec = run_document(scan_pdf(), {"max_pages": 2, "split": False})
+    assert rec["status"] == "done", rec
+    assert ocr.calls == 1
+    assert [p for p, _ in paths] == ["text"]
+    assert "RAČUN br. 125-1-1" in paths[0][1]
+
+
+def test_pool_probed_scan_full_document_uses_ocr_text(batch):
+    ocr, paths = batch
+    rec = run_document(scan_pdf(), {"max_pages": 2, "split": False, "full_document": True})
+    assert rec["status"] == "done", rec
+    assert ocr.calls == 1
+    assert [p for p, _ in paths] == ["text"]
@@ -0,0 +1,89 @@
+"""
+dedup_index: LSH lookup of near-duplicate invoices and the documentNumber/total cross-check
+
+Fingerprints are built from text directly (the same minhash(shingles(text)) that fingerprint()
+uses for the text layer), so the tests do not depend on PDF rendering.
+
+Run: python -m pytest -q tests/test_dedup_index.py
+"""
+import hashlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dedup_index import DedupIndex, Fingerprint, _jaccard_est, minhash, shingles  # noqa: E402
+
+
+def parse_number(s):
+    t = (s or "").strip()
+    if "," in t:
+        t = t.replace(".", "").replace(",", ".")
+    try:
+        return float(t)
+    except ValueError:
+        return None
+
+
+def invoice_text(number, total="1.250,00", footer="Hvala na povjerenju."):
+    lines = [f"ACME d.o.o. Ilica {i}, 10000 Zagreb, OIB 12345678903, stavka {i} vijak M{i} kom {i} cijena {i},00"
+             for i in range(1, 30)]
+    return "\n".join([f"RAČUN br. {number}"] + lines + [f"Ukupno za platiti: {total} EUR", footer])
+
+
+def fp(text, dh=None):
+    return Fingerprint(hashlib.sha256(text.encode()).hexdigest(), dh, minhash(shingles(text)) if text else None, text)
+
+
+RESULT = {"documentNumber": "125-1-1", "totals": {"totalAmount": 1250.0}}
+
+
+@pytest.fixture
+def index(tmp_path):
+    return DedupIndex(str(tmp_path / "dedup.sqlite"), parse_number=parse_number, text_threshold=0.8,
+                      image_only_distance=3)
+
+
+def test_exact_hit(index):
+    f = fp(invoice_text("125-1-1"))
+    assert index.add(f, RESULT)
+    hit = index.lookup(f)
+    assert hit.kind == "exact" and hit.result == RESULT
+    assert not index.add(f, RESULT)          # isti sha256 se ne sprema dvaput
+
+
+def test_lsh_text_hit_for_rescan(index):
+    index.add(fp(invoice_text("125-1-1")), RESULT)
+    # ponovni izvoz: isti račun, drugačiji podnožak
+    hit = index.lookup(fp(invoice_text("125-1-1", footer="Ispisano: 19.10.2026. 10:15")))
+    assert hit is not None and hit.kind == "text"
+    assert hit.similarity >= 0.8
+    assert hit.result == RESULT
+
+
+def test_near_text_with_other_number_is_rejected(index):
+    first = fp(invoice_text("125-1-1"))
+    index.add(first, RESULT)
+    other = fp(invoice_text("126-1-1"))
+    # isti layout dobavljača: MinHash je iznad praga, ali broj računa nije u novom tekstu
+    assert _jaccard_est(first.minhash, other.minhash) >= 0.8
+    assert index.lookup(other) is None
+
+
+def test_near_text_with_other_total_is_rejected(index):
+    index.add(fp(invoice_text("125-1-1")), RESULT)
+    assert index.lookup(fp(invoice_text("125-1-1", total="1.350,00"))) is None
+
+
+def test_result_without_cross_check_fields_is_not_indexed(index):
+    assert not index.add(fp(invoice_text("125-1-1")), {"documentNumber": "125-1-1", "totals": {}})
+    assert index.summary() == {"documents": 0}
+
+
+def test_image_only_match_needs_distance(index):
+    dh = 0x0F0F_F0F0_1234_ABCD
+    index.add(fp("", dh=dh), RESULT)
+    hit = index.lookup(Fingerprint("other-scan", dh ^ 0b101, None, ""))
+    assert hit is not None and hit.kind == "image" and hit.distance == 2
+    assert index.lookup(Fingerprint("far-scan", dh ^ 0xFF, None, "")) is None
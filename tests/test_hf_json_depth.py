@@ -0,0 +1,75 @@
+"""
+hf_backend.JsonDepth: the per-row stop of local generation fires only when the top-level JSON
+object closes
+
+The answer is fed in small pieces, like decoded tokens. torch/transformers are imported lazily
+by hf_backend, so this runs without them.
+
+Run: python -m pytest -q tests/test_hf_json_depth.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hf_backend import JsonDepth  # noqa: E402
+
+
+def feed_pieces(text, size=3):
+    """Index of the piece after which feed() returned True, or None."""
+    d = JsonDepth()
+    for i in range(0, len(text), size):
+        if d.feed(text[i:i + size]):
+            return i // size
+    return None
+
+
+def test_flat_object_closes():
+    d = JsonDepth()
+    assert d.feed('{"a": 1') is False
+    assert d.feed('}') is True
+    assert d.closed and d.depth == 0
+
+
+def test_nested_objects_stop_only_at_depth_zero():
+    text = '{"supplier": {"name": "ACME"}, "items": [{"qty": 1}, {"qty": 2}], "totals": {}}'
+    d = JsonDepth()
+    for i, ch in enumerate(text):
+        closed = d.feed(ch)
+        assert closed is (i == len(text) - 1), (i, ch)
+    # u komadima: staje na komadu sa zadnjom '}', iako u njemu slijedi i dio ograde
+    assert feed_pieces(text + "\n```") == (len(text) - 1) // 3
+
+
+def test_braces_and_quotes_inside_strings_do_not_count():
+    text = r'{"description": "Vijak {M8} [kom] \"DIN 933\" }}", "note": "a\\", "x": "}"}'
+    d = JsonDepth()
+    for i, ch in enumerate(text):
+        closed = d.feed(ch)
+        assert closed is (i == len(text) - 1), (i, ch)
+
+
+def test_escaped_backslash_before_quote_ends_string():
+    d = JsonDepth()
+    assert d.feed('{"path": "C:\\\\"') is False             # "C:\\" -> string je zatvoren
+    assert d.in_string is False
+    assert d.feed("}") is True
+
+
+def test_text_before_first_brace_is_ignored():
+    text = 'Evo rezultata: "} ] ```json\n{"a": {"b": "}"}}\n```'
+    d = JsonDepth()
+    assert d.feed(text[:text.index("{")]) is False
+    assert d.depth == 0 and not d.in_string
+    assert d.feed(text[text.index("{"):]) is True
+
+
+def test_nothing_after_close_is_counted():
+    d = JsonDepth()
+    assert d.feed('{"a": 1} {"b": 2') is True
+    assert d.feed("{{{") is True
+    assert d.depth == 0
+
+
+def test_unfinished_answer_does_not_stop():
+    assert feed_pieces('{"items": [{"description": "a}b", "qty": 1}') is None
+    assert feed_pieces('no json at all }}}') is None
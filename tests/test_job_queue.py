@@ -0,0 +1,139 @@
+"""
+job_queue: leases, heartbeat, retries and callbacks claimed exactly once
+
+Two JobQueue objects on one file stand in for two processes (API node + headless worker).
+An expired lease is simulated with a negative visibility.
+
+Run: python -m pytest -q tests/test_job_queue.py
+"""
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from job_queue import JobQueue  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "jobs.sqlite")
+
+
+@pytest.fixture
+def q(db_path):
+    return JobQueue(db_path, max_attempts=2, backoff_s=0.0)
+
+
+def enqueue(q, callback_url=None):
+    return q.enqueue(b"%PDF-1.4 test", "invoice.pdf", "application/pdf", {"max_pages": 3}, callback_url=callback_url)
+
+
+def test_lease_hands_out_job_once(q):
+    job_id = enqueue(q)
+    job = q.lease("w1", visibility_s=600)
+    assert job.id == job_id and job.attempts == 1
+    assert job.file_bytes == b"%PDF-1.4 test" and job.params == {"max_pages": 3}
+    assert q.lease("w2", visibility_s=600) is None
+
+
+def test_expired_lease_is_redelivered_and_old_worker_loses_it(q):
+    job_id = enqueue(q)
+    q.lease("w1", visibility_s=-1)           # radnik je umro: lease je već istekao
+    job = q.lease("w2", visibility_s=600)
+    assert job.id == job_id and job.attempts == 2
+    assert q.heartbeat(job_id, "w1", 600) is False
+    assert q.complete(job_id, "w1", {"late": True}) is False
+    assert q.complete(job_id, "w2", {"ok": True}) is True
+    assert q.get(job_id)["result"] == {"ok": True}
+
+
+def test_heartbeat_keeps_lease(q):
+    job_id = enqueue(q)
+    q.lease("w1", visibility_s=-1)
+    assert q.heartbeat(job_id, "w1", 600) is True
+    assert q.lease("w2", visibility_s=600) is None
+
+
+def test_retry_count_then_failed(q):
+    job_id = enqueue(q)
+    q.lease("w1", visibility_s=600)
+    assert q.fail(job_id, "w1", "boom") == "queued"
+    st = q.get(job_id)
+    assert st["status"] == "queued" and st["attempts"] == 1 and st["error"] == "boom"
+    job = q.lease("w1", visibility_s=600)
+    assert job.attempts == 2
+    assert q.fail(job_id, "w1", "boom again") == "failed"
+    assert q.get(job_id)["status"] == "failed"
+    assert q.lease("w1", visibility_s=600) is None
+    assert q.fail(job_id, "w1", "not ours") is None
+
+
+def test_release_does_not_count_attempt(q):
+    job_id = enqueue(q)
+    q.lease("w1", visibility_s=600)
+    q.release(job_id, "w1")
+    assert q.lease("w2", visibility_s=600).attempts == 1
+
+
+def test_last_attempt_lease_expiry_fails_job(q):
+    job_id = enqueue(q)
+    q.lease("w1", visibility_s=-1)
+    q.lease("w2", visibility_s=-1)
+    assert q.lease("w3", visibility_s=600) is None   # nema više pokušaja
+    assert q.expire_leases() == [job_id]
+    st = q.get(job_id)
+    assert st["status"] == "failed" and st["error"] == "lease expired"
+    assert q.expire_leases() == []
+
+
+def test_finished_job_drops_upload_and_is_purged(q):
+    job_id = enqueue(q)
+    q.lease("w1", visibility_s=600)
+    q.complete(job_id, "w1", {"ok": True})
+    with q._lock:
+        assert q._db.execute("SELECT file FROM jobs WHERE id = ?", (job_id,)).fetchone()["file"] == b""
+    assert q.purge(retention_s=3600) == 0
+    assert q.purge(retention_s=-1) == 1
+    assert q.get(job_id) is None
+
+
+def test_callback_claimed_exactly_once(db_path, q):
+    ids = []
+    for _ in range(5):
+        job_id = enqueue(q, callback_url="http://client/cb")
+        q.lease("w1", visibility_s=600)
+        q.complete(job_id, "w1", {"ok": True})
+        ids.append(job_id)
+    enqueue(q, callback_url="http://client/cb")          # još nije gotov: nema callbacka
+    nodes = [JobQueue(db_path), JobQueue(db_path), q]
+    claimed = []
+    lock = threading.Lock()
+
+    def sender(node):
+        while True:
+            got = node.claim_callback(hold_s=600)
+            if got is None:
+                return
+            with lock:
+                claimed.append(got[0])
+
+    threads = [threading.Thread(target=sender, args=(n,)) for n in nodes]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(claimed) == sorted(ids)
+
+
+def test_expired_callback_claim_is_handed_out_again(q):
+    job_id = enqueue(q, callback_url="http://client/cb")
+    q.lease("w1", visibility_s=600)
+    q.fail(job_id, "w1", "bad pdf", retry=False)
+    assert q.claim_callback(hold_s=-1) == (job_id, "http://client/cb")   # pošiljatelj je umro
+    assert q.claim_callback(hold_s=600) == (job_id, "http://client/cb")
+    assert q.claim_callback(hold_s=600) is None
+    q.set_callback_status(job_id, "sent")
+    assert q.claim_callback(hold_s=-1) is None
+    assert q.get(job_id)["callbackStatus"] == "sent"
@@ -0,0 +1,148 @@
+"""
+llm_pool: circuit breaker (open / half-open probe / close) and least-outstanding routing
+
+The probe is a fake, so no endpoint has to be running.
+
+Run: python -m pytest -q tests/test_llm_pool.py
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from llm_pool import EndpointPool, NoHealthyEndpoint, split_urls  # noqa: E402
+
+A, B = "http://a:8000", "http://b:8000"
+
+
+class FakeProbe:
+    def __init__(self):
+        self.up = {A: True, B: True}
+        self.calls = []
+
+    def __call__(self, url, timeout=3.0):
+        self.calls.append(url)
+        return self.up[url]
+
+
+@pytest.fixture
+def pool():
+    probe = FakeProbe()
+    return EndpointPool("text", f"{A}, {B}/", failure_threshold=2, cooldown_s=30.0, probe=probe), probe
+
+
+def by_url(p, url):
+    return next(ep for ep in p.endpoints if ep.url == url)
+
+
+def cool_down(p, url):
+    """Pomakni vrijeme izbacivanja unatrag kao da je cooldown prošao."""
+    by_url(p, url).ejected_at -= p.cooldown_s + 1
+
+
+def test_split_urls():
+    assert split_urls(" http://a:8000/, ,http://b:8000 ") == [A, B]
+    with pytest.raises(ValueError):
+        EndpointPool("text", "")
+
+
+def test_least_outstanding_routing(pool):
+    p, _ = pool
+    first = p.acquire()
+    second = p.acquire()
+    assert {first.url, second.url} == {A, B}
+    third = p.acquire()
+    assert third is first                  # izjednačeno -> manje ukupnih zahtjeva
+    p.acquire()
+    p.release(first, ok=True)
+    p.release(first, ok=True)
+    # first je sada jedini bez zahtjeva u letu, iako je ukupno primio više
+    assert p.acquire() is first
+    assert p.acquire() is first
+    assert (first.outstanding, second.outstanding) == (2, 2)
+
+
+def test_ties_share_load_round_robin(pool):
+    p, _ = pool
+    urls = []
+    for _ in range(4):
+        ep = p.acquire()
+        urls.append(ep.url)
+        p.release(ep, ok=True)
+    assert urls.count(A) == urls.count(B) == 2
+
+
+def test_affinity_pins_endpoint(pool):
+    p, _ = pool
+    pinned = p.acquire(affinity="conv-1")
+    p.release(pinned, ok=True)
+    busy = p.acquire(affinity="conv-1")
+    assert busy is pinned              # pinned pobjeđuje i kad ima više zahtjeva u letu
+    assert p.acquire(affinity="conv-1") is pinned
+
+
+def test_breaker_opens_after_consecutive_failures(pool):
+    p, _ = pool
+    a = by_url(p, A)
+    p.release(p.acquire(exclude=[by_url(p, B)]), ok=False)
+    assert a.healthy                   # jedna greška još ne otvara prekidač
+    p.release(p.acquire(exclude=[by_url(p, B)]), ok=True)
+    p.release(p.acquire(exclude=[by_url(p, B)]), ok=False)
+    assert a.healthy                   # uspjeh je resetirao brojač
+    p.release(p.acquire(exclude=[by_url(p, B)]), ok=False)
+    assert not a.healthy
+    assert all(p.acquire().url == B for _ in range(3))
+
+
+def test_no_healthy_endpoint(pool):
+    p, _ = pool
+    for url in (A, B):
+        for _ in range(2):
+            p.release(by_url(p, url), ok=False)
+    assert not p.any_healthy
+    with pytest.raises(NoHealthyEndpoint):
+        p.acquire()
+
+
+def test_half_open_probe_failure_keeps_endpoint_out(pool):
+    p, probe = pool
+    for _ in range(2):
+        p.release(by_url(p, A), ok=False)
+    p.acquire()
+    assert probe.calls == []           # cooldown još traje: nema probe
+    probe.up[A] = False
+    cool_down(p, A)
+    assert p.acquire().url == B
+    assert probe.calls == [A]
+    assert not by_url(p, A).healthy
+    p.acquire()
+    assert probe.calls == [A]          # novi cooldown nakon neuspjele probe
+
+
+def test_half_open_probe_success_closes_breaker(pool):
+    p, probe = pool
+    a = by_url(p, A)
+    for _ in range(2):
+        p.release(a, ok=False)
+    cool_down(p, A)
+    by_url(p, B).outstanding = 5
+    assert p.acquire() is a
+    assert probe.calls == [A]
+    assert a.healthy and a.failures == 0
+
+
+def test_background_check(pool):
+    p, probe = pool
+    a = by_url(p, A)
+    probe.up[A] = False
+    assert p.check(a) is False
+    assert not a.healthy and a.reachable is False
+    p.background_probing = True
+    cool_down(p, A)
+    p.acquire()
+    assert probe.calls == [A]          # acquire ne probira kad to radi pozadinski zadatak
+    probe.up[A] = True
+    assert p.check(a) is True
+    assert a.healthy
+    assert p.snapshot()[0]["latencyMs"] is not None
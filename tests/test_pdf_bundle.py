@@ -0,0 +1,130 @@
+"""
+pdf_bundle: split points of a multi-document PDF and the BUNDLE_MAX_PAGES overflow report
+
+Run: python -m pytest -q tests/test_pdf_bundle.py
+"""
+import os
+import sys
+
+import pypdfium2 as pdfium
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import agent_server  # noqa: E402
+from pdf_bundle import doc_number, extract_pages, page_counter, split_bundle  # noqa: E402
+
+
+def make_pdf(pages):
+    """A4 pages; each page is a list of text lines (Helvetica, top down) or None for a scan-like page."""
+    font = 3 + 2 * len(pages)
+    kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(len(pages))).encode()
+    objs = [b"<< /Type /Catalog /Pages 2 0 R >>",
+            b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % len(pages)]
+    for i, lines in enumerate(pages):
+        if lines is None:
+            stream = b"0.2 g 40 760 200 50 re f 0.6 g 40 300 500 300 re f"
+        else:
+            esc = [ln.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") for ln in lines]
+            stream = "\n".join(f"BT /F1 10 Tf 40 {800 - 14 * k} Td ({t}) Tj ET" for k, t in enumerate(esc)).encode("latin-1")
+        objs.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 %d 0 R >> >> "
+                    b"/Contents %d 0 R >>" % (font, 4 + 2 * i))
+        objs.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    objs.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objs, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objs) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objs) + 1, xref)
+    return bytes(out)
+
+
+def page(title, counter=None, body="Opis stavke Kolicina Cijena Iznos 1 kom 10,00"):
+    lines = ["Alati d.o.o., Ilica 1, Zagreb", title, body, "IBAN HR1210010051863000160"]
+    return lines + ([counter] if counter else [])
+
+
+def split(pages, **kw):
+    return [(s.pages, s.reason) for s in split_bundle(make_pdf(pages), **kw)]
+
+
+def test_page_counter_and_doc_number():
+    assert page_counter("Stranica 2 od 3") == (2, 3)
+    assert page_counter("Str. 4") == (4, None)
+    assert page_counter("Ukupno\n 2/ 4") == (2, 4)
+    assert page_counter("Stranica 5 od 3") is None
+    assert doc_number("Ponuda br. 25/0001960\nKupac") == "25/0001960"
+    assert doc_number("Quote No. : 183") == "183"
+
+
+def test_split_on_page_counter():
+    pages = [page("Racun br. 1", "Stranica 1 od 2"), page("nastavak stavki", "Stranica 2 od 2"),
+             page("Racun br. 2", "Stranica 1 od 1")]
+    assert split(pages) == [([0, 1], "first"), ([2], "counter")]
+
+
+def test_split_on_document_number():
+    pages = [page("Ponuda br. 25/0001960"), page("Ponuda br. 25/0001960"), page("Ponuda br. 25/0001961")]
+    segs = split_bundle(make_pdf(pages))
+    assert [(s.pages, s.reason, s.doc_number) for s in segs] == [
+        ([0, 1], "first", "25/0001960"), ([2], "docnumber", "25/0001961")]
+
+
+def test_split_on_style_change():
+    # brojač na svakoj stranici, pa stranica bez brojača; zatim sken usred digitalnog PDF-a
+    pages = [page("Racun br. 7", "Stranica 1 od 1"), page("Otpremnica uz racun"), None]
+    assert split(pages) == [([0], "first"), ([1], "style"), ([2], "style")]
+
+
+def test_repeated_scan_header_starts_new_document():
+    assert split([None, None]) == [([0], "first"), ([1], "header")]
+
+
+def test_unclear_bundle_stays_one_document():
+    pages = [page("Racun br. 1"), page("nastavak stavki bez broja i brojaca"), page("jos stavki i rekapitulacija")]
+    assert split(pages) == [([0, 1, 2], "first")]
+
+
+def test_extract_pages():
+    data = make_pdf([page("Racun br. 1", "Stranica 1 od 1"), page("Racun br. 2", "Stranica 1 od 1"),
+                     page("Racun br. 3", "Stranica 1 od 1")])
+    sub = pdfium.PdfDocument(extract_pages(data, [2, 0]))
+    try:
+        assert len(sub) == 2
+        tp = sub[0].get_textpage()
+        assert "Racun br. 3" in tp.get_text_bounded()
+        tp.close()
+    finally:
+        sub.close()
+
+
+def test_bundle_max_pages_overflow_is_reported(monkeypatch):
+    runs = []
+
+    def run_agent(state):
+        runs.append(len(pdfium.PdfDocument(state.file_bytes)))
+        state.result_json = {"documentType": "invoice"}
+        return state.result_json
+
+    monkeypatch.setattr(agent_server, "BUNDLE_MAX_PAGES", 3)
+    monkeypatch.setattr(agent_server, "run_agent", run_agent)
+    pages = [page(f"Racun br. {i}", "Stranica 1 od 1") for i in range(5)]
+    state = agent_server.AgentState(file_bytes=make_pdf(pages), is_pdf=True, split=True)
+    out = agent_server.run_request(state)
+    assert [d["pages"] for d in out["documents"]] == [[1], [2], [3]]
+    assert runs == [1, 1, 1]
+    info = state.bundle_info
+    assert info["pagesSeen"] == 3 and info["pagesTotal"] == 5 and info["truncated"] is True
+
+
+def test_bundle_within_limit_is_not_truncated(monkeypatch):
+    monkeypatch.setattr(agent_server, "run_agent", lambda state: {"documentType": "invoice"})
+    pages = [page("Racun br. 1", "Stranica 1 od 2"), page("nastavak", "Stranica 2 od 2"),
+             page("Racun br. 2", "Stranica 1 od 1")]
+    state = agent_server.AgentState(file_bytes=make_pdf(pages), is_pdf=True, split=True)
+    out = agent_server.run_request(state)
+    assert [d["pages"] for d in out["documents"]] == [[1, 2], [3]]
+    assert state.bundle_info["truncated"] is False
@@ -0,0 +1,224 @@
+"""
+supplier_templates: learning rules from validated results and rule-based extraction
+
+The invoices are generated as one-page PDFs with a Helvetica text layer, so pdfium sees the same
+positioned lines as in a real export.
+
+Run: python -m pytest -q tests/test_supplier_templates.py
+"""
+import json
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from supplier_templates import Line, TemplateStore  # noqa: E402
+
+OIB = "12345678903"
+IBAN = "HR1210010051863000160"
+BUYER_OIB = "98765432106"
+
+
+def parse_number(s):
+    t = (s or "").strip().replace(" ", "")
+    if "," in t:
+        t = t.replace(".", "").replace(",", ".")
+    try:
+        return float(t)
+    except ValueError:
+        return None
+
+
+def parse_date(s):
+    for fmt in ("%d.%m.%Y.", "%d.%m.%Y"):
+        try:
+            return datetime.strptime((s or "").strip(), fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+
+def make_pdf(texts):
+    """One A4 page; texts = [(x, y, string)] in PDF points (origin bottom left)."""
+    ops = []
+    for x, y, t in texts:
+        t = t.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+        ops.append(f"BT /F1 9 Tf {x} {y} Td ({t}) Tj ET")
+    stream = "\n".join(ops).encode("latin-1")
+    objs = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 5 0 R >> >> "
+        b"/Contents 4 0 R >>",
+        b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objs, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objs) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objs) + 1, xref)
+    return bytes(out)
+
+
+def fmt(v):
+    """1250.0 -> '1.250,00'"""
+    s = f"{v:,.2f}"
+    return s.replace(",", "X").replace(".", ",").replace("X", ".")
+
+
+def invoice(number, date, items, label_x=350):
+    """(pdf bytes, validated result) of one invoice in the supplier's fixed layout."""
+    texts = [
+        (40, 800, "Alati d.o.o."), (40, 788, f"OIB: {OIB}"), (40, 776, f"IBAN: {IBAN}"),
+        (40, 740, "Kupac j.d.o.o."), (40, 728, f"OIB kupca: {BUYER_OIB}"),
+        (label_x, 800, "Racun br."), (label_x + 80, 800, number),
+        (label_x, 788, f"Datum dokumenta: {date}"),
+        (40, 680, "Rb"), (70, 680, "Sifra"), (130, 680, "Opis"), (330, 680, "Kol"), (370, 680, "JM"),
+        (420, 680, "Cijena"), (500, 680, "Iznos"),
+    ]
+    y = 664
+    rows = []
+    for pos, (code, desc, qty, price) in enumerate(items, 1):
+        total = round(qty * price, 2)
+        texts += [(40, y, str(pos)), (70, y, code), (130, y, desc), (330, y, str(qty)), (370, y, "kom"),
+                  (420, y, fmt(price)), (500, y, fmt(total))]
+        rows.append({"position": pos, "code": code, "description": desc, "quantity": float(qty), "unit": "kom",
+                     "unitPrice": price, "discountPercent": None, "totalPrice": total})
+        y -= 14
+    subtotal = round(sum(r["totalPrice"] for r in rows), 2)
+    vat = round(subtotal * 0.25, 2)
+    texts += [(label_x, 500, "Osnovica:"), (label_x + 100, 500, fmt(subtotal)),
+              (label_x, 486, "PDV 25%:"), (label_x + 100, 486, fmt(vat)),
+              (label_x, 472, "Ukupno:"), (label_x + 100, 472, fmt(subtotal + vat))]
+    result = {
+        "documentType": "invoice", "documentNumber": number, "date": parse_date(date), "dueDate": None,
+        "currency": "EUR",
+        "supplier": {"name": "Alati d.o.o.", "address": None, "oib": OIB, "iban": IBAN},
+        "buyer": {"name": "Kupac j.d.o.o.", "address": None, "oib": BUYER_OIB, "iban": None},
+        "items": rows,
+        "totals": {"subtotal": subtotal, "vatAmount": vat, "totalAmount": round(subtotal + vat, 2)},
+    }
+    return make_pdf(texts), result
+
+
+INVOICES = [
+    invoice("125-1-1", "02.01.2025.", [("A100", "Vijak M8", 10, 1.5), ("B200", "Matica M8", 20, 0.3)]),
+    invoice("131-1-1", "09.01.2025.", [("C300", "Podloska M8", 50, 0.1), ("A100", "Vijak M8", 5, 1.5)]),
+    invoice("140-1-1", "15.01.2025.", [("D400", "Busilica", 1, 120.0), ("E500", "Svrdlo 6 mm", 3, 4.2)]),
+]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return TemplateStore(str(tmp_path / "templates.sqlite"), parse_number, parse_date, learn_min=3,
+                         spot_check_every=2)
+
+
+def learn_all(store):
+    return [store.observe(pdf, result) for pdf, result in INVOICES]
+
+
+def test_learns_after_consistent_observations(store):
+    assert learn_all(store) == [False, False, True]
+    assert store.summary() == {"suppliers": 1, "templates": 1}
+
+
+def test_learn_needs_agreeing_observations(store):
+    learn_all(store)
+    recent = [json.loads(r[0]) for r in store._db.execute("SELECT obs FROM observations ORDER BY id")]
+    assert store.learn(recent) is not None
+    assert store.learn(recent[:2]) is None                      # premalo opažanja
+    other = json.loads(json.dumps(recent[-1]))
+    other["fields"]["date"]["nth"] = 1                          # neobavezno polje: izostaje iz predloška
+    tpl = store.learn(recent[:2] + [other])
+    assert tpl is not None and "date" not in tpl["fields"] and "documentNumber" in tpl["fields"]
+    other["fields"]["documentNumber"]["mode"] = "next_line"     # obavezno polje bez suglasja -> nema predloška
+    assert store.learn(recent[:2] + [other]) is None
+    other = json.loads(json.dumps(recent[-1]))
+    other["items"]["classes"] = "NNN"                           # drugačiji raspored stupaca
+    assert store.learn(recent[:2] + [other]) is None
+
+
+def test_item_tail_split():
+    row = lambda *segs: Line(0, 0.5, [(i / 10, s) for i, s in enumerate(segs)])
+    assert TemplateStore._split_row(row("1", "A100", "Vijak M8", "10", "kom", "1,50", "15,00")) == (
+        ["1", "A100", "Vijak M8"], ["10", "kom", "1,50", "15,00"])
+    assert TemplateStore._split_row(row("2", "Kljuc 13", "4 kom", "6,25", "25,00")) == (
+        ["2", "Kljuc 13"], ["4", "kom", "6,25", "25,00"])
+    # kratak opis nije jedinica jer ispred njega nema količine
+    assert TemplateStore._split_row(row("3", "Lanac", "2", "33,00")) == (["3", "Lanac"], ["2", "33,00"])
+    assert TemplateStore._split_row(row("Ukupno:", "Lanac")) is None
+
+
+def test_extract_new_invoice(store):
+    learn_all(store)
+    pdf, expected = invoice("201-1-1", "03.02.2025.", [("F600", "Kljuc 13", 4, 6.25), ("A100", "Vijak M8", 100, 1.5),
+                                                       ("G700", "Lanac", 2, 33.0)])
+    m = store.match(pdf)
+    assert m is not None and m.oib == OIB
+    out = store.extract(m)
+    assert out["documentNumber"] == "201-1-1"
+    assert parse_date(out["date"]) == "2025-02-03"
+    assert parse_number(out["totals"]["totalAmount"]) == expected["totals"]["totalAmount"]
+    assert parse_number(out["totals"]["subtotal"]) == expected["totals"]["subtotal"]
+    assert out["supplier"]["oib"] == OIB and out["buyer"]["oib"] == BUYER_OIB
+    got = [(it["position"], it["code"], it["description"], parse_number(it["quantity"]), it["unit"],
+            parse_number(it["unitPrice"]), parse_number(it["totalPrice"])) for it in out["items"]]
+    want = [(it["position"], it["code"], it["description"], it["quantity"], it["unit"], it["unitPrice"],
+             it["totalPrice"]) for it in expected["items"]]
+    assert got == want
+
+
+def test_no_match_when_anchors_move(store):
+    learn_all(store)
+    pdf, _ = invoice("202-1-1", "04.02.2025.", [("A100", "Vijak M8", 1, 1.5)], label_x=120)
+    assert store.match(pdf) is None
+
+
+def test_no_match_without_template(store):
+    pdf, result = INVOICES[0]
+    store.observe(pdf, result)
+    assert store.match(pdf) is None
+
+
+def test_spot_check_cadence_and_drop(store):
+    learn_all(store)
+    assert [store.record_hit(OIB) for _ in range(4)] == [False, True, False, True]
+    store.report_spot_check(OIB, agreed=False)
+    assert store.summary()["templates"] == 0
+    assert store.match(INVOICES[0][0]) is None
+    assert learn_all(store)[-1] is True                         # ponovno naučen iz svježih opažanja
+
+
+def test_stores_sharing_a_file_merge_observations(tmp_path):
+    path = str(tmp_path / "shared.sqlite")
+    api = TemplateStore(path, parse_number, parse_date, learn_min=3)
+    worker = TemplateStore(path, parse_number, parse_date, learn_min=3)
+    (p0, r0), (p1, r1), (p2, r2) = INVOICES
+    assert api.observe(p0, r0) is False
+    assert worker.observe(p1, r1) is False
+    assert api.observe(p2, r2) is True
+    assert worker.match(p0) is not None
+    worker.record_hit(OIB)
+    api.record_hit(OIB)
+    assert api._db.execute("SELECT hits FROM suppliers WHERE oib = ?", (OIB,)).fetchone()[0] == 2
+
+
+def test_imports_legacy_json_store(tmp_path):
+    src = TemplateStore(str(tmp_path / "a.sqlite"), parse_number, parse_date, learn_min=3)
+    learn_all(src)
+    (tpl,) = src._db.execute("SELECT template FROM suppliers").fetchone()
+    legacy = tmp_path / "b.json"
+    legacy.write_text(json.dumps({"suppliers": {OIB: {"observations": [], "template": json.loads(tpl), "hits": 5}}}),
+                      encoding="utf-8")
+    store = TemplateStore(str(legacy), parse_number, parse_date, learn_min=3)
+    assert store.path.endswith("b.sqlite")
+    assert store.summary() == {"suppliers": 1, "templates": 1}
+    assert store.match(INVOICES[0][0]) is not None
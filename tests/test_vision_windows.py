@@ -0,0 +1,74 @@
+"""
+vision_windows: page windows and the join of an item cut by a window boundary
+
+Run: python -m pytest -q tests/test_vision_windows.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vision_windows import join_boundary_items, merge_windows, plan_windows  # noqa: E402
+
+
+def test_plan_windows_page_and_token_limits():
+    assert plan_windows([100] * 7, max_pages=3) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert plan_windows([400, 400, 400, 100], max_pages=3, max_tokens=900) == [[0, 1], [2, 3]]
+    # grupiranje prvih stranica ne ovisi o broju stranica koje slijede
+    assert plan_windows([100] * 4, max_pages=3)[0] == plan_windows([100] * 9, max_pages=3)[0]
+
+
+def test_same_row_on_both_windows_is_merged():
+    last = {"description": "Vijak M8x40 pocinčani", "quantity": 10, "totalPrice": 12.5}
+    first = {"description": "Vijak M8x40", "quantity": 10, "unitPrice": 1.25}
+    one = join_boundary_items(last, first)
+    assert one == {"description": "Vijak M8x40 pocinčani", "quantity": 10, "totalPrice": 12.5, "unitPrice": 1.25}
+
+
+def test_same_description_different_numbers_is_not_merged():
+    last = {"description": "Vijak M8x40", "quantity": 10, "totalPrice": 12.5}
+    first = {"description": "Vijak M8x40", "quantity": 20, "totalPrice": 25.0}
+    assert join_boundary_items(last, first) is None
+
+
+def test_description_then_numbers_is_merged():
+    last = {"description": "Usluga montaže i puštanja u rad"}
+    first = {"description": "", "quantity": 1, "unitPrice": 300.0, "totalPrice": 300.0}
+    one = join_boundary_items(last, first)
+    assert one == {"description": "Usluga montaže i puštanja u rad", "quantity": 1, "unitPrice": 300.0,
+                   "totalPrice": 300.0}
+
+
+def test_trailing_item_with_numbers_is_not_merged():
+    # zadnji red prozora je potpun (ima količinu i iznos), prvi red sljedećeg je zaseban
+    last = {"description": "Kabel NYM 3x1,5", "quantity": 50, "totalPrice": 45.0}
+    first = {"quantity": 2, "unitPrice": 8.0, "totalPrice": 16.0}
+    assert join_boundary_items(last, first) is None
+    last = {"description": "Kabel NYM 3x1,5", "totalPrice": 45.0}
+    assert join_boundary_items(last, first) is None
+
+
+def test_leading_item_with_description_is_not_merged():
+    # dva različita reda: jedan bez brojeva, drugi s vlastitim opisom
+    last = {"description": "Napomena: roba se isporučuje franko skladište"}
+    first = {"description": "Osigurač 16A", "quantity": 3, "totalPrice": 9.0}
+    assert join_boundary_items(last, first) is None
+    last = {"description": "Osigurač 16A", "quantity": 3, "totalPrice": 9.0}
+    first = {"description": "Napomena: roba se isporučuje franko skladište"}
+    assert join_boundary_items(last, first) is None
+
+
+def test_merge_windows_header_totals_and_boundary():
+    w1 = {"invoiceNumber": "125-1-1", "supplier": {"name": "ACME d.o.o."},
+          "items": [{"description": "A", "quantity": 1, "totalPrice": 10.0}, {"description": "B dugi opis"}],
+          "totals": {"total": None}}
+    w2 = {"invoiceNumber": "", "supplier": {"name": "", "oib": "12345678901"},
+          "items": [{"quantity": 2, "totalPrice": 20.0}, {"description": "C", "quantity": 1, "totalPrice": 5.0}],
+          "totals": {"total": 35.0}}
+    merged, joined = merge_windows([w1, w2])
+    assert joined == 1
+    assert merged["invoiceNumber"] == "125-1-1"
+    assert merged["supplier"] == {"name": "ACME d.o.o.", "oib": "12345678901"}
+    assert merged["totals"] == {"total": 35.0}
+    assert [it.get("description") for it in merged["items"]] == ["A", "B dugi opis", "C"]
+    assert merged["items"][1]["totalPrice"] == 20.0
+    assert w1["items"][1] == {"description": "B dugi opis"}    # ulazi se ne mijenjaju
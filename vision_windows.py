@@ -0,0 +1,147 @@
+"""
+Full-document vision: page windows for long scanned documents
+
+- plan_windows() groups pages greedily from page 1 into windows of at most `max_pages` pages and
+  `max_tokens` image tokens; the grouping of the first pages does not depend on how many pages
+  follow, so a re-run with a higher page limit reuses the cached windows and only adds new ones
+- merge_windows() joins the per-window results: header fields from the first window that has
+  them, totals from the last one (the summary is on the last page), items concatenated in page
+  order; an item cut by a window boundary (same row at the end of one window and the start of
+  the next, or a row whose description (without quantity/total) ends one window and whose
+  numbers (without description) start the next) is merged into one; anything else stays as is
+- WindowCache is a small thread-safe LRU of window results keyed by document hash, pages,
+  requested render width (before the memory fit) and prompt
+
+Usage from agent_server:
+  windows = plan_windows([tokens_page1, tokens_page2, ...], max_pages=3, max_tokens=6000)
+  merged, merged_items = merge_windows([result_window1, result_window2, ...])
+"""
+
+from __future__ import annotations
+import copy
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+_NUM_FIELDS = ("quantity", "unitPrice", "discountPercent", "totalPrice")
+
+
+def plan_windows(page_tokens: List[int], max_pages: int, max_tokens: int = 0) -> List[List[int]]:
+    """0-based page indices per window; max_tokens <= 0 = only the page limit applies."""
+    windows: List[List[int]] = []
+    cur: List[int] = []
+    used = 0
+    for i, tok in enumerate(page_tokens):
+        if cur and (len(cur) >= max_pages or (max_tokens > 0 and used + tok > max_tokens)):
+            windows.append(cur)
+            cur, used = [], 0
+        cur.append(i)
+        used += tok
+    if cur:
+        windows.append(cur)
+    return windows
+
+
+# ---------- merge ----------
+def _empty(v: Any) -> bool:
+    return v is None or v == "" or v == [] or v == {}
+
+
+def _norm(s: Any) -> str:
+    return "".join(ch for ch in str(s or "").lower() if ch.isalnum())
+
+
+def _numbers_agree(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    for k in _NUM_FIELDS:
+        x, y = a.get(k), b.get(k)
+        if isinstance(x, (int, float)) and isinstance(y, (int, float)) and abs(x - y) > 0.005:
+            return False
+    return True
+
+
+def _has_numbers(item: Dict[str, Any]) -> bool:
+    return any(isinstance(item.get(k), (int, float)) for k in ("quantity", "unitPrice", "totalPrice"))
+
+
+def _has_any(item: Dict[str, Any], keys: Tuple[str, ...]) -> bool:
+    return any(isinstance(item.get(k), (int, float)) for k in keys)
+
+
+def _fill(dst: Dict[str, Any], src: Dict[str, Any]) -> Dict[str, Any]:
+    for k, v in src.items():
+        if _empty(dst.get(k)) and not _empty(v):
+            dst[k] = v
+    return dst
+
+
+def join_boundary_items(last: Dict[str, Any], first: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """One item if `last` (end of a window) and `first` (start of the next) are the same row."""
+    da, db = _norm(last.get("description")), _norm(first.get("description"))
+    if da and db and (da.startswith(db) or db.startswith(da)) and _numbers_agree(last, first):
+        # isti red na oba prozora (stranica ponovljena ili red vidljiv na obje); duži opis je potpuniji
+        base, other = (last, first) if len(da) >= len(db) else (first, last)
+        return _fill(dict(base), other)
+    if da and not db and not _has_any(last, ("totalPrice", "quantity")) and _has_numbers(first):
+        # red prelomljen preko stranice: opis na kraju prozora, brojevi na početku sljedećeg
+        return _fill(dict(last), first)
+    return None
+
+
+def merge_windows(results: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], int]:
+    """Merged result of the windows in page order; returns (result, boundary items merged)."""
+    out: Dict[str, Any] = {}
+    items: List[Dict[str, Any]] = []
+    totals: Dict[str, Any] = {}
+    joined = 0
+    for res in results:
+        res = copy.deepcopy(res)
+        win_items = [it for it in (res.pop("items", None) or []) if isinstance(it, dict)]
+        for k, v in (res.pop("totals", None) or {}).items():
+            if not _empty(v):
+                totals[k] = v            # zadnji prozor s iznosom pobjeđuje
+        for k, v in res.items():
+            if isinstance(v, dict) and isinstance(out.get(k), dict):
+                _fill(out[k], v)
+            elif _empty(out.get(k)) and not _empty(v):
+                out[k] = v
+        if items and win_items:
+            one = join_boundary_items(items[-1], win_items[0])
+            if one is not None:
+                items[-1] = one
+                win_items = win_items[1:]
+                joined += 1
+        items.extend(win_items)
+    out["items"] = items
+    out["totals"] = totals
+    return out, joined
+
+
+# ---------- cache ----------
+class WindowCache:
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max(1, int(max_entries))
+        self._lock = threading.Lock()
+        self._data: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            v = self._data.get(key)
+            if v is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(v)
+
+    def put(self, key: tuple, value: Dict[str, Any]) -> None:
+        with self._lock:
+            self._data[key] = copy.deepcopy(value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._data), "hits": self.hits, "misses": self.misses}